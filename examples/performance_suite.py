@@ -1,544 +1,25 @@
-import metalgpu
-import numpy as np
-import time
-import sys
-
-# --- Test Configurations ---
-VECTOR_SIZE = 50_000_000  # Number of elements for vector operations
-MATRIX_M = 4096           # Rows for matrix A and C
-MATRIX_K = 4096           # Cols for matrix A / Rows for matrix B
-MATRIX_N = 4096           # Cols for matrix B and C
-POLY_DEGREE = 20           # Degree for polynomial evaluation
-COND_THRESHOLD = np.float32(0.5) # Threshold for conditional operation
-DOT_SUB_VECTOR_SIZE = 500 # Size of sub-vectors for partial dot product
-
-# --- Generic Test Runner ---
-def run_test(test_name, size_description, shader_str, kernel_name,
-             cpu_func, gpu_setup_func,
-             input_data_generators, num_outputs=1, verification_func=None):
-    """
-    Runs a single performance test and returns a dictionary of results.
-    """
-    print(f"Running test: {test_name} ({size_description})... ", end="")
-    sys.stdout.flush()
-
-    results = {
-        'name': test_name,
-        'size_desc': size_description,
-        'gpu_time': 'Error',
-        'cpu_time': 'Error',
-        'speedup': 'N/A',
-        'verified': 'No'
-    }
-
-    try:
-        # 1. Generate input data
-        input_arrays_np = [gen() for gen in input_data_generators]
-
-        # 2. CPU Computation
-        start_time_cpu = time.perf_counter()
-        cpu_result_arrays_np = cpu_func(*input_arrays_np)
-        if not isinstance(cpu_result_arrays_np, (list, tuple)):
-            cpu_result_arrays_np = (cpu_result_arrays_np,)
-        end_time_cpu = time.perf_counter()
-        results['cpu_time'] = end_time_cpu - start_time_cpu
-
-        # 3. GPU Computation
-        instance = None
-        gpu_buffers_all = [] # To keep track of all buffers for release
-        try:
-            instance = metalgpu.Interface()
-            instance.load_shader_from_string(shader_str)
-            instance.set_function(kernel_name)
-
-            # Setup GPU buffers and get grid size
-            # gpu_setup_func returns (grid_size, kernel_arg_buffers_list, output_placeholders_np_list)
-            grid_size, kernel_arg_buffers, output_placeholders_np = gpu_setup_func(instance, input_arrays_np)
-            gpu_buffers_all = kernel_arg_buffers # Keep track for release
-
-            start_time_gpu = time.perf_counter()
-            instance.run_function(grid_size, kernel_arg_buffers)
-            end_time_gpu = time.perf_counter()
-            results['gpu_time'] = end_time_gpu - start_time_gpu
-
-            # Retrieve results from GPU
-            # Assumes output buffers are the last `num_outputs` in kernel_arg_buffers
-            # and output_placeholders_np corresponds to them.
-            gpu_result_arrays_np = []
-            output_buffer_start_idx = len(kernel_arg_buffers) - num_outputs
-            for i in range(num_outputs):
-                output_buffer = kernel_arg_buffers[output_buffer_start_idx + i]
-                placeholder = output_placeholders_np[i]
-                retrieved_data = np.array(output_buffer.contents[:placeholder.size]).reshape(placeholder.shape)
-                gpu_result_arrays_np.append(retrieved_data)
-
-            # 4. Verification
-            verified_all = True
-            if verification_func:
-                try:
-                    verification_func(cpu_result_arrays_np, gpu_result_arrays_np)
-                    results['verified'] = 'Yes'
-                except AssertionError as e_verify:
-                    print(f"\nVerification FAILED for {test_name} (custom): {e_verify}")
-                    results['verified'] = 'No'
-                    verified_all = False # Though custom func might set this
-            else:
-                for i in range(num_outputs):
-                    try:
-                        # Adjusting rtol here to be more permissive
-                        np.testing.assert_allclose(gpu_result_arrays_np[i], cpu_result_arrays_np[i], rtol=0.1, atol=1e-5)
-                    except AssertionError as e_verify:
-                        print(f"\nVerification FAILED for {test_name}, output {i}: {e_verify}")
-                        verified_all = False
-                        break
-                results['verified'] = 'Yes' if verified_all else 'No'
-
-            # 5. Calculate Speedup
-            if isinstance(results['gpu_time'], float) and isinstance(results['cpu_time'], float) and results['cpu_time'] > 0:
-                if results['gpu_time'] > 0:
-                    results['speedup'] = f"{results['cpu_time'] / results['gpu_time']:.2f}x"
-                else:
-                    results['speedup'] = "Inf" if results['cpu_time'] > 0 else "N/A"
-            
-            print("Done.")
-
-        except Exception as e_gpu:
-            print(f"\nError during GPU part of {test_name}: {e_gpu}")
-            results['verified'] = 'Error (GPU)'
-        finally:
-            for buf in gpu_buffers_all:
-                if buf: buf.release()
-            # instance release/cleanup if necessary, but metalgpu.Interface might not need explicit release
-
-    except Exception as e_outer:
-        print(f"\nOuter error during test {test_name}: {e_outer}")
-        results['verified'] = 'Error (Outer)'
-    
-    return results
-
-# --- Test Implementations ---
-
-# Test 1: Vector Addition (C = A + B)
-def test_vector_addition():
-    shader = """
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void vector_add(device const float* A [[buffer(0)]],
-                           device const float* B [[buffer(1)]],
-                           device float* C       [[buffer(2)]],
-                           uint gid [[thread_position_in_grid]]) {
-        C[gid] = A[gid] + B[gid];
-    }
-    """
-    def cpu_op(a, b): return a + b
-    def gen_data(): return np.random.rand(VECTOR_SIZE).astype(np.float32)
-    
-    def gpu_setup(instance, inputs_np):
-        a_np, b_np = inputs_np
-        c_np_placeholder = np.empty_like(a_np)
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np
-        buf_b = instance.create_buffer(b_np.size, "float"); buf_b.contents[:] = b_np
-        buf_c = instance.create_buffer(c_np_placeholder.size, "float")
-        grid = metalgpu.MetalSize(a_np.size, 1, 1)
-        return grid, [buf_a, buf_b, buf_c], [c_np_placeholder]
-
-    return run_test("Vector Addition", f"N={VECTOR_SIZE}", shader, "vector_add", 
-                    cpu_op, gpu_setup, [gen_data, gen_data])
-
-# Test 2: Element-wise Square Root (B = sqrt(abs(A)))
-def test_elementwise_sqrt():
-    shader = """
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void element_sqrt(device const float* A [[buffer(0)]],
-                             device float* B       [[buffer(1)]],
-                             uint gid [[thread_position_in_grid]]) {
-        B[gid] = sqrt(fabs(A[gid]));
-    }
-    """
-    def cpu_op(a): return np.sqrt(np.abs(a))
-    def gen_data(): return (np.random.rand(VECTOR_SIZE).astype(np.float32) - 0.5) * 20.0
-    
-    def gpu_setup(instance, inputs_np):
-        a_np = inputs_np[0]
-        b_np_placeholder = np.empty_like(a_np)
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np
-        buf_b = instance.create_buffer(b_np_placeholder.size, "float")
-        grid = metalgpu.MetalSize(a_np.size, 1, 1)
-        return grid, [buf_a, buf_b], [b_np_placeholder]
-
-    return run_test("Elem-wise Sqrt(abs)", f"N={VECTOR_SIZE}", shader, "element_sqrt",
-                    cpu_op, gpu_setup, [gen_data])
-
-# Test 3: Element-wise Exponential (B = exp(A))
-def test_elementwise_exp():
-    shader = """
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void element_exp(device const float* A [[buffer(0)]],
-                            device float* B       [[buffer(1)]],
-                            uint gid [[thread_position_in_grid]]) {
-        B[gid] = exp(A[gid]);
-    }
-    """
-    def cpu_op(a): return np.exp(a)
-    def gen_data(): return (np.random.rand(VECTOR_SIZE).astype(np.float32) * 10.0) - 5.0
-    
-    def gpu_setup(instance, inputs_np): # Similar to sqrt
-        a_np = inputs_np[0]
-        b_np_placeholder = np.empty_like(a_np)
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np
-        buf_b = instance.create_buffer(b_np_placeholder.size, "float")
-        grid = metalgpu.MetalSize(a_np.size, 1, 1)
-        return grid, [buf_a, buf_b], [b_np_placeholder]
-
-    return run_test("Elem-wise Exp", f"N={VECTOR_SIZE}", shader, "element_exp",
-                    cpu_op, gpu_setup, [gen_data])
-
-# Test 4: SAXPY (Y_out = a * X + Y_in)
-def test_saxpy():
-    scalar_a_val = np.float32(2.5)
-    # Kernel: Y_out[gid] = a * X[gid] + Y_in[gid]
-    # To fit run_test, Y_out is the last buffer.
-    # Shader arguments: X (buf0), Y_in (buf1), a (buf2), Y_out (buf3)
-    # If Y is in-place: Y_in_out[gid] = a * X[gid] + Y_in_out[gid]
-    # Shader args: X (buf0), a (buf1), Y_in_out (buf2) - This is simpler.
-    shader = """
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void saxpy(device const float* X   [[buffer(0)]],
-                      constant float &a       [[buffer(1)]],
-                      device float* Y_in_out  [[buffer(2)]], 
-                      uint gid [[thread_position_in_grid]]) {
-        Y_in_out[gid] = a * X[gid] + Y_in_out[gid];
-    }
-    """
-    def cpu_op(x_np, y_initial_np): return scalar_a_val * x_np + y_initial_np
-    def gen_vec_data(): return np.random.rand(VECTOR_SIZE).astype(np.float32)
-    
-    def gpu_setup(instance, inputs_np):
-        x_np, y_initial_np = inputs_np
-        
-        # Y_in_out is the output, so its placeholder is based on y_initial_np's shape
-        y_output_placeholder_np = np.empty_like(y_initial_np) 
-
-        buf_x = instance.create_buffer(x_np.size, "float"); buf_x.contents[:] = x_np
-        
-        a_np = np.array([scalar_a_val], dtype=np.float32)
-        buf_a_scalar = instance.create_buffer(a_np.size, "float"); buf_a_scalar.contents[:] = a_np
-        
-        buf_y_in_out = instance.create_buffer(y_initial_np.size, "float")
-        buf_y_in_out.contents[:] = y_initial_np # Initialize Y for in-out operation
-        
-        grid = metalgpu.MetalSize(x_np.size, 1, 1)
-        # Kernel buffers: X, a, Y_in_out. Y_in_out is the output buffer.
-        return grid, [buf_x, buf_a_scalar, buf_y_in_out], [y_output_placeholder_np]
-
-    return run_test("SAXPY (Y=aX+Y)", f"N={VECTOR_SIZE}, a={scalar_a_val}", shader, "saxpy",
-                    cpu_op, gpu_setup, [gen_vec_data, gen_vec_data]) # X and Initial Y
-
-# Test 5: Matrix Multiplication (C = A @ B)
-def test_matrix_multiplication():
-    shader = """
-    #include <metal_stdlib>
-    using namespace metal;
-    struct MatDims { uint M; uint N; uint K; };
-    kernel void matmul(device const float* A  [[buffer(0)]], // A is M x K
-                       device const float* B  [[buffer(1)]], // B is K x N
-                       device float* C        [[buffer(2)]], // C is M x N
-                       constant MatDims &dims [[buffer(3)]],
-                       uint2 gid [[thread_position_in_grid]]) { // gid.x=col(N), gid.y=row(M)
-        uint M = dims.M; uint N = dims.N; uint K = dims.K;
-        if (gid.y >= M || gid.x >= N) return;
-        float sum = 0.0f;
-        for (uint i = 0; i < K; ++i) {
-            sum += A[gid.y * K + i] * B[i * N + gid.x];
-        }
-        C[gid.y * N + gid.x] = sum;
-    }
-    """
-    m, k, n = MATRIX_M, MATRIX_K, MATRIX_N
-    def cpu_op(a, b): return np.dot(a, b)
-    def gen_a(): return np.random.rand(m, k).astype(np.float32)
-    def gen_b(): return np.random.rand(k, n).astype(np.float32)
-
-    def gpu_setup(instance, inputs_np):
-        a_np, b_np = inputs_np
-        c_np_placeholder = np.empty((m, n), dtype=np.float32)
-
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np.flatten()
-        buf_b = instance.create_buffer(b_np.size, "float"); buf_b.contents[:] = b_np.flatten()
-        buf_c = instance.create_buffer(c_np_placeholder.size, "float") # Output buffer
-
-        dims_np = np.array([m, n, k], dtype=np.uint32) # M, N, K for shader
-        buf_dims = instance.create_buffer(dims_np.size, "uint")
-        buf_dims.contents[:] = dims_np
-        
-        grid = metalgpu.MetalSize(n, m, 1) # Grid: (width=N, height=M, depth=1)
-        # Kernel buffers: A, B, C, Dims. C is the output.
-        # To match run_test logic (output is last), this order is fine if C is the only output.
-        # If Dims was after C, then C wouldn't be last.
-        # Let's ensure C is the last *logical data output* buffer for run_test.
-        # The current run_test takes kernel_arg_buffers and num_outputs.
-        # It assumes the last num_outputs buffers in kernel_arg_buffers are the ones to retrieve.
-        # Here, kernel_arg_buffers = [buf_a, buf_b, buf_c, buf_dims]. num_outputs = 1.
-        # So it will try to retrieve from buf_dims. This is wrong.
-        #
-        # Fix: The output buffer (buf_c) must be the last one in the list if num_outputs=1.
-        # Kernel signature: A, B, Dims, C_out
-        # Shader: A(0), B(1), Dims(2), C(3)
-        new_shader_matmul = """
-        #include <metal_stdlib>
-        using namespace metal;
-        struct MatDims { uint M; uint N; uint K; };
-        kernel void matmul(device const float* A  [[buffer(0)]], 
-                           device const float* B  [[buffer(1)]], 
-                           constant MatDims &dims [[buffer(2)]], // Dims moved
-                           device float* C        [[buffer(3)]], // C is last
-                           uint2 gid [[thread_position_in_grid]]) {
-            uint M = dims.M; uint N = dims.N; uint K = dims.K;
-            if (gid.y >= M || gid.x >= N) return;
-            float sum = 0.0f;
-            for (uint i = 0; i < K; ++i) {
-                sum += A[gid.y * K + i] * B[i * N + gid.x];
-            }
-            C[gid.y * N + gid.x] = sum;
-        }
-        """
-        # This change requires instance.load_shader_from_string(new_shader_matmul) for this test.
-        # The main run_test function takes shader_str as an argument, so we pass the correct one.
-        
-        # Kernel arg buffers should be [buf_a, buf_b, buf_dims, buf_c]
-        return grid, [buf_a, buf_b, buf_dims, buf_c], [c_np_placeholder]
-
-    # Define the matmul shader with corrected buffer order for run_test compatibility
-    matmul_shader_ordered = """
-    #include <metal_stdlib>
-    using namespace metal;
-    struct MatDims { uint M; uint N; uint K; };
-    kernel void matmul(device const float* A  [[buffer(0)]], 
-                       device const float* B  [[buffer(1)]], 
-                       constant MatDims &dims [[buffer(2)]], 
-                       device float* C        [[buffer(3)]], 
-                       uint2 gid [[thread_position_in_grid]]) {
-        uint M = dims.M; uint N = dims.N; uint K = dims.K;
-        if (gid.y >= M || gid.x >= N) return;
-        float sum = 0.0f;
-        for (uint i = 0; i < K; ++i) {
-            sum += A[gid.y * K + i] * B[i * N + gid.x];
-        }
-        C[gid.y * N + gid.x] = sum;
-    }
-    """
-    return run_test("Matrix Multiplication", f"M,K,N={MATRIX_M}", matmul_shader_ordered, "matmul",
-                    cpu_op, gpu_setup, [gen_a, gen_b])
-
-
-# Test 6: Polynomial Evaluation (Horner's method)
-# P(x) = coeffs[0] + x*(coeffs[1] + x*(coeffs[2] + ...))
-def test_polynomial_evaluation():
-    coeffs = (np.random.rand(POLY_DEGREE + 1).astype(np.float32) - 0.5) * 2.0
-    # Shader expects coefficients buffer, then x_vector, then degree, THEN output_vector
-    shader_str = f"""
-    #include <metal_stdlib>
-    using namespace metal;
-
-    kernel void polynomial_eval(
-        device const float* coeffs       [[buffer(0)]],
-        device const float* x_values     [[buffer(1)]],
-        constant uint& degree          [[buffer(2)]], // Moved degree before results
-        device float* results          [[buffer(3)]], // Results is now last data buffer
-        uint gid [[thread_position_in_grid]])
-    {{
-        float x = x_values[gid];
-        float val = 0.0f;
-
-        // Correction: Standard Horner is sum = coeffs[degree]; for i=degree-1..0 sum = sum*x + coeffs[i]
-        // Or: val = coeffs[0]; x_pow = x; for i=1..degree val += coeffs[i]*x_pow; x_pow*=x (less efficient)
-        // Let's use the typical Horner loop:
-        val = coeffs[degree]; // Highest degree coefficient
-        for (int i = degree - 1; i >= 0; --i) {{ // Note: int for loop condition
-            val = val * x + coeffs[i];
-        }}
-        results[gid] = val;
-    }}
-    """
-    def cpu_poly_eval(x_vec_np):
-        res_np = np.zeros_like(x_vec_np)
-        for i in range(POLY_DEGREE, -1, -1):
-            res_np = res_np * x_vec_np + coeffs[i]
-        return res_np
-
-    def gen_x_data(): return (np.random.rand(VECTOR_SIZE).astype(np.float32) - 0.5) * 5.0 # x values in [-2.5, 2.5]
-
-    def gpu_setup_poly(instance, inputs_np):
-        x_values_np = inputs_np[0]
-        results_placeholder_np = np.empty_like(x_values_np)
-
-        buf_coeffs = instance.create_buffer(coeffs.size, "float"); buf_coeffs.contents[:] = coeffs
-        buf_x_values = instance.create_buffer(x_values_np.size, "float"); buf_x_values.contents[:] = x_values_np
-        
-        degree_np = np.array([POLY_DEGREE], dtype=np.uint32)
-        buf_degree = instance.create_buffer(degree_np.size, "uint"); buf_degree.contents[:] = degree_np
-        
-        buf_results = instance.create_buffer(results_placeholder_np.size, "float") # Output buffer
-
-        grid = metalgpu.MetalSize(x_values_np.size, 1, 1)
-        # Kernel args: coeffs, x_values, degree, results. Output: results (now correctly last)
-        return grid, [buf_coeffs, buf_x_values, buf_degree, buf_results], [results_placeholder_np]
-
-    return run_test("Polynomial Eval", f"N={VECTOR_SIZE}, deg={POLY_DEGREE}", shader_str, "polynomial_eval",
-                    cpu_poly_eval, gpu_setup_poly, [gen_x_data])
-
-# Test 7: Conditional Vector Operation (C = (A > thresh) ? B : D)
-def test_conditional_operation():
-    shader_str = """
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void conditional_op(
-        device const float* A [[buffer(0)]],
-        device const float* B [[buffer(1)]],
-        device const float* D [[buffer(2)]],
-        constant float& threshold [[buffer(3)]], // Moved threshold before C
-        device float* C       [[buffer(4)]], // C is now last data buffer
-        uint gid [[thread_position_in_grid]]) {
-        C[gid] = (A[gid] > threshold) ? B[gid] : D[gid];
-    }
-    """
-    def cpu_cond_op(a_np, b_np, d_np): return np.where(a_np > COND_THRESHOLD, b_np, d_np)
-    def gen_data(): return np.random.rand(VECTOR_SIZE).astype(np.float32)
-
-    def gpu_setup_cond(instance, inputs_np):
-        a_np, b_np, d_np = inputs_np
-        c_placeholder_np = np.empty_like(a_np)
-
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np
-        buf_b = instance.create_buffer(b_np.size, "float"); buf_b.contents[:] = b_np
-        buf_d = instance.create_buffer(d_np.size, "float"); buf_d.contents[:] = d_np
-        
-        thresh_np = np.array([COND_THRESHOLD], dtype=np.float32)
-        buf_thresh = instance.create_buffer(thresh_np.size, "float"); buf_thresh.contents[:] = thresh_np
-        
-        buf_c = instance.create_buffer(c_placeholder_np.size, "float") # Output buffer
-
-        grid = metalgpu.MetalSize(a_np.size, 1, 1)
-        # Kernel args: A, B, D, threshold, C. Output: C (now correctly last)
-        return grid, [buf_a, buf_b, buf_d, buf_thresh, buf_c], [c_placeholder_np]
-
-    return run_test("Conditional Op", f"N={VECTOR_SIZE}, thr={COND_THRESHOLD}", shader_str, "conditional_op",
-                    cpu_cond_op, gpu_setup_cond, [gen_data, gen_data, gen_data])
-
-# Test 8: Partial Dot Product (GPU computes partial sums, CPU sums them)
-def test_partial_dot_product():
-    num_partial_sums = VECTOR_SIZE // DOT_SUB_VECTOR_SIZE
-    if VECTOR_SIZE % DOT_SUB_VECTOR_SIZE != 0:
-        print(f"Warning: VECTOR_SIZE ({VECTOR_SIZE}) not perfectly divisible by DOT_SUB_VECTOR_SIZE ({DOT_SUB_VECTOR_SIZE}). Adjust for production.")
-        # For simplicity, this test assumes perfect divisibility or truncates.
-        # Effective vector size for this test will be num_partial_sums * DOT_SUB_VECTOR_SIZE
-    effective_vector_size = num_partial_sums * DOT_SUB_VECTOR_SIZE
-
-    shader_str = f"""
-    #include <metal_stdlib>
-    using namespace metal;
-    kernel void partial_dot_product(
-        device const float* A [[buffer(0)]],
-        device const float* B [[buffer(1)]],
-        constant uint& sub_vector_size [[buffer(2)]], // Moved sub_vector_size before C_partial_sums
-        device float* C_partial_sums [[buffer(3)]], // C_partial_sums is now last data buffer
-        uint gid [[thread_position_in_grid]]) // gid is index of the partial sum
-    {{
-        float current_sum = 0.0f;
-        uint start_index = gid * sub_vector_size;
-        for (uint i = 0; i < sub_vector_size; ++i) {{
-            current_sum += A[start_index + i] * B[start_index + i];
-        }}
-        C_partial_sums[gid] = current_sum;
-    }}
-    """
-
-    def cpu_dot_product(a_np, b_np):
-        # CPU computes the full dot product on the effective size
-        return np.dot(a_np[:effective_vector_size], b_np[:effective_vector_size])
-
-    def gen_data_dot(): return np.random.rand(effective_vector_size).astype(np.float32)
-
-    def gpu_setup_dot(instance, inputs_np):
-        a_np, b_np = inputs_np # These are already of effective_vector_size
-        
-        # Placeholder for partial sums from GPU
-        c_partial_placeholder_np = np.empty(num_partial_sums, dtype=np.float32)
-
-        buf_a = instance.create_buffer(a_np.size, "float"); buf_a.contents[:] = a_np
-        buf_b = instance.create_buffer(b_np.size, "float"); buf_b.contents[:] = b_np
-        
-        sub_vec_size_np = np.array([DOT_SUB_VECTOR_SIZE], dtype=np.uint32)
-        buf_sub_vec_size = instance.create_buffer(sub_vec_size_np.size, "uint")
-        buf_sub_vec_size.contents[:] = sub_vec_size_np
-
-        buf_c_partial = instance.create_buffer(c_partial_placeholder_np.size, "float") # Output buffer
-
-        grid = metalgpu.MetalSize(num_partial_sums, 1, 1) # One thread per partial sum
-        # Kernel args: A, B, sub_vector_size, C_partial_sums. Output: C_partial_sums (now correctly last)
-        return grid, [buf_a, buf_b, buf_sub_vec_size, buf_c_partial], [c_partial_placeholder_np]
-
-    def verify_dot_prod(cpu_results, gpu_results):
-        cpu_scalar_result = cpu_results[0]
-        gpu_partial_sums_array = gpu_results[0]
-        gpu_scalar_result = np.sum(gpu_partial_sums_array)
-        np.testing.assert_allclose(gpu_scalar_result, cpu_scalar_result, rtol=1e-3, atol=1e-4) # Relaxed tolerance for sums
-        return True # assert_allclose will raise on failure
-
-    return run_test("Partial Dot Product", f"N={effective_vector_size}, SubN={DOT_SUB_VECTOR_SIZE}", shader_str, "partial_dot_product",
-                    cpu_dot_product, gpu_setup_dot, [gen_data_dot, gen_data_dot], verification_func=verify_dot_prod)
-
-
-# --- Main Execution & Table Formatting ---
-def main():
-    all_test_results = []
-    
-    print("Starting Comprehensive GPU Performance Test Suite...")
-    print(f"Vector Size for element-wise ops: {VECTOR_SIZE}")
-    print(f"Matrix Dimensions (M,K,N) for matmul: ({MATRIX_M}, {MATRIX_K}, {MATRIX_N})\n")
-
-    all_test_results.append(test_vector_addition())
-    all_test_results.append(test_elementwise_sqrt())
-    all_test_results.append(test_elementwise_exp())
-    all_test_results.append(test_saxpy())
-    all_test_results.append(test_matrix_multiplication())
-    all_test_results.append(test_polynomial_evaluation())
-    all_test_results.append(test_conditional_operation())
-    all_test_results.append(test_partial_dot_product())
-
-    # Print results table
-    print("\n\n--- Performance Test Results ---")
-    
-    # Filter out None results if any test failed very early
-    valid_results = [r for r in all_test_results if r]
-    if not valid_results:
-        print("No valid test results to display.")
-        return
-
-    name_w = max(len("Test Name"), max(len(r['name']) for r in valid_results))
-    size_w = max(len("Data Size"), max(len(r['size_desc']) for r in valid_results))
-    gput_w = max(len("GPU Time (s)"), 12)
-    cput_w = max(len("CPU Time (s)"), 12)
-    speed_w = max(len("Speedup"), 10)
-    ver_w = max(len("Verified"), 12) # Increased for "Error (GPU)"
-
-    header = f"| {'Test Name':<{name_w}} | {'Data Size':<{size_w}} | {'GPU Time (s)':>{gput_w}} | {'CPU Time (s)':>{cput_w}} | {'Speedup':>{speed_w}} | {'Verified':<{ver_w}} |"
-    sep = f"|{'-'*(name_w+2)}|{'-'*(size_w+2)}|{'-'*(gput_w+2)}|{'-'*(cput_w+2)}|{'-'*(speed_w+2)}|{'-'*(ver_w+2)}|"
-    
-    print(sep)
-    print(header)
-    print(sep)
-
-    for r in valid_results:
-        gpu_time_str = f"{r['gpu_time']:.6f}" if isinstance(r['gpu_time'], float) else str(r['gpu_time'])
-        cpu_time_str = f"{r['cpu_time']:.6f}" if isinstance(r['cpu_time'], float) else str(r['cpu_time'])
-        
-        row = f"| {r['name']:<{name_w}} | {r['size_desc']:<{size_w}} | {gpu_time_str:>{gput_w}} | {cpu_time_str:>{cput_w}} | {str(r['speedup']):>{speed_w}} | {str(r['verified']):<{ver_w}} |"
-        print(row)
-    print(sep)
-
-if __name__ == "__main__":
-    main()
+from metalgpu import bench
+from metalgpu.utils import format_table
+
+# Runs every benchmark of `python -m metalgpu bench` on the GPU and with numpy, and prints the speedup of the GPU
+VECTOR_SIZE = 1 << 24
+MATRIX_SIZE = 2048
+WARMUP = 3
+RUNS = 10
+
+gpu = bench.MetalBackend()
+cpu = bench.NumpyBackend()
+
+print(f"Vector size: {VECTOR_SIZE}, matrix size: {MATRIX_SIZE}x{MATRIX_SIZE}")
+rows = []
+for benchmark in bench.benchmarks(VECTOR_SIZE, MATRIX_SIZE):
+    size = MATRIX_SIZE if benchmark.name == "matmul" else VECTOR_SIZE
+    print(f"Running {benchmark.name}...")
+    gpuResult = bench.run_benchmark(gpu, benchmark, size, WARMUP, RUNS)
+    cpuResult = bench.run_benchmark(cpu, benchmark, size, WARMUP, RUNS)
+
+    gpuTime = gpuResult["time"]["median"]
+    cpuTime = cpuResult["time"]["median"]
+    rows.append([benchmark.name, f"{gpuTime * 1e3:.3f}", f"{cpuTime * 1e3:.3f}", f"{cpuTime / gpuTime:.2f}x", "yes" if gpuResult["verified"] else "NO"])
+
+print(format_table(["Benchmark", "GPU (ms)", "CPU (ms)", "Speedup", "Verified"], rows))
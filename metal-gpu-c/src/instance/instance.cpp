@@ -1,8 +1,10 @@
 #include "instance.h"
 
+#include <algorithm>
 #include <cstring>
 #include <iostream>
 #include <cmath> // Added for std::sqrt and std::floor
+#include <mach/mach_time.h>
 
 #include "Foundation/NSString.hpp"
 
@@ -12,22 +14,67 @@ void Instance::init() {
         throw std::runtime_error("No Metal device found");
     }
 
-    commandQueue = device->newCommandQueue();
-    totbuf = -1;
-    buffers = nullptr;
+    queues.push_back(device->newCommandQueue());
+    activeQueues = 1;
+    liveBuffers = 0;
+    liveBytes = 0;
+    wrappedBytes = 0;
+    reservedBytes = 0;
+    peakBytes = 0;
+    evictedBytes = 0;
+    memoryBudget = 0;
     functionPSO = nullptr;
     function = nullptr;
     library = nullptr;
+    librarySourceHash = 0;
     errPtr = nullptr;
+
+    nextCompletion = 0;
+    tracker = std::make_shared<CompletionTracker>();
+    threads = std::make_shared<ThreadRegistry>();
 }
 
 Instance::~Instance() {
-    for (int i = 0; i <= totbuf; i++) {
-        if (buffers[i].buffer != nullptr) {
-            buffers[i].buffer->release();
+    // Batches that never ended are dropped without being submitted
+    {
+        std::lock_guard<std::mutex> guard(threads->lock);
+        for (auto &entry : threads->states) {
+            ThreadState &state = entry.second;
+            if (state.batchDepth > 0) {
+                state.batchEncoder->endEncoding();
+                state.batchCommandBuffer->release();
+                endCommand(state.batchSerial);
+            }
+        }
+    }
+
+    // Pending command buffers still use the buffers, and may call the completion callback
+    {
+        std::unique_lock<std::mutex> guard(tracker->lock);
+        tracker->callback = nullptr;
+        tracker->cond.wait(guard, [this]() { return tracker->inFlight.empty(); });
+    }
+    for (auto &stored : buffers) {
+        if (stored.buffer != nullptr) {
+            stored.buffer->release();
+        }
+    }
+    pool.clear();
+
+    for (auto &kernel : kernels) {
+        if (kernel.pipeline != nullptr) {
+            kernel.function->release();
+            kernel.pipeline->release();
         }
     }
-    free(buffers);
+    for (auto &prepared : dispatches) {
+        if (prepared.pipeline != nullptr) {
+            prepared.pipeline->release();
+        }
+    }
+
+    libraryCache.clear();
+    pipelineCache.clear();
  
     if (functionPSO != nullptr) {
         functionPSO->release();
@@ -38,6 +85,9 @@ Instance::~Instance() {
     if (library != nullptr) {
         library->release();
     }
+    for (auto queue : queues) {
+        queue->release();
+    }
 }
 
 void Instance::createLibrary(const char *filename) {
@@ -46,57 +96,304 @@ void Instance::createLibrary(const char *filename) {
     std::stringstream reader;
     reader << file.rdbuf();
     std::string raw_string = reader.str();
-    NS::String *source_code = NS::String::string(raw_string.c_str(), NS::StringEncoding::UTF8StringEncoding);
 
+    createLibraryFromString(raw_string.c_str(), nullptr);
+}
+
+LibraryStorer *Instance::getLibrary(const char *fileString, const char *binaryPath) {
+    std::string source(fileString);
+
+    LibraryStorer *cached = libraryCache.get(source);
+    if (cached != nullptr) {
+        return cached;
+    }
+
+    MTL::Library *newLibrary = nullptr;
     errPtr = nullptr;
-    MTL::CompileOptions *options = nullptr;
 
-    if (library != nullptr) {
-        library->release();
+    // Precompiled library from the on-disk shader cache, the source is only compiled if it can't be loaded
+    if (binaryPath != nullptr) {
+        NS::URL *url = NS::URL::fileURLWithPath(NS::String::string(binaryPath, NS::StringEncoding::UTF8StringEncoding));
+        newLibrary = device->newLibrary(url, &errPtr);
+        if (newLibrary == nullptr) {
+            std::cout << "[MetalGPU] Couldn't load cached library, compiling from source" << std::endl;
+            errPtr = nullptr;
+        }
     }
-    library = device->newLibrary(source_code, options, &errPtr);
 
-    if (library == nullptr) { 
+    if (newLibrary == nullptr) {
+        NS::String *source_code = NS::String::string(fileString, NS::StringEncoding::UTF8StringEncoding);
+        MTL::CompileOptions *options = nullptr;
+        newLibrary = device->newLibrary(source_code, options, &errPtr);
+    }
+    if (newLibrary == nullptr) { 
         std::cout << errPtr->localizedDescription()->utf8String() << std::endl;
+        return nullptr;
     }
+
+    LibraryStorer newLibStore;
+    newLibStore.library = newLibrary;
+    newLibStore.sourceHash = std::hash<std::string>{}(source);
+    return libraryCache.put(source, newLibStore);
 }
 
-void Instance::createLibraryFromString(const char *fileString) {
-    NS::String *source_code = NS::String::string(fileString, NS::StringEncoding::UTF8StringEncoding);
-    errPtr = nullptr;
-    MTL::CompileOptions *options = nullptr;
-    if (library != nullptr) {
-        library->release();
+PipelineStorer *Instance::getPipeline(LibraryStorer *libStore, const char *funcname) {
+    std::string key = std::to_string(libStore->sourceHash) + ":" + funcname;
+
+    PipelineStorer *cached = pipelineCache.get(key);
+    if (cached != nullptr && cached->library == libStore->library) {
+        return cached;
+    }
+
+    auto funcstring = NS::String::string(funcname, NS::ASCIIStringEncoding);
+
+    MTL::Function *newFunction = libStore->library->newFunction(funcstring);
+    if (newFunction == nullptr) { 
+        printf("[MetalGPU] Couldn't create function");
+        return nullptr;
     }
-    library = device->newLibrary(source_code, options, &errPtr);
-    if (library == nullptr) { 
+
+    errPtr = nullptr;
+    MTL::ComputePipelineState *newPSO = device->newComputePipelineState(newFunction, &errPtr);
+    if (newPSO == nullptr) { 
         std::cout << errPtr->localizedDescription()->utf8String() << std::endl;
+        newFunction->release();
+        return nullptr;
+    }
+
+    PipelineStorer newPipelineStore;
+    newPipelineStore.library = libStore->library;
+    newPipelineStore.function = newFunction;
+    newPipelineStore.pipeline = newPSO;
+    return pipelineCache.put(key, newPipelineStore);
+}
+
+void Instance::createLibraryFromString(const char *fileString, const char *binaryPath) {
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
+    LibraryStorer *cached = getLibrary(fileString, binaryPath);
+    if (cached == nullptr) {
         return;
     }
+
+    // The current library is retained separately, so that cache eviction never frees it while in use
+    cached->library->retain();
+    if (library != nullptr) {
+        library->release();
+    }
+    library = cached->library;
+    librarySourceHash = cached->sourceHash;
 }   
 
 void Instance::setFunction(const char *funcname) {
-    auto funcstring = NS::String::string(funcname, NS::ASCIIStringEncoding);
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
+    if (library == nullptr) {
+        printf("[MetalGPU] No library loaded");
+        return;
+    }
+
+    LibraryStorer currentLibrary;
+    currentLibrary.library = library;
+    currentLibrary.sourceHash = librarySourceHash;
 
+    PipelineStorer *cached = getPipeline(&currentLibrary, funcname);
+    if (cached == nullptr) {
+        return;
+    }
+
+    cached->function->retain();
+    cached->pipeline->retain();
     if (function != nullptr) {
         function->release();
         functionPSO->release();
     }
+    function = cached->function;
+    functionPSO = cached->pipeline;
+}
 
-    function = library->newFunction(funcstring);
-    if (function == nullptr) { 
-        printf("[MetalGPU] Couldn't create function");
+int Instance::createKernel(const char *fileString, const char *binaryPath, const char *funcname) {
+    KernelStorer newKernelStore;
+    {
+        std::lock_guard<std::recursive_mutex> guard(cacheLock);
+        LibraryStorer *libStore = getLibrary(fileString, binaryPath);
+        if (libStore == nullptr) {
+            return -1;
+        }
+        PipelineStorer *pipeStore = getPipeline(libStore, funcname);
+        if (pipeStore == nullptr) {
+            return -1;
+        }
+
+        newKernelStore.function = pipeStore->function;
+        newKernelStore.pipeline = pipeStore->pipeline;
+        newKernelStore.function->retain();
+        newKernelStore.pipeline->retain();
+    }
+
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    if (!freeKernels.empty()) {
+        int kernelNum = freeKernels.back();
+        freeKernels.pop_back();
+        kernels[kernelNum] = newKernelStore;
+        return kernelNum;
+    }
+    kernels.push_back(newKernelStore);
+    return kernels.size() - 1;
+}
+
+void Instance::releaseKernel(int kernelNum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    if (kernels[kernelNum].pipeline == nullptr) {
         return;
     }
+    kernels[kernelNum].function->release();
+    kernels[kernelNum].pipeline->release();
+    kernels[kernelNum].function = nullptr;
+    kernels[kernelNum].pipeline = nullptr;
+    freeKernels.push_back(kernelNum);
+}
 
-    functionPSO = device->newComputePipelineState(function, &errPtr);
-    if (function == nullptr) { 
-        std::cout << errPtr->localizedDescription()->utf8String() << std::endl;
+int Instance::createDispatch(int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    DispatchStorer newDispatch;
+    newDispatch.pipeline = kernels[kernelNum].pipeline;
+    newDispatch.pipeline->retain();
+    for (int i = 0; i < 3; i++) {
+        newDispatch.metalSize[i] = MetalSize[i];
+        newDispatch.threadsPerGroup[i] = threadsPerGroup != nullptr ? threadsPerGroup[i] : 0;
+    }
+    newDispatch.buffers.assign(requestedBuffers, requestedBuffers + numRequestedBuffers);
+    newDispatch.inlineSizes.assign(numRequestedBuffers, 0);
+    if (inlineSizes != nullptr) {
+        int inlineTotal = 0;
+        for (int i = 0; i < numRequestedBuffers; i++) {
+            newDispatch.inlineSizes[i] = inlineSizes[i];
+            inlineTotal += inlineSizes[i];
+        }
+        newDispatch.inlineBytes.assign(inlineBytes, inlineBytes + inlineTotal);
+    }
+
+    if (!freeDispatches.empty()) {
+        int dispatchNum = freeDispatches.back();
+        freeDispatches.pop_back();
+        dispatches[dispatchNum] = newDispatch;
+        return dispatchNum;
+    }
+    dispatches.push_back(newDispatch);
+    return dispatches.size() - 1;
+}
+
+int Instance::runDispatch(int dispatchNum, bool waitForCompletion) {
+    // Copied, as another thread may grow the table while this one waits for the GPU, and the pipeline retained,
+    // as another thread may release the dispatch meanwhile
+    DispatchStorer prepared;
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        prepared = dispatches[dispatchNum];
+        prepared.pipeline->retain();
+    }
+    int completionNum = dispatch(prepared.pipeline, prepared.metalSize, prepared.buffers.data(), prepared.buffers.size(), prepared.inlineBytes.data(), prepared.inlineSizes.data(), prepared.threadsPerGroup, waitForCompletion);
+    prepared.pipeline->release();
+    return completionNum;
+}
+
+void Instance::setDispatchBuffer(int dispatchNum, int index, int bufferNum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    setDispatchBytes(dispatchNum, index, nullptr, 0);
+    dispatches[dispatchNum].buffers[index] = bufferNum;
+}
+
+// Replaces the argument at index by size inline bytes, a size of 0 turning the slot back into an empty buffer slot
+void Instance::setDispatchBytes(int dispatchNum, int index, const char *bytes, int size) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    DispatchStorer &prepared = dispatches[dispatchNum];
+    int offset = 0;
+    for (int i = 0; i < index; i++) {
+        offset += prepared.inlineSizes[i];
+    }
+    auto position = prepared.inlineBytes.begin() + offset;
+    position = prepared.inlineBytes.erase(position, position + prepared.inlineSizes[index]);
+    if (size > 0) {
+        prepared.inlineBytes.insert(position, bytes, bytes + size);
+    }
+    prepared.inlineSizes[index] = size;
+    prepared.buffers[index] = -1;
+}
+
+void Instance::releaseDispatch(int dispatchNum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    if (dispatches[dispatchNum].pipeline == nullptr) {
         return;
     }
+    dispatches[dispatchNum].pipeline->release();
+    dispatches[dispatchNum].pipeline = nullptr;
+    dispatches[dispatchNum].buffers.clear();
+    freeDispatches.push_back(dispatchNum);
+}
+
+int Instance::kernelMaxThreadsPerGroup(int kernelNum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    return kernels[kernelNum].pipeline->maxTotalThreadsPerThreadgroup();
+}
+
+int Instance::kernelThreadExecutionWidth(int kernelNum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    return kernels[kernelNum].pipeline->threadExecutionWidth();
+}
+
+// GPU execution time in seconds of the last command buffer the calling thread waited on
+double Instance::lastGPUTime() {
+    ThreadState &state = currentThread();
+    return state.gpuEnd - state.gpuStart;
+}
+
+// Encoding time in seconds of the calling thread's last dispatch, then GPU start and end of the last command buffer it waited on
+void Instance::getDispatchTimes(double *times) {
+    ThreadState &state = currentThread();
+    times[0] = state.encodeTime;
+    times[1] = state.gpuStart;
+    times[2] = state.gpuEnd;
+}
+
+// GPU start and end of a command buffer submitted without waiting, both 0 until it completes
+void Instance::getCompletionTimes(int completionNum, double *times) {
+    times[0] = 0;
+    times[1] = 0;
+    auto completion = getCompletion(completionNum);
+    if (completion == nullptr) {
+        return;
+    }
+    std::lock_guard<std::mutex> guard(completion->lock);
+    times[0] = completion->gpuStart;
+    times[1] = completion->gpuEnd;
+}
+
+// Current time in seconds, on the clock used by command buffer GPU timestamps
+double Instance::hostTime() {
+    static mach_timebase_info_data_t timebase = {0, 0};
+    if (timebase.denom == 0) {
+        mach_timebase_info(&timebase);
+    }
+    return (double)mach_absolute_time() * timebase.numer / timebase.denom / 1e9;
+}
+
+void Instance::setCacheCapacity(int capacity) {
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
+    libraryCache.setCapacity(capacity);
+    pipelineCache.setCapacity(capacity);
+}
+
+void Instance::getCacheStats(long *stats) {
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
+    stats[0] = libraryCache.hits;
+    stats[1] = libraryCache.misses;
+    stats[2] = pipelineCache.hits;
+    stats[3] = pipelineCache.misses;
+    stats[4] = libraryCache.size();
+    stats[5] = pipelineCache.size();
 }
 
 int Instance::maxThreadsPerGroup() {
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
     if (function == nullptr) {
         return -1;
     }
@@ -104,44 +401,482 @@ int Instance::maxThreadsPerGroup() {
 }
 
 int Instance::threadExecutionWidth() {
+    std::lock_guard<std::recursive_mutex> guard(cacheLock);
     if (function == nullptr) {
         return -1;
     }
     return functionPSO->threadExecutionWidth();
 }
 
-int Instance::createBuffer(int bufsize) {
-    MTL::Buffer *buffer = device->newBuffer(bufsize, MTL::ResourceStorageModeShared);
+int Instance::createBuffer(long bufsize, bool privateStorage) {
+    size_t classSize = BufferPool::sizeClass(bufsize);
+    MTL::Buffer *buffer = nullptr;
+
+    // Poolable buffers are allocated to their size class, so that they can be reused by any request of that class
+    size_t allocSize = 0;
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        bool pooled = pool.accepts(classSize);
+        if (pooled) {
+            buffer = pool.acquire(classSize, privateStorage, minInFlightSerial());
+        }
+        // Reserved until the buffer is stored, so that concurrent allocations can't overshoot the budget together
+        if (buffer == nullptr) {
+            allocSize = pooled ? classSize : bufsize;
+            if (!reserveMemory(allocSize)) {
+                return -1;
+            }
+        }
+    }
+    if (buffer == nullptr) {
+        buffer = allocateBuffer(allocSize, privateStorage);
+    } else {
+        // Recycled buffers still hold their previous contents, new ones are zero filled
+        clearBuffer(buffer, privateStorage);
+    }
+    if (buffer == nullptr) {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        reservedBytes -= allocSize;
+        return -1;
+    }
+
+    return storeBuffer(buffer, bufsize, false, privateStorage, allocSize);
+}
 
-    totbuf += 1;
+// Shared buffers are cleared right away. Private ones by a blit on the thread's queue, or in its batch, ahead of any later
+// command using them, which nothing waits for
+void Instance::clearBuffer(MTL::Buffer *buffer, bool privateStorage) {
+    if (!privateStorage) {
+        memset(buffer->contents(), 0, buffer->length());
+        return;
+    }
 
-    BufferStorer newBufStore;
+    ThreadState &state = currentThread();
+    if (state.batchEncoder != nullptr) {
+        state.batchEncoder->endEncoding();
+        MTL::BlitCommandEncoder *blit = state.batchCommandBuffer->blitCommandEncoder();
+        blit->fillBuffer(buffer, NS::Range::Make(0, buffer->length()), 0);
+        blit->endEncoding();
+        state.batchEncoder = state.batchCommandBuffer->computeCommandEncoder();
+        return;
+    }
 
+    uint64_t serial = beginCommand();
+    MTL::CommandBuffer *commandBuffer = state.queue->commandBuffer();
+    MTL::BlitCommandEncoder *blit = commandBuffer->blitCommandEncoder();
+    blit->fillBuffer(buffer, NS::Range::Make(0, buffer->length()), 0);
+    blit->endEncoding();
+    // Only tracked, so that released buffers aren't recycled before the fill is done
+    auto sharedTracker = tracker;
+    commandBuffer->addCompletedHandler([sharedTracker, serial](MTL::CommandBuffer *) {
+        {
+            std::lock_guard<std::mutex> guard(sharedTracker->lock);
+            sharedTracker->inFlight.erase(serial);
+        }
+        sharedTracker->cond.notify_all();
+    });
+    commandBuffer->commit();
+}
+
+// Called with tableLock held. Over the budget, pooled buffers are freed, least recently released first, to make room
+bool Instance::reserveMemory(size_t bytes) {
+    if (memoryBudget > 0) {
+        size_t used = liveBytes + reservedBytes + pool.pooledBytes;
+        if (used + bytes > memoryBudget) {
+            evictedBytes += pool.evict(used + bytes - memoryBudget);
+        }
+        if (liveBytes + reservedBytes + pool.pooledBytes + bytes > memoryBudget) {
+            return false;
+        }
+    }
+    reservedBytes += bytes;
+    return true;
+}
+
+// When Metal is out of memory, the whole pool is given back to the system before trying again
+MTL::Buffer *Instance::allocateBuffer(size_t size, bool privateStorage) {
+    MTL::ResourceOptions options = privateStorage ? MTL::ResourceStorageModePrivate : MTL::ResourceStorageModeShared;
+    MTL::Buffer *buffer = device->newBuffer(size, options);
+    if (buffer == nullptr) {
+        {
+            std::lock_guard<std::recursive_mutex> guard(tableLock);
+            evictedBytes += pool.evict(pool.pooledBytes);
+        }
+        buffer = device->newBuffer(size, options);
+    }
+    return buffer;
+}
+
+// Wraps existing host memory, which must be page aligned and span a whole number of pages
+int Instance::createBufferNoCopy(void *pointer, long bufsize) {
+    MTL::Buffer *buffer = device->newBuffer(pointer, bufsize, MTL::ResourceStorageModeShared, nullptr);
+    if (buffer == nullptr) {
+        return -1;
+    }
+
+    return storeBuffer(buffer, bufsize, true, false, 0);
+}
+
+// reserved bytes were set aside by reserveMemory, and are now counted as live
+int Instance::storeBuffer(MTL::Buffer *buffer, long bufsize, bool noCopy, bool privateStorage, size_t reserved) {
+    BufferStorer newBufStore;
     newBufStore.buffer = buffer;
-    newBufStore.bufferNum = totbuf;
+    newBufStore.size = bufsize;
+    newBufStore.noCopy = noCopy;
+    newBufStore.privateStorage = privateStorage;
+
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    if (!freeBuffers.empty()) {
+        newBufStore.bufferNum = freeBuffers.back();
+        freeBuffers.pop_back();
+        buffers[newBufStore.bufferNum] = newBufStore;
+    } else {
+        newBufStore.bufferNum = buffers.size();
+        buffers.push_back(newBufStore);
+    }
+    liveBuffers += 1;
+    reservedBytes -= reserved;
+    if (noCopy) {
+        wrappedBytes += buffer->length();
+    } else {
+        liveBytes += buffer->length();
+    }
+    peakBytes = std::max(peakBytes, liveBytes + pool.pooledBytes);
+
+    return newBufStore.bufferNum;
+}
+
+void Instance::setPoolLimits(long maxBytes, long maxBufferSize) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    pool.setLimits(maxBytes, maxBufferSize);
+}
+
+void Instance::getPoolStats(long *stats) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    stats[0] = pool.hits;
+    stats[1] = pool.misses;
+    stats[2] = pool.pooledBuffers;
+    stats[3] = pool.pooledBytes;
+    stats[4] = liveBuffers;
+    stats[5] = buffers.size();
+    stats[6] = freeBuffers.size();
+}
 
-    buffers = (BufferStorer*)realloc(buffers, sizeof(BufferStorer) * totbuf + 1);
-    buffers[totbuf] = newBufStore;
+void Instance::setMemoryBudget(long bytes) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    memoryBudget = bytes;
+    // Live buffers can't be freed, only the pool is brought back under a lower budget
+    size_t used = liveBytes + reservedBytes + pool.pooledBytes;
+    if (memoryBudget > 0 && used > memoryBudget) {
+        evictedBytes += pool.evict(used - memoryBudget);
+    }
+}
 
-    return totbuf;
+void Instance::getMemoryStats(long *stats) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    stats[0] = liveBuffers;
+    stats[1] = liveBytes;
+    stats[2] = wrappedBytes;
+    stats[3] = pool.pooledBytes;
+    stats[4] = liveBytes + pool.pooledBytes;
+    stats[5] = peakBytes;
+    stats[6] = memoryBudget;
+    stats[7] = evictedBytes;
+    stats[8] = device->currentAllocatedSize();
+    stats[9] = device->recommendedMaxWorkingSetSize();
 }
  
-void Instance::runFunction(int *MetalSize, int *requestedBuffers, int numRequestedBuffers, bool waitForCompletion) {
-    MTL::CommandBuffer *commandBuffer = commandQueue->commandBuffer();
-    MTL::ComputeCommandEncoder *encoder = commandBuffer->computeCommandEncoder();
-    encoder->setComputePipelineState(functionPSO);
-    for(int i = 0; i < numRequestedBuffers; i++) {
-        if(requestedBuffers[i] == -1 ) {
-            continue; 
+int Instance::runFunction(int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion) {
+    // Retained for the dispatch, as another thread may set a new function meanwhile
+    MTL::ComputePipelineState *pipeline;
+    {
+        std::lock_guard<std::recursive_mutex> guard(cacheLock);
+        pipeline = functionPSO;
+        pipeline->retain();
+    }
+    int completionNum = dispatch(pipeline, MetalSize, requestedBuffers, numRequestedBuffers, inlineBytes, inlineSizes, threadsPerGroup, waitForCompletion);
+    pipeline->release();
+    return completionNum;
+}
+
+int Instance::runKernel(int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion) {
+    // Retained for the dispatch, as another thread may release the kernel meanwhile
+    MTL::ComputePipelineState *pipeline;
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        pipeline = kernels[kernelNum].pipeline;
+        pipeline->retain();
+    }
+    int completionNum = dispatch(pipeline, MetalSize, requestedBuffers, numRequestedBuffers, inlineBytes, inlineSizes, threadsPerGroup, waitForCompletion);
+    pipeline->release();
+    return completionNum;
+}
+
+// Batches belong to the calling thread, dispatches from other threads go to their own command buffers meanwhile
+void Instance::beginBatch() {
+    ThreadState &state = currentThread();
+    state.batchDepth += 1;
+    if (state.batchDepth > 1) {
+        return;
+    }
+    // Kept across calls until the batch ends
+    state.batchSerial = beginCommand();
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        openBatches.insert(state.batchSerial);
+    }
+    state.batchCommandBuffer = state.queue->commandBuffer();
+    state.batchCommandBuffer->retain();
+    state.batchEncoder = state.batchCommandBuffer->computeCommandEncoder();
+}
+
+int Instance::endBatch(bool waitForCompletion) {
+    ThreadState &state = currentThread();
+    if (state.batchDepth == 0) {
+        return -1;
+    }
+    state.batchDepth -= 1;
+    if (state.batchDepth > 0) {
+        return -1;
+    }
+
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        openBatches.erase(state.batchSerial);
+    }
+    MTL::CommandBuffer *commandBuffer = state.batchCommandBuffer;
+    state.batchEncoder->endEncoding();
+    state.batchEncoder = nullptr;
+    state.batchCommandBuffer = nullptr;
+
+    int completionNum = submit(commandBuffer, state.batchSerial, waitForCompletion);
+    commandBuffer->release();
+    return completionNum;
+}
+
+// Removes the exiting thread's entry from every instance it used, so that short lived threads don't accumulate
+struct ThreadExit {
+    std::vector<std::weak_ptr<ThreadRegistry>> registries;
+
+    ~ThreadExit() {
+        std::thread::id id = std::this_thread::get_id();
+        for (auto &weak : registries) {
+            std::shared_ptr<ThreadRegistry> registry = weak.lock();
+            if (registry == nullptr) {
+                continue;
+            }
+            std::lock_guard<std::mutex> guard(registry->lock);
+            auto found = registry->states.find(id);
+            // A batch left open is dropped by the instance destructor, which needs the entry
+            if (found != registry->states.end() && found->second.batchDepth == 0) {
+                registry->states.erase(found);
+            }
+        }
+    }
+};
+
+static thread_local ThreadExit threadExit;
+
+ThreadState &Instance::currentThread() {
+    std::lock_guard<std::mutex> guard(threads->lock);
+    auto found = threads->states.find(std::this_thread::get_id());
+    if (found != threads->states.end()) {
+        return found->second;
+    }
+    // Elements of an unordered_map never move, the reference stays valid as other threads are added and removed
+    ThreadState &state = threads->states[std::this_thread::get_id()];
+    state.queue = queues[threads->assigned % activeQueues];
+    threads->assigned += 1;
+
+    // Registries of deleted instances are dropped, so a long lived thread doesn't accumulate them either
+    auto &registries = threadExit.registries;
+    registries.erase(std::remove_if(registries.begin(), registries.end(), [](const std::weak_ptr<ThreadRegistry> &weak) { return weak.expired(); }), registries.end());
+    registries.push_back(threads);
+    return state;
+}
+
+void Instance::setCommandQueues(int count) {
+    if (count < 1) {
+        return;
+    }
+    std::lock_guard<std::mutex> guard(threads->lock);
+    // Queues are never released before the instance, command buffers of a thread's previous queue may still be pending
+    while ((int)queues.size() < count) {
+        queues.push_back(device->newCommandQueue());
+    }
+    // Only threads dispatching for the first time after this get the new count, the queue of a thread being read
+    // without the lock by that thread
+    activeQueues = count;
+}
+
+uint64_t Instance::beginCommand() {
+    std::lock_guard<std::mutex> guard(tracker->lock);
+    tracker->lastSerial += 1;
+    tracker->inFlight.insert(tracker->lastSerial);
+    return tracker->lastSerial;
+}
+
+void Instance::endCommand(uint64_t serial) {
+    {
+        std::lock_guard<std::mutex> guard(tracker->lock);
+        tracker->inFlight.erase(serial);
+    }
+    tracker->cond.notify_all();
+}
+
+// Every command of a lower serial has completed
+long Instance::completedBefore() {
+    uint64_t oldest = minInFlightSerial();
+    if (oldest != UINT64_MAX) {
+        return oldest;
+    }
+    std::lock_guard<std::mutex> guard(tracker->lock);
+    return tracker->lastSerial + 1;
+}
+
+uint64_t Instance::minInFlightSerial() {
+    std::lock_guard<std::mutex> guard(tracker->lock);
+    if (tracker->inFlight.empty()) {
+        return UINT64_MAX;
+    }
+    return *tracker->inFlight.begin();
+}
+
+int Instance::submit(MTL::CommandBuffer *commandBuffer, uint64_t serial, bool waitForCompletion) {
+    if (waitForCompletion) {
+        commandBuffer->commit();
+        commandBuffer->waitUntilCompleted();
+        ThreadState &state = currentThread();
+        state.gpuStart = commandBuffer->GPUStartTime();
+        state.gpuEnd = commandBuffer->GPUEndTime();
+        endCommand(serial);
+        return -1;
+    }
+
+    auto completion = std::make_shared<CompletionStorer>();
+    int completionNum;
+    {
+        std::lock_guard<std::mutex> guard(completionsLock);
+        completionNum = nextCompletion++;
+        completions[completionNum] = completion;
+    }
+
+    // Runs on a Metal thread once the GPU is done with the command buffer. It only uses the shared tracker,
+    // as the instance may be in its destructor, waiting for pending command buffers.
+    auto sharedTracker = tracker;
+    commandBuffer->addCompletedHandler([sharedTracker, completion, completionNum, serial](MTL::CommandBuffer *finished) {
+        int status = finished->status() == MTL::CommandBufferStatusError ? COMPLETION_ERROR : COMPLETION_DONE;
+        // Timestamps are stored first, so that they are readable from the completion callback
+        {
+            std::lock_guard<std::mutex> guard(completion->lock);
+            completion->gpuStart = finished->GPUStartTime();
+            completion->gpuEnd = finished->GPUEndTime();
+        }
+
+        CompletionCallback callback;
+        {
+            std::lock_guard<std::mutex> guard(sharedTracker->lock);
+            callback = sharedTracker->callback;
+        }
+        if (callback != nullptr) {
+            callback(completionNum, status);
+        }
+
+        {
+            std::lock_guard<std::mutex> guard(completion->lock);
+            completion->status = status;
+        }
+        completion->cond.notify_all();
+
+        {
+            std::lock_guard<std::mutex> guard(sharedTracker->lock);
+            sharedTracker->inFlight.erase(serial);
+        }
+        sharedTracker->cond.notify_all();
+    });
+    commandBuffer->commit();
+    return completionNum;
+}
+
+std::shared_ptr<CompletionStorer> Instance::getCompletion(int completionNum) {
+    std::lock_guard<std::mutex> guard(completionsLock);
+    auto found = completions.find(completionNum);
+    if (found == completions.end()) {
+        return nullptr;
+    }
+    return found->second;
+}
+
+int Instance::completionStatus(int completionNum) {
+    auto completion = getCompletion(completionNum);
+    if (completion == nullptr) {
+        return COMPLETION_DONE;
+    }
+    std::lock_guard<std::mutex> guard(completion->lock);
+    return completion->status;
+}
+
+int Instance::waitCompletion(int completionNum, double timeout) {
+    auto completion = getCompletion(completionNum);
+    if (completion == nullptr) {
+        return COMPLETION_DONE;
+    }
+    std::unique_lock<std::mutex> guard(completion->lock);
+    auto finished = [&completion]() { return completion->status != COMPLETION_PENDING; };
+    if (timeout < 0) {
+        completion->cond.wait(guard, finished);
+    } else {
+        completion->cond.wait_for(guard, std::chrono::duration<double>(timeout), finished);
+    }
+    return completion->status;
+}
+
+void Instance::releaseCompletion(int completionNum) {
+    std::lock_guard<std::mutex> guard(completionsLock);
+    completions.erase(completionNum);
+}
+
+void Instance::setCompletionCallback(CompletionCallback callback) {
+    std::lock_guard<std::mutex> guard(tracker->lock);
+    tracker->callback = callback;
+}
+
+int Instance::dispatch(MTL::ComputePipelineState *pipeline, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion) {
+    // While batching, every dispatch goes into the same encoder. Its default serial dispatch type
+    // runs dispatches one after the other, so a kernel always sees the writes of the previous ones.
+    auto encodeStart = std::chrono::steady_clock::now();
+    ThreadState &state = currentThread();
+    bool batching = state.batchEncoder != nullptr;
+    uint64_t serial = batching ? state.batchSerial : beginCommand();
+    MTL::CommandBuffer *commandBuffer = batching ? state.batchCommandBuffer : state.queue->commandBuffer();
+    MTL::ComputeCommandEncoder *encoder = batching ? state.batchEncoder : commandBuffer->computeCommandEncoder();
+    encoder->setComputePipelineState(pipeline);
+    int inlineOffset = 0;
+    {
+        // Another thread may grow the buffer table while arguments are bound
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        for(int i = 0; i < numRequestedBuffers; i++) {
+            // Inline arguments are copied by the encoder, no buffer is created for them
+            if (inlineSizes != nullptr && inlineSizes[i] > 0) {
+                encoder->setBytes(inlineBytes + inlineOffset, inlineSizes[i], i);
+                inlineOffset += inlineSizes[i];
+                continue;
+            }
+            if(requestedBuffers[i] == -1 ) {
+                continue; 
+            }
+            encoder->setBuffer(buffers[requestedBuffers[i]].buffer, 0, i);
+            if (batching) {
+                buffers[requestedBuffers[i]].batchSerial = serial;
+            }
         }
-        encoder->setBuffer(buffers[requestedBuffers[i]].buffer, 0, i);
     }
 
     MTL::Size gridSize = MTL::Size(MetalSize[0], MetalSize[1], MetalSize[2]);
 
     // Corrected calculation for threadsPerGroup
-    NS::UInteger psoTEW = functionPSO->threadExecutionWidth();
-    NS::UInteger psoMTTPTG = functionPSO->maxTotalThreadsPerThreadgroup();
+    NS::UInteger psoTEW = pipeline->threadExecutionWidth();
+    NS::UInteger psoMTTPTG = pipeline->maxTotalThreadsPerThreadgroup();
 
     // Ensure PSO values are somewhat sane (should be >0 from a valid PSO)
     if (psoTEW == 0) psoTEW = 1; 
@@ -149,7 +884,11 @@ void Instance::runFunction(int *MetalSize, int *requestedBuffers, int numRequest
 
     NS::UInteger tgpWidth, tgpHeight, tgpDepth;
 
-    if (gridSize.height == 1 && gridSize.depth == 1) { // 1D dispatch
+    if (threadsPerGroup != nullptr && threadsPerGroup[0] > 0) { // Explicit threadgroup size, checked by the caller
+        tgpWidth = threadsPerGroup[0];
+        tgpHeight = threadsPerGroup[1];
+        tgpDepth = threadsPerGroup[2];
+    } else if (gridSize.height == 1 && gridSize.depth == 1) { // 1D dispatch
         tgpWidth = psoMTTPTG;
         tgpHeight = 1;
         tgpDepth = 1;
@@ -179,26 +918,139 @@ void Instance::runFunction(int *MetalSize, int *requestedBuffers, int numRequest
     if (tgpHeight == 0) tgpHeight = 1;
     if (tgpDepth == 0) tgpDepth = 1;
     
-    MTL::Size threadsPerGroup = MTL::Size(tgpWidth, tgpHeight, tgpDepth);
+    MTL::Size groupSize = MTL::Size(tgpWidth, tgpHeight, tgpDepth);
 
-    encoder->dispatchThreads(gridSize, threadsPerGroup);
+    encoder->dispatchThreads(gridSize, groupSize);
+
+    if (batching) {
+        state.encodeTime = std::chrono::duration<double>(std::chrono::steady_clock::now() - encodeStart).count();
+        return -1;
+    }
 
     encoder->endEncoding();
-    commandBuffer->commit();
+    state.encodeTime = std::chrono::duration<double>(std::chrono::steady_clock::now() - encodeStart).count();
+    return submit(commandBuffer, serial, waitForCompletion);
+}
 
-    if(waitForCompletion) {
-        commandBuffer->waitUntilCompleted();
+// Returns the serial of the last command that can still use the buffer, the host memory a wrapped buffer was made from
+// must outlive it. -1 if there is no such buffer
+long Instance::releaseBuffer(int bufnum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    if (bufnum < 0 || bufnum >= (int)buffers.size() || buffers[bufnum].buffer == nullptr) {
+        return -1;
     }
 
-    return;
-
-}
+    uint64_t releaseSerial;
+    {
+        std::lock_guard<std::mutex> guard(tracker->lock);
+        releaseSerial = tracker->lastSerial;
+    }
+    // Memory that isn't owned by Metal can't be handed to someone else
+    if (buffers[bufnum].noCopy) {
+        wrappedBytes -= buffers[bufnum].buffer->length();
+        buffers[bufnum].buffer->release();
+    } else {
+        liveBytes -= buffers[bufnum].buffer->length();
+        pool.release(buffers[bufnum].buffer, buffers[bufnum].privateStorage, releaseSerial);
+    }
 
-void Instance::releaseBuffer(int bufnum) {
-    buffers[bufnum].buffer->release();
     buffers[bufnum].buffer = nullptr;
+    freeBuffers.push_back(bufnum);
+    liveBuffers -= 1;
+    return releaseSerial;
 }
 
 void *Instance::getBufferPointer(int bufnum) {
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
     return buffers[bufnum].buffer->contents();
 }
+
+// Copies size bytes between two buffers with a blit, either of them may be private
+int Instance::copyBuffer(int sourceNum, long sourceOffset, int destinationNum, long destinationOffset, long size, bool waitForCompletion) {
+    MTL::Buffer *source;
+    MTL::Buffer *destination;
+    ThreadState &state = currentThread();
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        source = buffers[sourceNum].buffer;
+        destination = buffers[destinationNum].buffer;
+        if (state.batchEncoder != nullptr) {
+            buffers[sourceNum].batchSerial = state.batchSerial;
+            buffers[destinationNum].batchSerial = state.batchSerial;
+        }
+    }
+
+    if (state.batchEncoder != nullptr) {
+        // Encoders of a command buffer run in order, the batch goes on in a new compute encoder after the copy
+        state.batchEncoder->endEncoding();
+        MTL::BlitCommandEncoder *blit = state.batchCommandBuffer->blitCommandEncoder();
+        blit->copyFromBuffer(source, sourceOffset, destination, destinationOffset, size);
+        blit->endEncoding();
+        state.batchEncoder = state.batchCommandBuffer->computeCommandEncoder();
+        return -1;
+    }
+
+    uint64_t serial = beginCommand();
+    MTL::CommandBuffer *commandBuffer = state.queue->commandBuffer();
+    MTL::BlitCommandEncoder *blit = commandBuffer->blitCommandEncoder();
+    blit->copyFromBuffer(source, sourceOffset, destination, destinationOffset, size);
+    blit->endEncoding();
+    return submit(commandBuffer, serial, waitForCompletion);
+}
+
+// Moves a buffer to the other storage mode, keeping its number and its contents. Returns once the copy is done, -1 on failure,
+// -2 if a batch still being recorded uses the buffer
+int Instance::setBufferStorage(int bufnum, bool privateStorage) {
+    MTL::Buffer *previous;
+    size_t length;
+    {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        BufferStorer &stored = buffers[bufnum];
+        if (stored.noCopy) {
+            return -1;
+        }
+        if (stored.privateStorage == privateStorage) {
+            return 0;
+        }
+        // Commands of an open batch would keep using the previous buffer, their writes being lost
+        if (openBatches.count(stored.batchSerial) > 0) {
+            return -2;
+        }
+        previous = stored.buffer;
+        length = previous->length();
+        if (!reserveMemory(length)) {
+            return -1;
+        }
+    }
+
+    MTL::Buffer *buffer = allocateBuffer(length, privateStorage);
+    if (buffer == nullptr) {
+        std::lock_guard<std::recursive_mutex> guard(tableLock);
+        reservedBytes -= length;
+        return -1;
+    }
+
+    // Runs after the work already submitted to the thread's queue, outside of any batch it may be recording
+    ThreadState &state = currentThread();
+    uint64_t serial = beginCommand();
+    MTL::CommandBuffer *commandBuffer = state.queue->commandBuffer();
+    MTL::BlitCommandEncoder *blit = commandBuffer->blitCommandEncoder();
+    blit->copyFromBuffer(previous, 0, buffer, 0, length);
+    blit->endEncoding();
+    submit(commandBuffer, serial, true);
+
+    std::lock_guard<std::recursive_mutex> guard(tableLock);
+    uint64_t releaseSerial;
+    {
+        std::lock_guard<std::mutex> trackerGuard(tracker->lock);
+        releaseSerial = tracker->lastSerial;
+    }
+    reservedBytes -= length;
+    liveBytes += buffer->length();
+    liveBytes -= previous->length();
+    pool.release(previous, !privateStorage, releaseSerial);
+    buffers[bufnum].buffer = buffer;
+    buffers[bufnum].privateStorage = privateStorage;
+    peakBytes = std::max(peakBytes, liveBytes + pool.pooledBytes);
+    return 0;
+}
@@ -1,38 +1,221 @@
 #include "../config.h"
 #include "../api/utils.h"
+#include "lrucache.h"
+#include "pool.h"
+
+#include <chrono>
+#include <condition_variable>
+#include <memory>
+#include <mutex>
+#include <set>
+#include <thread>
+#include <vector>
+
+#define DEFAULT_CACHE_CAPACITY 64
+
+#define COMPLETION_PENDING 0
+#define COMPLETION_DONE 1
+#define COMPLETION_ERROR 2
+
+typedef void (*CompletionCallback)(int completionNum, int status);
 
 struct BufferStorer {
     MTL::Buffer *buffer;
     int bufferNum;
+    size_t size;
+    bool noCopy;
+    // Only the GPU can access private buffers, contents() being null
+    bool privateStorage;
+    // Serial of the last batch that encoded a command using the buffer, 0 if none did
+    uint64_t batchSerial = 0;
+};
+
+struct LibraryStorer {
+    MTL::Library *library;
+    size_t sourceHash;
+};
+
+struct KernelStorer {
+    MTL::Function *function;
+    MTL::ComputePipelineState *pipeline;
+};
+
+// Arguments of a dispatch, validated once and replayed by runDispatch
+struct DispatchStorer {
+    MTL::ComputePipelineState *pipeline;
+    int metalSize[3];
+    int threadsPerGroup[3];
+    std::vector<int> buffers;
+    // Arguments passed as bytes rather than buffers, packed in slot order, inlineSizes being 0 for buffer slots
+    std::vector<char> inlineBytes;
+    std::vector<int> inlineSizes;
+};
+
+struct CompletionStorer {
+    std::mutex lock;
+    std::condition_variable cond;
+    int status = COMPLETION_PENDING;
+    double gpuStart = 0;
+    double gpuEnd = 0;
+};
+
+// Serials of the command buffers that were created but haven't completed yet
+struct CompletionTracker {
+    std::mutex lock;
+    std::condition_variable cond;
+    CompletionCallback callback = nullptr;
+    std::set<uint64_t> inFlight;
+    uint64_t lastSerial = 0;
+};
+
+// Command queue, batch and timing state of one calling thread, so that threads sharing an instance never use each other's
+struct ThreadState {
+    MTL::CommandQueue *queue = nullptr;
+    int batchDepth = 0;
+    uint64_t batchSerial = 0;
+    MTL::CommandBuffer *batchCommandBuffer = nullptr;
+    MTL::ComputeCommandEncoder *batchEncoder = nullptr;
+    double encodeTime = 0;
+    double gpuStart = 0;
+    double gpuEnd = 0;
+};
+
+// States of the threads using an instance, shared with those threads so that each can remove its own entry when it exits,
+// even once the instance is gone
+struct ThreadRegistry {
+    std::mutex lock;
+    std::unordered_map<std::thread::id, ThreadState> states;
+    size_t assigned = 0;
+};
+
+struct PipelineStorer {
+    MTL::Library *library;
+    MTL::Function *function;
+    MTL::ComputePipelineState *pipeline;
 };
 
 class Instance {
     public:
         void init();
         void createLibrary(const char* filename);
-        void createLibraryFromString(const char *fileString);
+        void createLibraryFromString(const char *fileString, const char *binaryPath);
         void setFunction(const char *funcname);
-        void releaseBuffer(int bufnum);
-        void runFunction(int *MetalSize, int *requestedBuffers, int numRequestedBuffers, bool waitForCompletion);
+        long releaseBuffer(int bufnum);
+        long completedBefore();
+        int runFunction(int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion);
+
+        int createKernel(const char *fileString, const char *binaryPath, const char *funcname);
+        void releaseKernel(int kernelNum);
+        int runKernel(int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion);
+
+        void beginBatch();
+        int endBatch(bool waitForCompletion);
+
+        int completionStatus(int completionNum);
+        int waitCompletion(int completionNum, double timeout);
+        void releaseCompletion(int completionNum);
+        void setCompletionCallback(CompletionCallback callback);
 
         int maxThreadsPerGroup();
         int threadExecutionWidth();
+        int kernelMaxThreadsPerGroup(int kernelNum);
+        int kernelThreadExecutionWidth(int kernelNum);
+
+        int createDispatch(int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup);
+        int runDispatch(int dispatchNum, bool waitForCompletion);
+        void setDispatchBuffer(int dispatchNum, int index, int bufferNum);
+        void setDispatchBytes(int dispatchNum, int index, const char *bytes, int size);
+        void releaseDispatch(int dispatchNum);
+        double lastGPUTime();
+        void getDispatchTimes(double *times);
+        void getCompletionTimes(int completionNum, double *times);
+        double hostTime();
+
+        void setCacheCapacity(int capacity);
+        void getCacheStats(long *stats);
+
+        void setPoolLimits(long maxBytes, long maxBufferSize);
+        void getPoolStats(long *stats);
+
+        void setCommandQueues(int count);
+
+        void setMemoryBudget(long bytes);
+        void getMemoryStats(long *stats);
 
         ~Instance();
 
-        int createBuffer(int bufsize);
+        int createBuffer(long bufsize, bool privateStorage);
+        int createBufferNoCopy(void *pointer, long bufsize);
         void *getBufferPointer(int bufnum);
+        int copyBuffer(int sourceNum, long sourceOffset, int destinationNum, long destinationOffset, long size, bool waitForCompletion);
+        int setBufferStorage(int bufnum, bool privateStorage);
 
-        BufferStorer *buffers;
-        int totbuf;
+        std::vector<BufferStorer> buffers;
 
     private:
+        LibraryStorer *getLibrary(const char *fileString, const char *binaryPath);
+        PipelineStorer *getPipeline(LibraryStorer *libStore, const char *funcname);
+        uint64_t beginCommand();
+        void endCommand(uint64_t serial);
+        uint64_t minInFlightSerial();
+        ThreadState &currentThread();
+        int submit(MTL::CommandBuffer *commandBuffer, uint64_t serial, bool waitForCompletion);
+        std::shared_ptr<CompletionStorer> getCompletion(int completionNum);
+        int storeBuffer(MTL::Buffer *buffer, long bufsize, bool noCopy, bool privateStorage, size_t reserved);
+        bool reserveMemory(size_t bytes);
+        MTL::Buffer *allocateBuffer(size_t size, bool privateStorage);
+        void clearBuffer(MTL::Buffer *buffer, bool privateStorage);
+        int dispatch(MTL::ComputePipelineState *pipeline, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion);
+
         MTL::Device *device;
-        MTL::CommandQueue *commandQueue;
+        // Threads are spread over the first activeQueues queues, command buffers of different queues running concurrently
+        std::vector<MTL::CommandQueue *> queues;
+        int activeQueues;
+        std::shared_ptr<ThreadRegistry> threads;
+
+        // Guards the buffer, kernel and dispatch tables, and the pool. Taken after cacheLock when both are needed
+        std::recursive_mutex tableLock;
+        // Guards the library and pipeline caches, and the current library and function
+        std::recursive_mutex cacheLock;
         MTL::Library *library;
+        size_t librarySourceHash;
 
         MTL::Function *function;
         MTL::ComputePipelineState *functionPSO;
 
+        std::unordered_map<int, std::shared_ptr<CompletionStorer>> completions;
+        int nextCompletion;
+        std::mutex completionsLock;
+        std::shared_ptr<CompletionTracker> tracker;
+
+        std::vector<int> freeBuffers;
+        // Serials of the batches still being recorded, guarded by tableLock. Their commands hold on to the Metal buffers
+        // they were given, which can't be swapped for new ones until the batch is submitted
+        std::set<uint64_t> openBatches;
+        long liveBuffers;
+        // Bytes of the buffers allocated by the instance, host memory wrapped without a copy being counted apart
+        size_t liveBytes;
+        size_t wrappedBytes;
+        size_t reservedBytes;
+        size_t peakBytes;
+        size_t evictedBytes;
+        // 0 when there is no budget
+        size_t memoryBudget;
+        BufferPool pool;
+
+        std::vector<KernelStorer> kernels;
+        std::vector<int> freeKernels;
+
+        std::vector<DispatchStorer> dispatches;
+        std::vector<int> freeDispatches;
+
+        LRUCache<LibraryStorer> libraryCache{DEFAULT_CACHE_CAPACITY, [](LibraryStorer &stored) {
+            stored.library->release();
+        }};
+        LRUCache<PipelineStorer> pipelineCache{DEFAULT_CACHE_CAPACITY, [](PipelineStorer &stored) {
+            stored.function->release();
+            stored.pipeline->release();
+        }};
+
         NS::Error *errPtr;
 };
@@ -0,0 +1,76 @@
+#pragma once
+
+#include <functional>
+#include <list>
+#include <string>
+#include <unordered_map>
+
+// Bounded least-recently-used cache, keyed by string.
+// onEvict is called on every value leaving the cache, so that Metal objects can be released.
+template <typename T>
+class LRUCache {
+    public:
+        LRUCache(size_t capacity, std::function<void(T &)> onEvict) : capacity(capacity > 0 ? capacity : 1), onEvict(onEvict) {}
+
+        ~LRUCache() {
+            clear();
+        }
+
+        T *get(const std::string &key) {
+            auto found = index.find(key);
+            if (found == index.end()) {
+                misses += 1;
+                return nullptr;
+            }
+            hits += 1;
+            items.splice(items.begin(), items, found->second);
+            return &found->second->second;
+        }
+
+        T *put(const std::string &key, T value) {
+            auto found = index.find(key);
+            if (found != index.end()) {
+                onEvict(found->second->second);
+                items.erase(found->second);
+                index.erase(found);
+            }
+            items.emplace_front(key, value);
+            index[key] = items.begin();
+            trim();
+            return &items.begin()->second;
+        }
+
+        void setCapacity(size_t newCapacity) {
+            capacity = newCapacity > 0 ? newCapacity : 1;
+            trim();
+        }
+
+        void clear() {
+            for (auto &item : items) {
+                onEvict(item.second);
+            }
+            items.clear();
+            index.clear();
+        }
+
+        size_t size() const {
+            return items.size();
+        }
+
+        long hits = 0;
+        long misses = 0;
+
+    private:
+        void trim() {
+            while (items.size() > capacity && !items.empty()) {
+                onEvict(items.back().second);
+                index.erase(items.back().first);
+                items.pop_back();
+            }
+        }
+
+        size_t capacity;
+        std::function<void(T &)> onEvict;
+        std::list<std::pair<std::string, T>> items;
+        std::unordered_map<std::string, typename std::list<std::pair<std::string, T>>::iterator> index;
+};
@@ -0,0 +1,106 @@
+#include "pool.h"
+
+// Four size classes per power of two, so that a pooled buffer is never more than 25% larger than requested
+size_t BufferPool::sizeClass(size_t size) {
+    if (size <= POOL_MIN_SIZE_CLASS) {
+        return POOL_MIN_SIZE_CLASS;
+    }
+    size_t power = POOL_MIN_SIZE_CLASS;
+    while (power < size) {
+        power <<= 1;
+    }
+    size_t step = power / 8;
+    return ((size + step - 1) / step) * step;
+}
+
+bool BufferPool::accepts(size_t classSize) const {
+    return classSize <= maxBufferSize && classSize <= maxBytes;
+}
+
+MTL::Buffer *BufferPool::acquire(size_t classSize, bool privateStorage, uint64_t minInFlightSerial) {
+    auto found = entries.find({classSize, privateStorage});
+    // The oldest entry is the most likely to be unused by the GPU. It can only be reused once every
+    // command buffer that existed when it was released has completed.
+    if (found == entries.end() || found->second.empty() || found->second.front().releaseSerial >= minInFlightSerial) {
+        misses += 1;
+        return nullptr;
+    }
+    hits += 1;
+
+    MTL::Buffer *buffer = found->second.front().buffer;
+    found->second.pop_front();
+    pooledBytes -= buffer->length();
+    pooledBuffers -= 1;
+    return buffer;
+}
+
+void BufferPool::release(MTL::Buffer *buffer, bool privateStorage, uint64_t releaseSerial) {
+    size_t length = buffer->length();
+    if (!accepts(length)) {
+        buffer->release();
+        return;
+    }
+
+    PooledBuffer entry;
+    entry.buffer = buffer;
+    entry.releaseSerial = releaseSerial;
+    entry.releaseTick = tick++;
+    entries[{length, privateStorage}].push_back(entry);
+    pooledBytes += length;
+    pooledBuffers += 1;
+
+    while (pooledBytes > maxBytes) {
+        evictOldest();
+    }
+}
+
+size_t BufferPool::evictOldest() {
+    std::deque<PooledBuffer> *oldest = nullptr;
+    for (auto &entry : entries) {
+        if (!entry.second.empty() && (oldest == nullptr || entry.second.front().releaseTick < oldest->front().releaseTick)) {
+            oldest = &entry.second;
+        }
+    }
+    if (oldest == nullptr) {
+        return 0;
+    }
+
+    MTL::Buffer *buffer = oldest->front().buffer;
+    oldest->pop_front();
+    size_t length = buffer->length();
+    pooledBytes -= length;
+    pooledBuffers -= 1;
+    buffer->release();
+    return length;
+}
+
+size_t BufferPool::evict(size_t bytes) {
+    size_t freed = 0;
+    while (freed < bytes && pooledBuffers > 0) {
+        freed += evictOldest();
+    }
+    return freed;
+}
+
+void BufferPool::setLimits(size_t newMaxBytes, size_t newMaxBufferSize) {
+    maxBytes = newMaxBytes;
+    maxBufferSize = newMaxBufferSize;
+    while (pooledBytes > maxBytes) {
+        evictOldest();
+    }
+}
+
+void BufferPool::clear() {
+    for (auto &entry : entries) {
+        for (auto &pooled : entry.second) {
+            pooled.buffer->release();
+        }
+    }
+    entries.clear();
+    pooledBytes = 0;
+    pooledBuffers = 0;
+}
+
+BufferPool::~BufferPool() {
+    clear();
+}
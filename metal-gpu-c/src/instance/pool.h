@@ -0,0 +1,46 @@
+#pragma once
+
+#include "../config.h"
+
+#include <cstdint>
+#include <deque>
+#include <map>
+#include <utility>
+
+#define DEFAULT_POOL_MAX_BYTES (256 * 1024 * 1024)
+#define DEFAULT_POOL_MAX_BUFFER_SIZE (64 * 1024 * 1024)
+#define POOL_MIN_SIZE_CLASS 256
+
+struct PooledBuffer {
+    MTL::Buffer *buffer;
+    uint64_t releaseSerial;
+    uint64_t releaseTick;
+};
+
+// Released Metal buffers, grouped by size class and storage mode, kept for reuse by later allocations of a compatible size.
+class BufferPool {
+    public:
+        static size_t sizeClass(size_t size);
+
+        bool accepts(size_t classSize) const;
+        MTL::Buffer *acquire(size_t classSize, bool privateStorage, uint64_t minInFlightSerial);
+        void release(MTL::Buffer *buffer, bool privateStorage, uint64_t releaseSerial);
+        size_t evict(size_t bytes);
+        void setLimits(size_t newMaxBytes, size_t newMaxBufferSize);
+        void clear();
+
+        ~BufferPool();
+
+        long hits = 0;
+        long misses = 0;
+        size_t pooledBytes = 0;
+        size_t pooledBuffers = 0;
+
+    private:
+        size_t evictOldest();
+
+        std::map<std::pair<size_t, bool>, std::deque<PooledBuffer>> entries;
+        uint64_t tick = 0;
+        size_t maxBytes = DEFAULT_POOL_MAX_BYTES;
+        size_t maxBufferSize = DEFAULT_POOL_MAX_BUFFER_SIZE;
+};
@@ -5,6 +5,8 @@
 #include "config.h"
 #include "instance/instance.h"
 
+#include <climits>
+
 int main() {}  
 
 extern "C" {
@@ -20,9 +22,14 @@ extern "C" {
         instance->createLibrary(filename);
     }
 
-    int createBuffer(Instance* instance, int bufsize) {
+    int createBuffer(Instance* instance, long bufsize, bool privateStorage) {
+        if (instance == nullptr) return -1;
+        return instance->createBuffer(bufsize, privateStorage);
+    }
+
+    int createBufferNoCopy(Instance* instance, void *pointer, long bufsize) {
         if (instance == nullptr) return -1;
-        return instance->createBuffer(bufsize);
+        return instance->createBufferNoCopy(pointer, bufsize);
     }
 
     void setFunction(Instance* instance, const char *funcname) {
@@ -30,14 +37,19 @@ extern "C" {
         instance->setFunction(funcname);
     }
 
-    void runFunction(Instance* instance, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, bool waitForCompletion) {
-        if (instance == nullptr) return;
-        instance->runFunction(MetalSize, requestedBuffers, numRequestedBuffers, waitForCompletion);
+    int runFunction(Instance* instance, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion) {
+        if (instance == nullptr) return -1;
+        return instance->runFunction(MetalSize, requestedBuffers, numRequestedBuffers, inlineBytes, inlineSizes, threadsPerGroup, waitForCompletion);
     }
 
-    void releaseBuffer(Instance* instance, int bufnum) {
-        if (instance == nullptr) return;
-        instance->releaseBuffer(bufnum);
+    long releaseBuffer(Instance* instance, int bufnum) {
+        if (instance == nullptr) return -1;
+        return instance->releaseBuffer(bufnum);
+    }
+
+    long completedBefore(Instance* instance) {
+        if (instance == nullptr) return LONG_MAX;
+        return instance->completedBefore();
     }
 
     void deleteInstance(Instance* instance) {
@@ -53,7 +65,12 @@ extern "C" {
 
     void createLibraryFromString(Instance* instance, const char* string) {
         if (instance == nullptr) return;
-        instance->createLibraryFromString(string);
+        instance->createLibraryFromString(string, nullptr);
+    }
+
+    void createLibraryFromBinary(Instance* instance, const char* string, const char *binaryPath) {
+        if (instance == nullptr) return;
+        instance->createLibraryFromString(string, binaryPath);
     }
 
     int maxThreadsPerGroup(Instance* instance) {
@@ -65,6 +82,149 @@ extern "C" {
         if (instance == nullptr) return 0;
         return instance->threadExecutionWidth();
     }
-}
 
+    void setCacheCapacity(Instance* instance, int capacity) {
+        if (instance == nullptr) return;
+        instance->setCacheCapacity(capacity);
+    }
+
+    void getCacheStats(Instance* instance, long *stats) {
+        if (instance == nullptr) return;
+        instance->getCacheStats(stats);
+    }
+
+    int createKernel(Instance* instance, const char *string, const char *binaryPath, const char *funcname) {
+        if (instance == nullptr) return -1;
+        return instance->createKernel(string, binaryPath, funcname);
+    }
+
+    void releaseKernel(Instance* instance, int kernelNum) {
+        if (instance == nullptr) return;
+        instance->releaseKernel(kernelNum);
+    }
+
+    int runKernel(Instance* instance, int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup, bool waitForCompletion) {
+        if (instance == nullptr) return -1;
+        return instance->runKernel(kernelNum, MetalSize, requestedBuffers, numRequestedBuffers, inlineBytes, inlineSizes, threadsPerGroup, waitForCompletion);
+    }
+
+    int kernelMaxThreadsPerGroup(Instance* instance, int kernelNum) {
+        if (instance == nullptr) return 0;
+        return instance->kernelMaxThreadsPerGroup(kernelNum);
+    }
+
+    int kernelThreadExecutionWidth(Instance* instance, int kernelNum) {
+        if (instance == nullptr) return 0;
+        return instance->kernelThreadExecutionWidth(kernelNum);
+    }
+
+    double lastGPUTime(Instance* instance) {
+        if (instance == nullptr) return 0;
+        return instance->lastGPUTime();
+    }
+
+    int createDispatch(Instance* instance, int kernelNum, int *MetalSize, int *requestedBuffers, int numRequestedBuffers, const char *inlineBytes, int *inlineSizes, int *threadsPerGroup) {
+        if (instance == nullptr) return -1;
+        return instance->createDispatch(kernelNum, MetalSize, requestedBuffers, numRequestedBuffers, inlineBytes, inlineSizes, threadsPerGroup);
+    }
+
+    int runDispatch(Instance* instance, int dispatchNum, bool waitForCompletion) {
+        if (instance == nullptr) return -1;
+        return instance->runDispatch(dispatchNum, waitForCompletion);
+    }
+
+    void setDispatchBuffer(Instance* instance, int dispatchNum, int index, int bufferNum) {
+        if (instance == nullptr) return;
+        instance->setDispatchBuffer(dispatchNum, index, bufferNum);
+    }
+
+    void setDispatchBytes(Instance* instance, int dispatchNum, int index, const char *bytes, int size) {
+        if (instance == nullptr) return;
+        instance->setDispatchBytes(dispatchNum, index, bytes, size);
+    }
+
+    void releaseDispatch(Instance* instance, int dispatchNum) {
+        if (instance == nullptr) return;
+        instance->releaseDispatch(dispatchNum);
+    }
+
+    void getDispatchTimes(Instance* instance, double *times) {
+        if (instance == nullptr) return;
+        instance->getDispatchTimes(times);
+    }
+
+    void getCompletionTimes(Instance* instance, int completionNum, double *times) {
+        if (instance == nullptr) return;
+        instance->getCompletionTimes(completionNum, times);
+    }
+
+    double hostTime(Instance* instance) {
+        if (instance == nullptr) return 0;
+        return instance->hostTime();
+    }
+
+    void beginBatch(Instance* instance) {
+        if (instance == nullptr) return;
+        instance->beginBatch();
+    }
+
+    int endBatch(Instance* instance, bool waitForCompletion) {
+        if (instance == nullptr) return -1;
+        return instance->endBatch(waitForCompletion);
+    }
+
+    int completionStatus(Instance* instance, int completionNum) {
+        if (instance == nullptr) return -1;
+        return instance->completionStatus(completionNum);
+    }
+
+    int waitCompletion(Instance* instance, int completionNum, double timeout) {
+        if (instance == nullptr) return -1;
+        return instance->waitCompletion(completionNum, timeout);
+    }
+
+    void releaseCompletion(Instance* instance, int completionNum) {
+        if (instance == nullptr) return;
+        instance->releaseCompletion(completionNum);
+    }
+
+    void setCompletionCallback(Instance* instance, CompletionCallback callback) {
+        if (instance == nullptr) return;
+        instance->setCompletionCallback(callback);
+    }
+
+    void setPoolLimits(Instance* instance, long maxBytes, long maxBufferSize) {
+        if (instance == nullptr) return;
+        instance->setPoolLimits(maxBytes, maxBufferSize);
+    }
+
+    void getPoolStats(Instance* instance, long *stats) {
+        if (instance == nullptr) return;
+        instance->getPoolStats(stats);
+    }
+
+    void setCommandQueues(Instance* instance, int count) {
+        if (instance == nullptr) return;
+        instance->setCommandQueues(count);
+    }
 
+    void setMemoryBudget(Instance* instance, long bytes) {
+        if (instance == nullptr) return;
+        instance->setMemoryBudget(bytes);
+    }
+
+    void getMemoryStats(Instance* instance, long *stats) {
+        if (instance == nullptr) return;
+        instance->getMemoryStats(stats);
+    }
+
+    int copyBuffer(Instance* instance, int sourceNum, long sourceOffset, int destinationNum, long destinationOffset, long size, bool waitForCompletion) {
+        if (instance == nullptr) return -1;
+        return instance->copyBuffer(sourceNum, sourceOffset, destinationNum, destinationOffset, size, waitForCompletion);
+    }
+
+    int setBufferStorage(Instance* instance, int bufnum, bool privateStorage) {
+        if (instance == nullptr) return -1;
+        return instance->setBufferStorage(bufnum, privateStorage);
+    }
+}
@@ -1,6 +1,6 @@
 from .interface import Interface, MetalSize
-from .operators import sqrt, cos, sin, tan
-
-import platform
-
-assert platform.system() == "Darwin", "[MetalGPU] MetalGPU is only supported on macOS"
+from .operators import sqrt, cos, sin, tan, add, sub, mul
+from .reductions import sum, min, max, mean, argmin, argmax
+from .scan import cumsum, compact, nonzero, flatnonzero
+from .sorting import sort, argsort, sort_by_key
+from .linalg import matmul
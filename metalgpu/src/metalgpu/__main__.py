@@ -1,5 +1,6 @@
 import os
 import subprocess
+import sys
 
 curr_path = os.path.dirname(__file__)
 
@@ -21,4 +22,17 @@ def build():
     subprocess.run(final_command, shell=True)
 
 
-build()
+
+def main():
+    command = sys.argv[1] if len(sys.argv) > 1 else "build"
+    if command == "build":
+        build()
+    elif command == "bench":
+        from .bench import main as bench
+        sys.exit(bench(sys.argv[2:]))
+    else:
+        print(f"Unknown command {command}, expected build or bench", file=sys.stderr)
+        sys.exit(2)
+
+
+main()
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import tempfile
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .utils import anyToMetal
+
+# Bump whenever keys or entries change meaning, so that stale tables are ignored
+TABLE_VERSION = 1
+
+
+# Grids are grouped by dimensionality and the power of two above every dimension, one shape being tuned per group
+def grid_class(size) -> str:
+    dims = [size.width, size.height, size.depth]
+    return "x".join(str((dim - 1).bit_length()) if dim > 1 else "1" for dim in dims)
+
+
+def normalize_threads(threads_per_group) -> tuple[int, int, int]:
+    if isinstance(threads_per_group, int):
+        threads = (threads_per_group, 1, 1)
+    elif hasattr(threads_per_group, "width"):
+        threads = (threads_per_group.width, threads_per_group.height, threads_per_group.depth)
+    else:
+        threads = tuple(threads_per_group) + (1,) * (3 - len(threads_per_group))
+    assert len(threads) == 3 and all(isinstance(dim, int) and dim > 0 for dim in threads), "[MetalGPU] Threads per group must be 1 to 3 positive integers"
+    return threads
+
+
+# Copies of the Metal buffers behind the given ones, views being rebuilt with the same layout on the copy of their base.
+# Returns the arguments to run with, and the copies to release
+def scratch_buffers(interface, buffers: list) -> tuple[list, list]:
+    copies = {}
+    scratch = []
+    for buff in buffers:
+        if isinstance(buff, LazyBuffer):
+            buff = buff.evaluate()
+        if not isinstance(buff, Buffer):
+            scratch.append(buff)
+            continue
+        root = buff.base if buff.base is not None else buff
+        if id(root) not in copies:
+            copy = interface.create_buffer(root.shape, anyToMetal(root.bufType), "private" if root.private else "shared")
+            interface.copy_buffer(root, copy)
+            copies[id(root)] = copy
+        copy = copies[id(root)]
+        scratch.append(copy if buff is root else copy._view(buff.shape, buff.strides, buff.offset))
+    return scratch, list(copies.values())
+
+
+class Autotuner:
+    def __init__(self, path: str | None = None, runs: int = 3) -> None:
+        assert runs > 0, "[MetalGPU] Autotune runs must be greater than 0"
+        self.path = os.path.expanduser(path) if path is not None else None
+        self.runs = runs
+        self.table = {}
+        self.tuned = 0
+
+        if self.path is not None and os.path.isfile(self.path):
+            try:
+                with open(self.path) as f:
+                    data = json.load(f)
+            except (OSError, ValueError):
+                data = {}
+            if data.get("version") == TABLE_VERSION:
+                self.table = {key: tuple(threads) for key, threads in data.get("entries", {}).items()}
+
+    def key(self, kernel, size) -> str:
+        # Hashing the source once per kernel keeps lookups cheap on every dispatch
+        if kernel._tune_key is None:
+            digest = hashlib.sha256()
+            for part in (kernel.source, kernel.function_name):
+                digest.update(part.encode("utf-8"))
+                digest.update(b"\0")
+            kernel._tune_key = digest.hexdigest()[:32]
+        return f"{kernel._tune_key}:{grid_class(size)}"
+
+    def lookup(self, kernel, size) -> tuple[int, int, int] | None:
+        if not self.table:
+            return None
+        threads = self.table.get(self.key(kernel, size))
+        # A table written on another GPU may hold shapes this pipeline can't run
+        if threads is None or threads[0] * threads[1] * threads[2] > kernel.maxThreadsPerGroup():
+            return None
+        return threads
+
+    def candidates(self, kernel, size) -> list[tuple[int, int, int]]:
+        width = kernel.threadExecutionWidth()
+        maxThreads = kernel.maxThreadsPerGroup()
+        totals = []
+        total = width
+        while total <= maxThreads:
+            totals.append(total)
+            total *= 2
+        if maxThreads not in totals:
+            totals.append(maxThreads)
+
+        candidates = []
+        for total in totals:
+            if size.height == 1 and size.depth == 1:
+                candidates.append((total, 1, 1))
+                continue
+            # Every split of total with a power of two width of at least 4, the depth being covered by threadgroups
+            x = 4
+            while x <= total:
+                if total % x == 0 and x <= max(size.width, width) and total // x <= max(size.height, 1) * 2:
+                    candidates.append((x, total // x, 1))
+                x *= 2
+        return candidates or [(width, 1, 1)]
+
+    # Times every candidate shape on the given dispatch, the kernel being run runs times per candidate. The runs use copies of
+    # the buffers, so that kernels updating them in place, such as accumulations, leave the caller's buffers as they were
+    def tune(self, interface, kernel, size, buffers: list) -> tuple[int, int, int]:
+        scratch, copies = scratch_buffers(interface, buffers)
+        best, bestTime = None, None
+        try:
+            for threads in self.candidates(kernel, size):
+                times = []
+                for _ in range(self.runs):
+                    interface.run_function(size, scratch, kernel, True, threads_per_group=threads)
+                    times.append(interface.last_gpu_time())
+                if bestTime is None or min(times) < bestTime:
+                    best, bestTime = threads, min(times)
+        finally:
+            for copy in copies:
+                copy.release()
+
+        self.table[self.key(kernel, size)] = best
+        self.tuned += 1
+        self.save()
+        return best
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump({"version": TABLE_VERSION, "entries": {key: list(threads) for key, threads in self.table.items()}}, f)
+            os.replace(tmp_path, self.path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def clear(self) -> None:
+        self.table = {}
+        self.save()
+
+    def stats(self) -> dict:
+        return {"entries": len(self.table), "tuned": self.tuned}
@@ -0,0 +1,320 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+
+import numpy as np
+
+from .utils import format_table
+
+# Bump whenever result fields change meaning, so that comparisons against older baselines can be flagged
+RESULTS_VERSION = 1
+
+_poly_degree = 20
+_cond_threshold = np.float32(0.5)
+
+_shaders = {
+    "vector_add": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void vector_add(device const float *a [[buffer(0)]], device const float *b [[buffer(1)]], device float *c [[buffer(2)]], uint id [[thread_position_in_grid]]) {
+    c[id] = a[id] + b[id];
+}
+""",
+    "sqrt": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void element_sqrt(device const float *a [[buffer(0)]], device float *b [[buffer(1)]], uint id [[thread_position_in_grid]]) {
+    b[id] = sqrt(fabs(a[id]));
+}
+""",
+    "exp": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void element_exp(device const float *a [[buffer(0)]], device float *b [[buffer(1)]], uint id [[thread_position_in_grid]]) {
+    b[id] = exp(a[id]);
+}
+""",
+    "saxpy": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void saxpy(device const float *x [[buffer(0)]], device const float *y [[buffer(1)]], constant float &a [[buffer(2)]], device float *out [[buffer(3)]], uint id [[thread_position_in_grid]]) {
+    out[id] = a * x[id] + y[id];
+}
+""",
+    "polynomial": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void polynomial(device const float *coeffs [[buffer(0)]], device const float *x [[buffer(1)]], constant uint &degree [[buffer(2)]], device float *out [[buffer(3)]], uint id [[thread_position_in_grid]]) {
+    float value = coeffs[degree];
+    for (int i = degree - 1; i >= 0; i--) {
+        value = value * x[id] + coeffs[i];
+    }
+    out[id] = value;
+}
+""",
+    "conditional": """
+#include <metal_stdlib>
+using namespace metal;
+kernel void conditional(device const float *a [[buffer(0)]], device const float *b [[buffer(1)]], device const float *d [[buffer(2)]], constant float &threshold [[buffer(3)]], device float *out [[buffer(4)]], uint id [[thread_position_in_grid]]) {
+    out[id] = a[id] > threshold ? b[id] : d[id];
+}
+""",
+}
+
+
+# One measured operation. inputs builds the numpy inputs for a problem size, numpy and metal return a callable running the operation once and returning its result
+class Benchmark:
+    def __init__(self, name, inputs, numpy, metal, bytes_moved, flops, single_dispatch=True, rtol=1e-4, atol=1e-5) -> None:
+        self.name = name
+        self.inputs = inputs
+        self.numpy = numpy
+        self.metal = metal
+        self.bytes_moved = bytes_moved
+        self.flops = flops
+        # Only operations that run as one command buffer report the GPU time of the last one
+        self.single_dispatch = single_dispatch
+        self.rtol = rtol
+        self.atol = atol
+
+
+def _floats(*scales):
+    return lambda n, rng: [((rng.random(n, dtype=np.float32) - 0.5) * scale).astype(np.float32) for scale in scales]
+
+
+def _kernel(name : str, function_name : str, size, *scalars):
+    # Metal side of a raw kernel benchmark, the output buffer being the last argument
+    def prepare(interface, *arrays):
+        import metalgpu
+        kernel = interface.get_kernel(_shaders[name], function_name)
+        buffers = [interface.array_to_buffer(array) for array in arrays]
+        # Scalars are passed inline, as constant arguments
+        buffers += list(scalars)
+        out = interface.create_buffer(size(arrays), "float")
+        buffers.append(out)
+
+        def run():
+            kernel(metalgpu.MetalSize(out.size, 1, 1), buffers)
+            return out
+        return run
+    return prepare
+
+
+def _library(function):
+    def prepare(interface, *arrays):
+        buffers = [interface.array_to_buffer(array) for array in arrays]
+        return lambda: function(*buffers)
+    return prepare
+
+
+def _polynomial_numpy(coeffs, x):
+    def run():
+        out = np.full_like(x, coeffs[_poly_degree])
+        for i in range(_poly_degree - 1, -1, -1):
+            out = out * x + coeffs[i]
+        return out
+    return run
+
+
+def _matmul_inputs(n, rng):
+    return [rng.random((n, n), dtype=np.float32), rng.random((n, n), dtype=np.float32)]
+
+
+def _metal_op(name):
+    def call(*args):
+        import metalgpu
+        return getattr(metalgpu, name)(*args)
+    return call
+
+
+def benchmarks(size : int, matrix_size : int) -> list[Benchmark]:
+    length = lambda arrays: arrays[-1].size
+    return [
+        Benchmark("vector_add", _floats(1, 1), lambda a, b: lambda: a + b, _kernel("vector_add", "vector_add", length), 12 * size, size),
+        Benchmark("sqrt", _floats(20), lambda a: lambda: np.sqrt(np.abs(a)), _kernel("sqrt", "element_sqrt", length), 8 * size, size),
+        Benchmark("exp", _floats(10), lambda a: lambda: np.exp(a), _kernel("exp", "element_exp", length), 8 * size, size, rtol=1e-3),
+        Benchmark("saxpy", _floats(1, 1), lambda x, y: lambda: np.float32(2.5) * x + y, _kernel("saxpy", "saxpy", length, np.float32(2.5)), 12 * size, 2 * size),
+        Benchmark("polynomial", lambda n, rng: [(rng.random(_poly_degree + 1, dtype=np.float32) - 0.5) * 2] + _floats(2)(n, rng),
+                  _polynomial_numpy, _kernel("polynomial", "polynomial", length, np.uint32(_poly_degree)), 8 * size, 2 * _poly_degree * size, rtol=1e-3, atol=1e-4),
+        Benchmark("conditional", _floats(1, 1, 1), lambda a, b, d: lambda: np.where(a > _cond_threshold, b, d),
+                  _kernel("conditional", "conditional", length, _cond_threshold), 16 * size, size),
+        Benchmark("matmul", _matmul_inputs, lambda a, b: lambda: a @ b, _library(_metal_op("matmul")),
+                  12 * matrix_size * matrix_size, 2 * matrix_size ** 3, rtol=1e-3, atol=1e-3),
+        Benchmark("sum", _floats(1), lambda a: lambda: np.sum(a, dtype=np.float32), _library(_metal_op("sum")), 4 * size, size, rtol=1e-3, atol=1e-2),
+        Benchmark("cumsum", lambda n, rng: [rng.integers(0, 16, n, dtype=np.int32)], lambda a: lambda: np.cumsum(a, dtype=np.int32),
+                  _library(_metal_op("cumsum")), 8 * size, size, single_dispatch=False),
+        Benchmark("sort", lambda n, rng: [rng.integers(-2 ** 31, 2 ** 31, n, dtype=np.int32)], lambda a: lambda: np.sort(a, kind="stable"),
+                  _library(_metal_op("sort")), 8 * size, 0),
+    ]
+
+
+class NumpyBackend:
+    # Runs every benchmark on the CPU, as a reference and to exercise the harness without a GPU
+    name = "numpy"
+
+    def prepare(self, benchmark : Benchmark, arrays : list):
+        return benchmark.numpy(*arrays)
+
+    def gpu_time(self) -> float | None:
+        return None
+
+    def device(self) -> str:
+        return f"{platform.machine()} {platform.processor()}".strip()
+
+
+class MetalBackend:
+    name = "metal"
+
+    def __init__(self) -> None:
+        import metalgpu
+        self.interface = metalgpu.Interface()
+
+    def prepare(self, benchmark : Benchmark, arrays : list):
+        return benchmark.metal(self.interface, *arrays)
+
+    def gpu_time(self) -> float | None:
+        return self.interface.last_gpu_time()
+
+    def device(self) -> str:
+        return f"{platform.machine()} macOS {platform.mac_ver()[0]}"
+
+
+backends = {"numpy": NumpyBackend, "metal": MetalBackend}
+
+
+def summarize(times : list[float]) -> dict:
+    percentiles = np.percentile(times, [10, 50, 90, 99])
+    return {
+        "min": min(times),
+        "median": float(percentiles[1]),
+        "mean": statistics.fmean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "p10": float(percentiles[0]),
+        "p90": float(percentiles[2]),
+        "p99": float(percentiles[3]),
+    }
+
+
+def _to_numpy(result) -> np.ndarray:
+    if hasattr(result, "evaluate"):
+        result = result.evaluate()
+    return np.asarray(result.contents if hasattr(result, "contents") else result)
+
+
+def run_benchmark(backend, benchmark : Benchmark, size : int, warmup : int, runs : int, seed : int = 0) -> dict:
+    arrays = benchmark.inputs(size, np.random.default_rng(seed))
+    run = backend.prepare(benchmark, arrays)
+
+    # Warmup runs pay for compilation, pipeline creation and first touch of the memory
+    result = None
+    for _ in range(warmup):
+        result = run()
+
+    times, gpuTimes = [], []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = run()
+        times.append(time.perf_counter() - start)
+        gpuTime = backend.gpu_time() if benchmark.single_dispatch else None
+        if gpuTime:
+            gpuTimes.append(gpuTime)
+
+    expected = _to_numpy(benchmark.numpy(*arrays)())
+    verified = bool(np.allclose(_to_numpy(result).reshape(expected.shape), expected, rtol=benchmark.rtol, atol=benchmark.atol))
+
+    stats = summarize(times)
+    return {
+        "name": benchmark.name,
+        "size": size,
+        "runs": runs,
+        "time": stats,
+        "gpu_time": summarize(gpuTimes) if gpuTimes else None,
+        "bandwidth_gbs": benchmark.bytes_moved / stats["median"] / 1e9,
+        "gflops": benchmark.flops / stats["median"] / 1e9 if benchmark.flops else None,
+        "verified": verified,
+    }
+
+
+def compare(results : dict, baseline : dict, threshold : float) -> list[dict]:
+    # A benchmark regressed when its median time grew by more than threshold, as a fraction of the baseline
+    previous = {result["name"]: result for result in baseline["results"]}
+    rows = []
+    for result in results["results"]:
+        base = previous.get(result["name"])
+        if base is None:
+            continue
+        ratio = result["time"]["median"] / base["time"]["median"]
+        if ratio > 1 + threshold:
+            status = "regression"
+        elif ratio < 1 / (1 + threshold):
+            status = "improvement"
+        else:
+            status = "ok"
+        rows.append({"name": result["name"], "baseline": base["time"]["median"], "current": result["time"]["median"], "ratio": ratio, "status": status})
+    return rows
+
+
+def _number(value, digits : int = 2) -> str:
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def main(argv : list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m metalgpu bench", description="Times metalgpu kernels and operations")
+    parser.add_argument("--backend", choices=sorted(backends), default="metal", help="metal, or numpy to run the same benchmarks on the CPU")
+    parser.add_argument("--filter", action="append", default=[], help="Only run benchmarks whose name contains this, can be repeated")
+    parser.add_argument("--size", type=int, default=1 << 22, help="Number of elements of vector benchmarks")
+    parser.add_argument("--matrix-size", type=int, default=1024, help="Side of the square matrices of the matmul benchmark")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed runs before measuring")
+    parser.add_argument("--runs", type=int, default=20, help="Timed runs per benchmark")
+    parser.add_argument("--json", metavar="PATH", help="Write the results to this file")
+    parser.add_argument("--compare", metavar="PATH", help="Compare against results previously written with --json")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Median slowdown, as a fraction, counted as a regression")
+    parser.add_argument("--list", action="store_true", help="List the benchmarks and exit")
+    args = parser.parse_args(argv)
+
+    if args.warmup < 0 or args.runs < 1:
+        parser.error("--warmup must be positive and --runs at least 1")
+
+    selected = [benchmark for benchmark in benchmarks(args.size, args.matrix_size) if not args.filter or any(name in benchmark.name for name in args.filter)]
+    if args.list:
+        print("\n".join(benchmark.name for benchmark in selected))
+        return 0
+    if not selected:
+        parser.error("no benchmark matches --filter")
+
+    backend = backends[args.backend]()
+    results = {"version": RESULTS_VERSION, "backend": backend.name, "device": backend.device(), "warmup": args.warmup, "results": []}
+    for benchmark in selected:
+        print(f"Running {benchmark.name}... ", end="", file=sys.stderr, flush=True)
+        size = args.matrix_size if benchmark.name == "matmul" else args.size
+        results["results"].append(run_benchmark(backend, benchmark, size, args.warmup, args.runs))
+        print("done", file=sys.stderr)
+
+    print(format_table(
+        ["Benchmark", "Size", "Median (ms)", "P90 (ms)", "GPU (ms)", "GB/s", "GFLOP/s", "Verified"],
+        [[result["name"], str(result["size"]), _number(result["time"]["median"] * 1e3, 3), _number(result["time"]["p90"] * 1e3, 3),
+          _number(result["gpu_time"]["median"] * 1e3 if result["gpu_time"] else None, 3), _number(result["bandwidth_gbs"]), _number(result["gflops"]),
+          "yes" if result["verified"] else "NO"] for result in results["results"]],
+    ))
+
+    if args.json is not None:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    status = 0 if all(result["verified"] for result in results["results"]) else 1
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if baseline.get("version") != RESULTS_VERSION or baseline.get("backend") != results["backend"]:
+            print(f"Warning: baseline was written by backend {baseline.get('backend')}, version {baseline.get('version')}", file=sys.stderr)
+        rows = compare(results, baseline, args.threshold)
+        print()
+        print(format_table(
+            ["Benchmark", "Baseline (ms)", "Current (ms)", "Ratio", "Status"],
+            [[row["name"], _number(row["baseline"] * 1e3, 3), _number(row["current"] * 1e3, 3), _number(row["ratio"]), row["status"].upper() if row["status"] == "regression" else row["status"]] for row in rows],
+        ) if rows else "No benchmark in common with the baseline")
+        if any(row["status"] == "regression" for row in rows):
+            status = 2
+    return status
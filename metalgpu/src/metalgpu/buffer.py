@@ -1,88 +1,217 @@
 import numpy as np
 
 from .utils import anyToMetal, allowedCTypesPointer
-from .shader import add_func_kernel, sub_func_kernel, mul_func_kernel, cast_func_kernel
+from .shader import add_func_kernel, sub_func_kernel, mul_func_kernel, cast_func_kernel, copy_func_kernel, contiguous_strides
+from .lazy import LazyBuffer, as_operand, broadcast_operands, kernel_argument
 
 
 class Buffer:
-    def __init__(self, buffPointer : allowedCTypesPointer, buffSize : int, interface, bufNum : int) -> None:
-        self.contents : np.ndarray = np.ctypeslib.as_array(buffPointer, shape=(buffSize,))
+    def __init__(self, buffPointer : allowedCTypesPointer | None, buffSize : int, interface, bufNum : int, owner : np.ndarray | None = None, shape : tuple | None = None, dtype = None) -> None:
+        # Flat view over the whole Metal buffer, contents is a (possibly strided) view of it. Private buffers have no pointer, and no storage
+        # until a read moves them to shared storage
+        self.length = buffSize
+        self._private = buffPointer is None
+        self.storage : np.ndarray | None = Buffer.__as_storage(buffPointer, buffSize, dtype) if buffPointer is not None else None
         self.bufNum = bufNum
         self.interface = interface
-        self.bufType = self.contents.dtype
+        self.bufType = np.dtype(dtype) if self.storage is None else self.storage.dtype
+        # Host memory wrapped without a copy, kept alive as long as the buffer
+        self.owner = owner
+        # Views share the Metal buffer of their base, which only the base releases
+        self.base = None
+        self.__set_layout(tuple(shape) if shape is not None else (buffSize,), None, 0)
+
+    def __set_layout(self, shape : tuple, strides : tuple | None, offset : int) -> None:
+        self.shape = tuple(int(dim) for dim in shape)
+        # Strides and offset are counted in elements, not bytes
+        self.strides = tuple(int(stride) for stride in strides) if strides is not None else contiguous_strides(self.shape)
+        self.offset = offset
+        self.size = int(np.prod(self.shape))
+        self._contents = self.__strided() if self.storage is not None else None
+
+    @staticmethod
+    def __as_storage(buffPointer : allowedCTypesPointer, buffSize : int, dtype) -> np.ndarray:
+        storage = np.ctypeslib.as_array(buffPointer, shape=(buffSize,))
+        # Types without a ctypes equivalent, such as half, are exposed through an integer type of the same size
+        return storage.view(dtype) if dtype is not None else storage
+
+    def __strided(self) -> np.ndarray:
+        itemsize = self.bufType.itemsize
+        return np.lib.stride_tricks.as_strided(self.storage[self.offset:], self.shape, [stride * itemsize for stride in self.strides])
+
+    @property
+    def contents(self) -> np.ndarray:
+        root = self.base if self.base is not None else self
+        if root._private:
+            root.make_shared()
+        # Views made before the storage of their base changed are rebuilt on it
+        if self.storage is not root.storage:
+            self.storage = root.storage
+            self._contents = self.__strided()
+        return self._contents
+
+    @property
+    def private(self) -> bool:
+        return (self.base if self.base is not None else self)._private
+
+    def make_shared(self) -> None:
+        # Waits for the copy, GPU work still writing to the buffer must have completed first
+        root = self.base if self.base is not None else self
+        if not root._private:
+            return
+        pointer = root.interface.set_buffer_storage(root.bufNum, False, root.bufType)
+        root.storage = Buffer.__as_storage(pointer, root.length, root.bufType)
+        root._private = False
+        root._contents = root.__strided()
+
+    def make_private(self) -> None:
+        root = self.base if self.base is not None else self
+        assert(root.owner is None), "[MetalGPU] Buffers wrapping host memory can't be made private"
+        if root._private:
+            return
+        root.interface.set_buffer_storage(root.bufNum, True, root.bufType)
+        root.storage = None
+        root._private = True
+        root._contents = None
+
+    def _view(self, shape : tuple, strides : tuple, offset : int) -> "Buffer":
+        view = Buffer.__new__(Buffer)
+        view.storage = self.storage
+        view.bufNum = self.bufNum
+        view.interface = self.interface
+        view.bufType = self.bufType
+        view.owner = None
+        view.length = self.length
+        view._private = False
+        view.base = self.base if self.base is not None else self
+        view.__set_layout(shape, strides, offset)
+        return view
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.bufType
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    @property
+    def nbytes(self) -> int:
+        return self.size * self.bufType.itemsize
+
+    def is_contiguous(self) -> bool:
+        return self.offset == 0 and self.strides == contiguous_strides(self.shape)
+
+    def reshape(self, *shape) -> "Buffer":
+        if len(shape) == 1 and isinstance(shape[0], (tuple, list)):
+            shape = tuple(shape[0])
+        if -1 in shape:
+            known = int(np.prod([dim for dim in shape if dim != -1]))
+            assert(shape.count(-1) == 1 and known > 0 and self.size % known == 0), "[MetalGPU] Can't infer reshape dimension"
+            shape = tuple(self.size // known if dim == -1 else dim for dim in shape)
+        assert(int(np.prod(shape)) == self.size), f"[MetalGPU] Can't reshape buffer of size {self.size} into shape {shape}"
+        # Only contiguous layouts can be reinterpreted, anything else is first copied on the GPU
+        source = self if self.is_contiguous() else self.contiguous()
+        return source._view(shape, contiguous_strides(shape), 0)
+
+    def transpose(self, *axes) -> "Buffer":
+        if len(axes) == 1 and isinstance(axes[0], (tuple, list)):
+            axes = tuple(axes[0])
+        if len(axes) == 0:
+            axes = tuple(reversed(range(self.ndim)))
+        assert(sorted(axes) == list(range(self.ndim))), "[MetalGPU] Transpose axes must be a permutation of the buffer dimensions"
+        return self._view(tuple(self.shape[axis] for axis in axes), tuple(self.strides[axis] for axis in axes), self.offset)
+
+    @property
+    def T(self) -> "Buffer":
+        return self.transpose()
+
+    def contiguous(self) -> "Buffer":
+        if self.is_contiguous():
+            return self
+        outBuffer = self.interface.create_buffer(self.shape, anyToMetal(self.bufType), self.interface.output_storage)
+        copy_kernel = self.interface.get_kernel(copy_func_kernel(self), "copy")
+        copy_kernel(self.size, [self, outBuffer], threads_per_group=copy_kernel.maxThreadsPerGroup())
+        return outBuffer
 
     def release(self) -> None:
-        self.interface.release_buffer(self.bufNum)
-        self.contents = np.array([])
+        # Buffer numbers are reused once released, so a buffer must only release its number once
+        # Wrapped host memory is handed to the interface, which keeps it until the GPU is done with it
+        if self.bufNum is not None and self.base is None:
+            self.interface.release_buffer(self.bufNum, self.owner)
+        self.bufNum = None
+        self.base = None
+        self.storage = np.array([], dtype=self.bufType)
+        self._contents = np.array([], dtype=self.bufType)
+        self._private = False
+        self.owner = None
 
     def __del__(self) -> None:
         self.release()
 
-    def __add__(self, other : "Buffer") -> "Buffer":
-        assert(len(self.contents) == len(other.contents)), "[MetalGPU] Buffers must be of the same content size"
-        assert(self.contents.dtype == other.contents.dtype), "[MetalGPU] Buffers must be of the same data type"
-        outBuffer = self.interface.create_buffer(len(self.contents), anyToMetal(self.contents.dtype))
-
-        add_kernel = add_func_kernel(self)
-
-        prevShader = self.interface.loaded_shader
-        shaderFromPath = self.interface.shader_from_path
-        prevFunction = self.interface.current_function
-        self.interface.load_shader_from_string(add_kernel)
-        self.interface.set_function("add")
-        self.interface.run_function(len(self.contents), [self, other, outBuffer])
-        self.interface.load_shader(prevShader) if shaderFromPath else self.interface.load_shader_from_string(prevShader)
-        self.interface.set_function(prevFunction)
-        return outBuffer
-
-    def __sub__(self, other : "Buffer") -> "Buffer":
-        assert(len(self.contents) == len(other.contents)), "[MetalGPU] Buffers must be of the same content size"
-        assert(self.contents.dtype == other.contents.dtype), "[MetalGPU] Buffers must be of the same data type"
-        outBuffer = self.interface.create_buffer(len(self.contents), anyToMetal(self.contents.dtype))
-
-        sub_kernel = sub_func_kernel(self)
-
-        prevShader = self.interface.loaded_shader
-        shaderFromPath = self.interface.shader_from_path
-        prevFunction = self.interface.current_function
-        self.interface.load_shader_from_string(sub_kernel)
-        self.interface.set_function("sub")
-        self.interface.run_function(len(self.contents), [self, other, outBuffer])
-        self.interface.load_shader(prevShader) if shaderFromPath else self.interface.load_shader_from_string(prevShader)
-        self.interface.set_function(prevFunction)
-        return outBuffer
-
-    def __mul__(self, other : "Buffer") -> "Buffer":
-        assert(len(self.contents) == len(other.contents)), "[MetalGPU] Buffers must be of the same content size"
-        assert(self.contents.dtype == other.contents.dtype), "[MetalGPU] Buffers must be of the same data type"
-
-        outBuffer = self.interface.create_buffer(len(self.contents), anyToMetal(self.contents.dtype))
-
-        mul_kernel = mul_func_kernel(self)
-
-        prevShader = self.interface.loaded_shader
-        shaderFromPath = self.interface.shader_from_path
-        prevFunction = self.interface.current_function
-        self.interface.load_shader_from_string(mul_kernel)
-        self.interface.set_function("mul")
-        self.interface.run_function(len(self.contents), [self, other, outBuffer])
-        self.interface.load_shader(prevShader) if shaderFromPath else self.interface.load_shader_from_string(prevShader)
-        self.interface.set_function(prevFunction)
-        return outBuffer
-
-    def astype(self, targetType) -> "Buffer":
-        new_buf = self.interface.create_buffer(len(self.contents), targetType)
-
-        cast_kernel = cast_func_kernel(self, targetType)
-
-        prevShader = self.interface.loaded_shader
-        shaderFromPath = self.interface.shader_from_path
-        prevFunction = self.interface.current_function
-        self.interface.load_shader_from_string(cast_kernel)
-
-        self.interface.set_function("cast")
-
-        self.interface.run_function(len(self.contents), [self, new_buf])
-        self.interface.load_shader(prevShader) if shaderFromPath else self.interface.load_shader_from_string(prevShader)
-        self.interface.set_function(prevFunction)
+    def broadcast_to(self, shape : tuple) -> "Buffer":
+        shape = tuple(shape)
+        assert(len(shape) >= self.ndim), f"[MetalGPU] Can't broadcast shape {self.shape} to {shape}"
+        # Broadcast dimensions get a stride of 0, so that every position along them reads the same element
+        lead = len(shape) - self.ndim
+        strides = [0] * lead
+        for dim, size, stride in zip(shape[lead:], self.shape, self.strides):
+            assert(size == dim or size == 1), f"[MetalGPU] Can't broadcast shape {self.shape} to {shape}"
+            strides.append(stride if size == dim else 0)
+        return self._view(shape, tuple(strides), self.offset)
+
+    def _binary(self, op : str, other, out : "Buffer | None" = None, reverse : bool = False) -> "Buffer | LazyBuffer":
+        other = as_operand(other, self.bufType)
+        left, right = (other, self) if reverse else (self, other)
+        if self.interface.lazy or isinstance(other, LazyBuffer):
+            result = LazyBuffer.binary(op, left, right)
+            return result if out is None else result.evaluate(out)
+
+        assert(self.bufType == other.bufType), "[MetalGPU] Buffers must be of the same data type"
+        left, right, shape = broadcast_operands(left, right)
+        if out is None:
+            out = self.interface.create_buffer(shape, anyToMetal(self.bufType), self.interface.output_storage)
+        assert(out.shape == shape and out.bufType == self.bufType), "[MetalGPU] Output buffer must be of the same shape and data type as the result"
+
+        generator = {"add": add_func_kernel, "sub": sub_func_kernel, "mul": mul_func_kernel}[op]
+        kernel = self.interface.get_kernel(generator(left, right, out), op)
+        # Passed explicitly, as the autotuner would run the kernel again on out, which can be one of the operands
+        kernel(out.size, [kernel_argument(left), kernel_argument(right), out], threads_per_group=kernel.maxThreadsPerGroup())
+        return out
+
+    def __add__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("add", other)
+
+    def __sub__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("sub", other)
+
+    def __mul__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("mul", other)
+
+    def __radd__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("add", other, reverse=True)
+
+    def __rsub__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("sub", other, reverse=True)
+
+    def __rmul__(self, other) -> "Buffer | LazyBuffer":
+        return self._binary("mul", other, reverse=True)
+
+    # In place operators write the result to the buffer itself, even when lazy, the whole expression then being fused into it
+    def __iadd__(self, other) -> "Buffer":
+        return self._binary("add", other, out=self)
+
+    def __isub__(self, other) -> "Buffer":
+        return self._binary("sub", other, out=self)
+
+    def __imul__(self, other) -> "Buffer":
+        return self._binary("mul", other, out=self)
+
+    def astype(self, targetType) -> "Buffer | LazyBuffer":
+        if self.interface.lazy:
+            return LazyBuffer.cast(self, targetType)
+        new_buf = self.interface.create_buffer(self.shape, targetType, self.interface.output_storage)
+
+        cast_kernel = self.interface.get_kernel(cast_func_kernel(self, targetType), "cast")
+        cast_kernel(self.size, [self, new_buf], threads_per_group=cast_kernel.maxThreadsPerGroup())
         return new_buf
@@ -0,0 +1,77 @@
+import asyncio
+import threading
+
+COMPLETION_PENDING = 0
+COMPLETION_DONE = 1
+COMPLETION_ERROR = 2
+
+
+class Completion:
+    def __init__(self, interface, completionNum : int) -> None:
+        self.interface = interface
+        self.completionNum = completionNum
+        self.__status = COMPLETION_PENDING
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+
+    def _set_status(self, status : int) -> None:
+        # Called from a Metal thread when the command buffer completes
+        with self.__lock:
+            if self.__status != COMPLETION_PENDING:
+                return
+            self.__status = status
+            callbacks = self.__callbacks
+            self.__callbacks = []
+        for callback in callbacks:
+            callback(self)
+
+    def done(self) -> bool:
+        if self.__status == COMPLETION_PENDING and self.completionNum is not None:
+            status = self.interface.completion_status(self.completionNum)
+            if status != COMPLETION_PENDING:
+                self._set_status(status)
+        return self.__status != COMPLETION_PENDING
+
+    def wait(self, timeout : float | None = None) -> bool:
+        if self.__status == COMPLETION_PENDING and self.completionNum is not None:
+            status = self.interface.wait_completion(self.completionNum, -1 if timeout is None else timeout)
+            if status != COMPLETION_PENDING:
+                self._set_status(status)
+        if self.__status == COMPLETION_ERROR:
+            raise RuntimeError("[MetalGPU] Command buffer execution failed")
+        return self.__status != COMPLETION_PENDING
+
+    def add_done_callback(self, callback) -> None:
+        with self.__lock:
+            if self.__status == COMPLETION_PENDING:
+                self.__callbacks.append(callback)
+                return
+        callback(self)
+
+    def __await__(self):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(completion):
+            if not future.done():
+                if completion.__status == COMPLETION_ERROR:
+                    future.set_exception(RuntimeError("[MetalGPU] Command buffer execution failed"))
+                else:
+                    future.set_result(None)
+
+        self.add_done_callback(lambda completion: loop.call_soon_threadsafe(resolve, completion))
+        return future.__await__()
+
+    def release(self) -> None:
+        if self.completionNum is not None:
+            self.interface.release_completion(self.completionNum)
+            self.completionNum = None
+
+    def __del__(self) -> None:
+        self.release()
+
+
+class Batch:
+    def __init__(self) -> None:
+        # Set when the batch is submitted without waiting for it
+        self.completion : Completion | None = None
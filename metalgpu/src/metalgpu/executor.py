@@ -0,0 +1,35 @@
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class DispatchExecutor(ThreadPoolExecutor):
+    def __init__(self, interface, max_workers: int | None = None) -> None:
+        self._interface = weakref.ref(interface)
+        # Workers mostly wait on the GPU, two per command queue keep every queue busy while the other one is encoding
+        if max_workers is None:
+            max_workers = 2 * interface.command_queues
+        super().__init__(max_workers=max_workers, thread_name_prefix="metalgpu")
+
+    @property
+    def interface(self):
+        interface = self._interface()
+        if interface is None:
+            raise ReferenceError("[MetalGPU] The interface this executor was created from has been deleted")
+        return interface
+
+    # The returned futures resolve once the GPU is done with the dispatch, the wait happening on the worker thread
+    def dispatch(self, kernel, received_size, buffers: list, threads_per_group=None) -> Future:
+        return self.submit(kernel, received_size, buffers, True, threads_per_group)
+
+    def run_prepared(self, prepared) -> Future:
+        return self.submit(prepared, True)
+
+    # Runs fn inside a batch of the worker thread, resolving to its result once the batch has completed
+    def batch(self, fn, *args, **kwargs) -> Future:
+        interface = self.interface
+
+        def run():
+            with interface.batch():
+                return fn(*args, **kwargs)
+
+        return self.submit(run)
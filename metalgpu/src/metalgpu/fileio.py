@@ -0,0 +1,84 @@
+import os
+
+import numpy as np
+import numpy.lib.format as npy
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .utils import anyToMetal, anyToNumpy, canWrapWithoutCopy
+
+
+def is_npy(path : str) -> bool:
+    return os.fspath(path).endswith(".npy")
+
+
+# Shape, data type, Fortran order and payload offset of a .npy file
+def read_npy_header(f) -> tuple[tuple, np.dtype, bool, int]:
+    version = npy.read_magic(f)
+    if version == (1, 0):
+        shape, fortran, dtype = npy.read_array_header_1_0(f)
+    elif version == (2, 0):
+        shape, fortran, dtype = npy.read_array_header_2_0(f)
+    else:
+        raise ValueError(f"[MetalGPU] Unsupported .npy format version {version[0]}.{version[1]}")
+    return tuple(shape), dtype, fortran, f.tell()
+
+
+def read_into(f, view : memoryview) -> None:
+    filled = 0
+    while filled < len(view):
+        count = f.readinto(view[filled:])
+        if not count:
+            raise ValueError(f"[MetalGPU] File ended after {filled} of {len(view)} bytes")
+        filled += count
+
+
+def load_buffer(interface, path : str, dtype=None, shape : int | tuple | None = None, offset : int = 0, copy : bool | None = None) -> Buffer:
+    # Unbuffered, so that the payload is read straight into the Metal buffer
+    with open(path, "rb", buffering=0) as f:
+        fortran = False
+        if is_npy(path):
+            shape, dtype, fortran, offset = read_npy_header(f)
+        else:
+            assert(dtype is not None), "[MetalGPU] Raw files need a data type"
+            dtype = np.dtype(dtype)
+            if shape is None:
+                shape = ((os.fstat(f.fileno()).st_size - offset) // dtype.itemsize,)
+            shape = tuple(shape) if isinstance(shape, (tuple, list)) else (shape,)
+        assert(dtype.isnative and dtype.names is None), f"[MetalGPU] Unsupported file data type {dtype}"
+        buftype = anyToMetal(dtype)
+        # Types only converting to a buffer type, such as float64 to float, would be read with the wrong element size
+        if np.dtype(anyToNumpy(buftype)) != dtype:
+            raise TypeError(f"[MetalGPU] No buffer type holds {dtype} data, convert the file to {np.dtype(anyToNumpy(buftype))} first")
+        # Fortran ordered payloads are the transpose of the C ordered array of reversed shape
+        storageShape = shape[::-1] if fortran else shape
+        nbytes = int(np.prod(storageShape)) * dtype.itemsize
+        assert(nbytes > 0), "[MetalGPU] Buffer size must be greater than 0"
+        assert(offset + nbytes <= os.fstat(f.fileno()).st_size), f"[MetalGPU] {path} is too small for {storageShape} elements of {dtype}"
+
+        buffer = None
+        # A copy on write mapping is wrapped without reading anything, pages being loaded as the GPU or CPU touches them
+        if copy is not True:
+            mapped = np.memmap(f, dtype=dtype, mode="c", offset=offset, shape=storageShape)
+            if canWrapWithoutCopy(mapped):
+                buffer = interface.array_to_buffer(mapped, copy=False)
+            elif copy is False:
+                raise ValueError("[MetalGPU] File can't be mapped without a copy, its payload must start on a page boundary and span whole pages")
+            del mapped
+
+        if buffer is None:
+            buffer = interface.create_buffer(storageShape, buftype)
+            f.seek(offset)
+            read_into(f, memoryview(buffer.storage.view(np.uint8))[:nbytes])
+    return buffer.T if fortran else buffer
+
+
+def save_buffer(buffer : Buffer | LazyBuffer, path : str) -> None:
+    if isinstance(buffer, LazyBuffer):
+        buffer = buffer.evaluate()
+    # Contiguous contents are written straight from the Metal buffer, views are written in C order
+    if is_npy(path):
+        with open(path, "wb") as f:
+            np.save(f, buffer.contents)
+    else:
+        buffer.contents.tofile(path)
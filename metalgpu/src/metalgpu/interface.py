@@ -2,10 +2,28 @@ import ctypes
 import numpy as np
 
 import os
+import platform
+import threading
+import time
+import weakref
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
 from .buffer import Buffer
-from .utils import anyToCtypes, anyToMetal, allowedCTypes, allowedNumpyTypes
+from .kernel import Kernel, PreparedDispatch
+from .completion import Completion, Batch
+from .lazy import LazyBuffer
+from .utils import anyToCtypes, anyToMetal, anyToNumpy, allowedCTypes, allowedNumpyTypes, pageAlignedArray, canWrapWithoutCopy, inlineBytes, PAGE_SIZE
 from .shader import initial_shader
+from .shader_cache import ShaderCache
+from .autotune import Autotuner, normalize_threads
+from .profiler import Profiler
+from .executor import DispatchExecutor
+from .streaming import stream_map
+from .fileio import load_buffer, save_buffer
+
+
+_CompletionCallback = ctypes.CFUNCTYPE(None, ctypes.c_int, ctypes.c_int)
 
 
 class MetalSize:
@@ -16,7 +34,8 @@ class MetalSize:
 
 
 class Interface:
-    def __init__(self) -> None:
+    def __init__(self, shader_cache_dir: str | None = None, shader_cache_size: int = 256 * 1024 * 1024, autotune_path: str | None = None, command_queues: int = 1) -> None:
+        assert platform.system() == "Darwin", "[MetalGPU] MetalGPU is only supported on macOS"
         _objPath = os.path.dirname(__file__)
 
         assert os.path.isfile(_objPath + "/lib/libmetalgpucpp-arm.dylib"), "[MetalGPU] Library not found, please run `python -m metalgpu build`"
@@ -26,117 +45,603 @@ class Interface:
         # Store the instance pointer returned by init
         self.__instance = self.__init()
 
+        self.__completions = weakref.WeakValueDictionary()
+        interfaceRef = weakref.ref(self)
+
+        def on_completion(completionNum, status):
+            interface = interfaceRef()
+            if interface is not None:
+                interface.__on_completion(completionNum, status)
+
+        # Kept on the interface, the native library only holds a pointer to it
+        self.__completionCallback = _CompletionCallback(on_completion)
+        self.__setCompletionCallback(self.__instance, self.__completionCallback)
+
+        # Guards the kernel cache, everything else is either guarded natively or kept per thread
+        self.__lock = threading.RLock()
+        self.__local = threading.local()
+        self.__kernels = OrderedDict()
+        self.__kernelCacheSize = 64
+        # Host memory of released wrapped buffers, with the serial of the last command that could use it, kept until that command completes
+        self.__pendingOwners = deque()
+        self.shader_cache = ShaderCache(shader_cache_dir, shader_cache_size) if shader_cache_dir is not None else None
+        # When set, buffer operators build an expression that is only compiled and run, as a single fused kernel, once its result is used
+        self.lazy = False
+        # Tuned threadgroup shapes are always used, new ones are only searched for while autotune is set
+        self.autotuner = Autotuner(autotune_path)
+        self.autotune = False
+        # Set by Interface.profile, every dispatch, batch and kernel compilation is then recorded
+        self.profiler = None
+        self.command_queues = 1
+        self.memory_budget = None
+        # Storage of the buffers created by operators, reductions, scans, sorts and matmul. Private ones move to shared storage once read
+        self.output_storage = "shared"
+        if command_queues != 1:
+            self.set_command_queues(command_queues)
+
         self.load_shader_from_string(initial_shader())
         self.set_function("emptyFunc")
 
     def __del__(self) -> None:
         if hasattr(self, '_Interface__instance') and self.__instance:
             self.__deleteInstance(self.__instance)
+            self.__instance = None
 
     def __init_functions(self) -> None:
         self.__init = self.__metal.init
         self.__createBuffer = self.__metal.createBuffer
-        self.__createLibrary = self.__metal.createLibrary
-        self.__setFunction = self.__metal.setFunction
-        self.__runFunction = self.__metal.runFunction
+        self.__createBufferNoCopy = self.__metal.createBufferNoCopy
         self.__releaseBuffer = self.__metal.releaseBuffer
         self.__getBufferPointer = self.__metal.getBufferPointer
         self.__deleteInstance = self.__metal.deleteInstance
         self.__createLibraryFromString = self.__metal.createLibraryFromString
-        self.__maxThreadsPerGroup = self.__metal.maxThreadsPerGroup
-        self.__threadExecutionWidth = self.__metal.threadExecutionWidth
+        self.__createLibraryFromBinary = self.__metal.createLibraryFromBinary
+        self.__setCacheCapacity = self.__metal.setCacheCapacity
+        self.__getCacheStats = self.__metal.getCacheStats
+        self.__createKernel = self.__metal.createKernel
+        self.__releaseKernel = self.__metal.releaseKernel
+        self.__runKernel = self.__metal.runKernel
+        self.__kernelMaxThreadsPerGroup = self.__metal.kernelMaxThreadsPerGroup
+        self.__kernelThreadExecutionWidth = self.__metal.kernelThreadExecutionWidth
+        self.__lastGPUTime = self.__metal.lastGPUTime
+        self.__getDispatchTimes = self.__metal.getDispatchTimes
+        self.__createDispatch = self.__metal.createDispatch
+        self.__runDispatch = self.__metal.runDispatch
+        self.__setDispatchBuffer = self.__metal.setDispatchBuffer
+        self.__setDispatchBytes = self.__metal.setDispatchBytes
+        self.__releaseDispatch = self.__metal.releaseDispatch
+        self.__getCompletionTimes = self.__metal.getCompletionTimes
+        self.__hostTime = self.__metal.hostTime
+        self.__beginBatch = self.__metal.beginBatch
+        self.__endBatch = self.__metal.endBatch
+        self.__completionStatus = self.__metal.completionStatus
+        self.__waitCompletion = self.__metal.waitCompletion
+        self.__releaseCompletion = self.__metal.releaseCompletion
+        self.__setCompletionCallback = self.__metal.setCompletionCallback
+        self.__setPoolLimits = self.__metal.setPoolLimits
+        self.__getPoolStats = self.__metal.getPoolStats
+        self.__setCommandQueues = self.__metal.setCommandQueues
+        self.__setMemoryBudget = self.__metal.setMemoryBudget
+        self.__getMemoryStats = self.__metal.getMemoryStats
+        self.__copyBuffer = self.__metal.copyBuffer
+        self.__setBufferStorage = self.__metal.setBufferStorage
+        self.__completedBefore = self.__metal.completedBefore
 
         # Update function signatures to include instance pointer
         self.__init.argtypes = []
-        self.__createBuffer.argtypes = [ctypes.c_void_p, ctypes.c_int]
-        self.__createLibrary.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-        self.__setFunction.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-        self.__runFunction.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_bool]
+        self.__createBuffer.argtypes = [ctypes.c_void_p, ctypes.c_long, ctypes.c_bool]
+        self.__createBufferNoCopy.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_long]
         self.__releaseBuffer.argtypes = [ctypes.c_void_p, ctypes.c_int]
         self.__getBufferPointer.argtypes = [ctypes.c_void_p, ctypes.c_int]
         self.__deleteInstance.argtypes = [ctypes.c_void_p]
         self.__createLibraryFromString.argtypes = [ctypes.c_void_p, ctypes.c_char_p]
-        self.__maxThreadsPerGroup.argtypes = [ctypes.c_void_p]
-        self.__threadExecutionWidth.argtypes = [ctypes.c_void_p]
+        self.__createLibraryFromBinary.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p]
+        self.__setCacheCapacity.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__getCacheStats.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_long)]
+        self.__createKernel.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p]
+        self.__releaseKernel.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__runKernel.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_bool]
+        self.__kernelMaxThreadsPerGroup.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__kernelThreadExecutionWidth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__lastGPUTime.argtypes = [ctypes.c_void_p]
+        self.__getDispatchTimes.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_double)]
+        self.__createDispatch.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int), ctypes.c_int, ctypes.c_char_p, ctypes.POINTER(ctypes.c_int), ctypes.POINTER(ctypes.c_int)]
+        self.__runDispatch.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_bool]
+        self.__setDispatchBuffer.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_int]
+        self.__setDispatchBytes.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+        self.__releaseDispatch.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__getCompletionTimes.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.POINTER(ctypes.c_double)]
+        self.__hostTime.argtypes = [ctypes.c_void_p]
+        self.__beginBatch.argtypes = [ctypes.c_void_p]
+        self.__endBatch.argtypes = [ctypes.c_void_p, ctypes.c_bool]
+        self.__completionStatus.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__waitCompletion.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_double]
+        self.__releaseCompletion.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__setCompletionCallback.argtypes = [ctypes.c_void_p, _CompletionCallback]
+        self.__setPoolLimits.argtypes = [ctypes.c_void_p, ctypes.c_long, ctypes.c_long]
+        self.__getPoolStats.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_long)]
+        self.__setCommandQueues.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        self.__setMemoryBudget.argtypes = [ctypes.c_void_p, ctypes.c_long]
+        self.__getMemoryStats.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_long)]
+        self.__copyBuffer.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_long, ctypes.c_int, ctypes.c_long, ctypes.c_long, ctypes.c_bool]
+        self.__setBufferStorage.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_bool]
+        self.__completedBefore.argtypes = [ctypes.c_void_p]
 
         # Return types
         self.__init.restype = ctypes.c_void_p  # Returns instance pointer
         self.__createBuffer.restype = ctypes.c_int
-        self.__createLibrary.restype = None
-        self.__setFunction.restype = None
-        self.__runFunction.restype = None
-        self.__releaseBuffer.restype = None
-        self.__getBufferPointer.restype = ctypes.POINTER(ctypes.c_int)
+        self.__createBufferNoCopy.restype = ctypes.c_int
+        self.__releaseBuffer.restype = ctypes.c_long
+        # Cast to the buffer's type by the caller, a shared restype could be changed by another thread in between
+        self.__getBufferPointer.restype = ctypes.c_void_p
         self.__deleteInstance.restype = None
         self.__createLibraryFromString.restype = None
-        self.__maxThreadsPerGroup.restype = int
-        self.__threadExecutionWidth.restype = int
+        self.__createLibraryFromBinary.restype = None
+        self.__setCacheCapacity.restype = None
+        self.__getCacheStats.restype = None
+        self.__createKernel.restype = ctypes.c_int
+        self.__releaseKernel.restype = None
+        self.__runKernel.restype = ctypes.c_int
+        self.__kernelMaxThreadsPerGroup.restype = int
+        self.__kernelThreadExecutionWidth.restype = int
+        self.__lastGPUTime.restype = ctypes.c_double
+        self.__getDispatchTimes.restype = None
+        self.__createDispatch.restype = ctypes.c_int
+        self.__runDispatch.restype = ctypes.c_int
+        self.__setDispatchBuffer.restype = None
+        self.__setDispatchBytes.restype = None
+        self.__releaseDispatch.restype = None
+        self.__getCompletionTimes.restype = None
+        self.__hostTime.restype = ctypes.c_double
+        self.__beginBatch.restype = None
+        self.__endBatch.restype = ctypes.c_int
+        self.__completionStatus.restype = ctypes.c_int
+        self.__waitCompletion.restype = ctypes.c_int
+        self.__releaseCompletion.restype = None
+        self.__setCompletionCallback.restype = None
+        self.__setPoolLimits.restype = None
+        self.__getPoolStats.restype = None
+        self.__setCommandQueues.restype = None
+        self.__setMemoryBudget.restype = None
+        self.__getMemoryStats.restype = None
+        self.__copyBuffer.restype = ctypes.c_int
+        self.__setBufferStorage.restype = ctypes.c_int
+        self.__completedBefore.restype = ctypes.c_long
 
-    def create_buffer(self, bufsize: int, buffer_type: str | allowedNumpyTypes | allowedCTypes) -> "Buffer":
+    def create_buffer(self, bufsize: int | tuple, buffer_type: str | allowedNumpyTypes | allowedCTypes, storage: str = "shared") -> "Buffer":
+        shape = tuple(bufsize) if isinstance(bufsize, (tuple, list)) else (bufsize,)
+        bufsize = int(np.prod(shape))
         assert bufsize > 0, "[MetalGPU] Buffer size must be greater than 0"
+        assert storage in ("shared", "private"), f"[MetalGPU] Unknown storage {storage}, must be shared or private"
         bufType = anyToCtypes(buffer_type)
-        number = self.__createBuffer(self.__instance, ctypes.sizeof(bufType) * bufsize)
-        self.__getBufferPointer.restype = ctypes.POINTER(bufType)
-        buffPointer = self.__getBufferPointer(self.__instance, number)
-        buff = Buffer(buffPointer, bufsize, self, number)
+        number = self.__createBuffer(self.__instance, ctypes.sizeof(bufType) * bufsize, storage == "private")
+        if number == -1:
+            budget = f", the memory budget is {self.memory_budget} bytes" if self.memory_budget is not None else ""
+            raise MemoryError(f"[MetalGPU] Couldn't allocate a buffer of {ctypes.sizeof(bufType) * bufsize} bytes{budget}")
+        buffPointer = ctypes.cast(self.__getBufferPointer(self.__instance, number), ctypes.POINTER(bufType)) if storage == "shared" else None
+        buff = Buffer(buffPointer, bufsize, self, number, shape=shape, dtype=anyToNumpy(buffer_type))
         return buff
 
+    def set_buffer_storage(self, bufnum: int, private: bool, buffer_type: str | allowedNumpyTypes | allowedCTypes):
+        # Returns the new pointer of a buffer moved to shared storage
+        result = self.__setBufferStorage(self.__instance, bufnum, private)
+        if result == -2:
+            raise RuntimeError("[MetalGPU] The buffer is used by a batch that hasn't been submitted yet, its storage can only change, and a private buffer only be read, once the batch ends")
+        if result == -1:
+            raise MemoryError("[MetalGPU] Couldn't change the storage of the buffer")
+        if private:
+            return None
+        return ctypes.cast(self.__getBufferPointer(self.__instance, bufnum), ctypes.POINTER(anyToCtypes(buffer_type)))
+
+    def copy_buffer(self, source: Buffer, destination: Buffer, wait_for_completion: bool = True) -> Completion | None:
+        # Blit copy on the GPU, either buffer may be private
+        assert(source.is_contiguous() and destination.is_contiguous()), "[MetalGPU] Only contiguous buffers can be copied"
+        assert(source.nbytes == destination.nbytes), f"[MetalGPU] Can't copy {source.nbytes} bytes into a buffer of {destination.nbytes} bytes"
+        return self.__completion(self.__copyBuffer(self.__instance, source.bufNum, 0, destination.bufNum, 0, source.nbytes, wait_for_completion))
+
+    def upload(self, buffer: Buffer, data: Buffer | np.ndarray | list, wait_for_completion: bool = True) -> Completion | None:
+        if not isinstance(data, Buffer):
+            data = np.asarray(data, dtype=buffer.bufType)
+            assert(data.size == buffer.size), f"[MetalGPU] Can't upload {data.size} elements into a buffer of {buffer.size}"
+            # Staged in a pooled buffer, which is only reused once the copy has completed
+            staging = self.create_buffer(buffer.shape, anyToMetal(buffer.bufType))
+            staging.contents[...] = data.reshape(buffer.shape)
+            completion = self.copy_buffer(staging, buffer, wait_for_completion)
+            staging.release()
+            return completion
+        return self.copy_buffer(data, buffer, wait_for_completion)
+
+    def download(self, buffer: Buffer, out: Buffer, wait_for_completion: bool = True) -> Completion | None:
+        assert(not out.private), "[MetalGPU] Downloads must go to a shared buffer"
+        return self.copy_buffer(buffer, out, wait_for_completion)
+
     def load_shader(self, shader_path: str) -> None:
-        self.__createLibrary(self.__instance, shader_path.encode('utf-8'))
+        with open(shader_path) as f:
+            self.load_shader_from_string(f.read())
         self.loaded_shader = shader_path
         self.shader_from_path = True
 
     def set_function(self, function_name: str) -> None:
-        self.__setFunction(self.__instance, function_name.encode('utf-8'))
+        # Resolved to a kernel of the shader this thread loaded, and kept per thread, so that threads never run each other's functions
+        source = getattr(self.__local, "shader", self.__shader)
+        kernel = self.get_kernel(source, function_name)
+        self.__local.function = kernel
+        # Threads that never set a function use the last one set by any thread
+        self.__function = kernel
         self.current_function = function_name
 
-    def run_function(self, received_size: int | MetalSize, buffers: list[Buffer], function_name: str | None = None, wait_for_completion : bool = True) -> None:
+    def __current_kernel(self) -> Kernel:
+        return getattr(self.__local, "function", self.__function)
+
+    def get_kernel(self, shader_string: str, function_name: str) -> Kernel:
+        key = (shader_string, function_name)
+        # Held while compiling, so that threads asking for the same kernel compile it once
+        with self.__lock:
+            kernel = self.__kernels.get(key)
+            if kernel is not None:
+                self.__kernels.move_to_end(key)
+                return kernel
+
+            start = time.perf_counter()
+            number = self.__createKernel(self.__instance, shader_string.encode('utf-8'), self.__cached_binary(shader_string), function_name.encode('utf-8'))
+            if self.profiler is not None:
+                self.profiler.compile(f"compile {function_name}", start, time.perf_counter())
+            if number == -1:
+                raise RuntimeError(f"[MetalGPU] Couldn't create kernel {function_name}")
+            kernel = Kernel(self, number, function_name, shader_string)
+
+            self.__kernels[key] = kernel
+            while len(self.__kernels) > self.__kernelCacheSize:
+                self.__kernels.popitem(last=False)
+            return kernel
+
+    def release_kernel(self, kernelnum: int) -> None:
+        if self.__instance:
+            self.__releaseKernel(self.__instance, kernelnum)
+
+    def run_function(self, received_size: int | MetalSize, buffers: list[Buffer | LazyBuffer], function_name: str | Kernel | None = None, wait_for_completion : bool = True, threads_per_group: int | tuple | MetalSize | None = None) -> Completion | None:
+        start = time.perf_counter() if self.profiler is not None else 0
         if isinstance(received_size, int):
             received_size = MetalSize(received_size, 1, 1)
 
-        if function_name is not None:
-            self.set_function(function_name)
+        if isinstance(function_name, Kernel):
+            kernel = function_name
+        else:
+            if function_name is not None:
+                self.set_function(function_name)
+            kernel = self.__current_kernel()
 
+        bufferArr, inlineData, inlineSizes = self.__arguments(buffers)
+        metalSize = np.array([received_size.width, received_size.height, received_size.depth]).astype(np.int32)
+
+        metalSizePointer = metalSize.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+        bufferPointer = bufferArr.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+        inlinePointer = inlineSizes.ctypes.data_as(ctypes.POINTER(ctypes.c_int)) if inlineSizes is not None else None
+
+        threadsPointer = None
+        threads = self.__threads(kernel, received_size, buffers, threads_per_group)
+        if threads is not None:
+            threadsArr = np.array(threads).astype(np.int32)
+            threadsPointer = threadsArr.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+
+        marshalEnd = time.perf_counter() if self.profiler is not None else 0
+        completionNum = self.__runKernel(self.__instance, kernel.kernelNum, metalSizePointer, bufferPointer, len(bufferArr), inlineData, inlinePointer, threadsPointer, wait_for_completion)
+        completion = self.__completion(completionNum)
+
+        if self.profiler is not None:
+            end = time.perf_counter()
+            bufferBytes = sum(buff.nbytes for buff in buffers if isinstance(buff, Buffer))
+            name = kernel.function_name
+            grid = (received_size.width, received_size.height, received_size.depth)
+            batched = self.__batch_depth() > 0
+            self.profiler.dispatch(name, grid, threads, bufferBytes, start, marshalEnd, end, self.dispatch_times(), completion, batched, wait_for_completion and not batched)
+        return completion
+
+    def __arguments(self, buffers: list) -> tuple[np.ndarray, bytes | None, np.ndarray | None]:
+        # Buffer numbers, then the packed bytes and per slot sizes of inline arguments, both None if there are none
         bufferList = []
-        for buff in buffers:
+        inlineList = None
+        for index, buff in enumerate(buffers):
             if buff is None:
                 bufferList.append(-1)
             elif isinstance(buff, Buffer):
                 bufferList.append(buff.bufNum)
+            elif isinstance(buff, LazyBuffer):
+                bufferList.append(buff.evaluate().bufNum)
             else:
-                raise Exception("Unsupported buffer type")
+                data = inlineBytes(buff)
+                if data is None:
+                    raise Exception("Unsupported buffer type")
+                if inlineList is None:
+                    inlineList = [b""] * len(buffers)
+                inlineList[index] = data
+                bufferList.append(-1)
 
         bufferArr = np.array(bufferList).astype(np.int32)
+        if inlineList is None:
+            return bufferArr, None, None
+        return bufferArr, b"".join(inlineList), np.array([len(data) for data in inlineList]).astype(np.int32)
+
+    def __threads(self, kernel: Kernel, received_size: MetalSize, buffers: list, threads_per_group) -> tuple[int, int, int] | None:
+        if threads_per_group is None and kernel is not None:
+            threads_per_group = self.autotuner.lookup(kernel, received_size)
+            # Tuning waits on every candidate run, which a batch can't do
+            if threads_per_group is None and self.autotune and self.__batch_depth() == 0:
+                threads_per_group = self.autotuner.tune(self, kernel, received_size, buffers)
+        if threads_per_group is None:
+            return None
+        threads = normalize_threads(threads_per_group)
+        assert(threads[0] * threads[1] * threads[2] <= self.maxThreadsPerGroup(kernel)), f"[MetalGPU] Threads per group {threads} exceed the maximum of {self.maxThreadsPerGroup(kernel)}"
+        return threads
+
+    def prepare(self, kernel: Kernel, received_size: int | MetalSize, buffers: list[Buffer | LazyBuffer], threads_per_group: int | tuple | MetalSize | None = None) -> PreparedDispatch:
+        assert(isinstance(kernel, Kernel)), "[MetalGPU] Only kernels from Interface.get_kernel can be prepared"
+        if isinstance(received_size, int):
+            received_size = MetalSize(received_size, 1, 1)
+        buffers = [buff.evaluate() if isinstance(buff, LazyBuffer) else buff for buff in buffers]
+
+        bufferArr, inlineData, inlineSizes = self.__arguments(buffers)
         metalSize = np.array([received_size.width, received_size.height, received_size.depth]).astype(np.int32)
+        threads = self.__threads(kernel, received_size, buffers, threads_per_group)
+        threadsArr = np.array(threads).astype(np.int32) if threads is not None else None
 
-        metalSizePointer = metalSize.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
-        bufferPointer = bufferArr.ctypes.data_as(ctypes.POINTER(ctypes.c_int))
+        number = self.__createDispatch(self.__instance, kernel.kernelNum, metalSize.ctypes.data_as(ctypes.POINTER(ctypes.c_int)), bufferArr.ctypes.data_as(ctypes.POINTER(ctypes.c_int)), len(bufferArr),
+                                       inlineData, inlineSizes.ctypes.data_as(ctypes.POINTER(ctypes.c_int)) if inlineSizes is not None else None,
+                                       threadsArr.ctypes.data_as(ctypes.POINTER(ctypes.c_int)) if threadsArr is not None else None)
+        return PreparedDispatch(self, number, kernel, tuple(int(dim) for dim in metalSize), buffers, threads)
 
-        self.__runFunction(self.__instance, metalSizePointer, bufferPointer, len(bufferArr), wait_for_completion)
+    def run_prepared(self, prepared: PreparedDispatch, wait_for_completion: bool = True) -> Completion | None:
+        if self.profiler is None:
+            return self.__completion(self.__runDispatch(self.__instance, prepared.dispatchNum, wait_for_completion))
 
-    def release_buffer(self, bufnum: int) -> None:
-        self.__releaseBuffer(self.__instance, bufnum)
+        start = time.perf_counter()
+        completion = self.__completion(self.__runDispatch(self.__instance, prepared.dispatchNum, wait_for_completion))
+        bufferBytes = sum(buff.nbytes for buff in prepared.buffers if isinstance(buff, Buffer))
+        batched = self.__batch_depth() > 0
+        # Arguments were marshalled when the dispatch was prepared
+        self.profiler.dispatch(prepared.kernel.function_name, prepared.grid, prepared.threads, bufferBytes, start, start, time.perf_counter(), self.dispatch_times(), completion, batched, wait_for_completion and not batched)
+        return completion
 
-    def array_to_buffer(self, array: np.ndarray | list) -> "Buffer":
-        array = np.array(array)
-        if array.ndim != 1:
-            array = array.flatten()
+    def set_dispatch_buffer(self, dispatchnum: int, index: int, bufnum: int) -> None:
+        self.__setDispatchBuffer(self.__instance, dispatchnum, index, bufnum)
 
+    def set_dispatch_bytes(self, dispatchnum: int, index: int, data: bytes) -> None:
+        self.__setDispatchBytes(self.__instance, dispatchnum, index, data, len(data))
+
+    def release_dispatch(self, dispatchnum: int) -> None:
+        if self.__instance:
+            self.__releaseDispatch(self.__instance, dispatchnum)
+
+    def __batch_depth(self) -> int:
+        return getattr(self.__local, "batchDepth", 0)
+
+    def batching(self) -> bool:
+        # Whether this thread is inside Interface.batch, its dispatches then only running once the outermost batch ends
+        return self.__batch_depth() > 0
+
+    @contextmanager
+    def batch(self, wait_for_completion: bool = True):
+        # Every run_function call inside the block, from this thread, is encoded into one command buffer, submitted once on exit
+        batch = Batch()
+        profiler = self.profiler if self.__batch_depth() == 0 else None
+        if profiler is not None:
+            start, firstRecord = time.perf_counter(), len(profiler.records)
+        self.__beginBatch(self.__instance)
+        self.__local.batchDepth = self.__batch_depth() + 1
+        try:
+            yield batch
+        finally:
+            self.__local.batchDepth -= 1
+            batch.completion = self.__completion(self.__endBatch(self.__instance, wait_for_completion))
+            if profiler is not None:
+                thread = threading.get_ident()
+                dispatches = sum(1 for record in profiler.records[firstRecord:] if record["type"] == "dispatch" and record["thread"] == thread)
+                profiler.batch(dispatches, start, time.perf_counter(), self.dispatch_times(), batch.completion, wait_for_completion)
+
+    def __completion(self, completionNum: int) -> Completion | None:
+        if completionNum == -1:
+            return None
+        completion = Completion(self, completionNum)
+        self.__completions[completionNum] = completion
+        # The command buffer may have completed before the completion was registered
+        completion.done()
+        return completion
+
+    def __on_completion(self, completionNum: int, status: int) -> None:
+        completion = self.__completions.get(completionNum)
+        if completion is not None:
+            completion._set_status(status)
+
+    def completion_status(self, completionnum: int) -> int:
+        return self.__completionStatus(self.__instance, completionnum)
+
+    def wait_completion(self, completionnum: int, timeout: float) -> int:
+        return self.__waitCompletion(self.__instance, completionnum, timeout)
+
+    def release_completion(self, completionnum: int) -> None:
+        if self.__instance:
+            self.__releaseCompletion(self.__instance, completionnum)
+
+    def release_buffer(self, bufnum: int, owner: np.ndarray | None = None) -> None:
+        if self.__instance:
+            serial = self.__releaseBuffer(self.__instance, bufnum)
+            # Batched or asynchronous commands may still read or write the memory of a wrapped buffer
+            if owner is not None and serial != -1:
+                with self.__lock:
+                    self.__pendingOwners.append((serial, owner))
+            self.__drop_owners()
+
+    def __drop_owners(self) -> None:
+        if not self.__pendingOwners:
+            return
+        completed = self.__completedBefore(self.__instance)
+        with self.__lock:
+            while self.__pendingOwners and self.__pendingOwners[0][0] < completed:
+                self.__pendingOwners.popleft()
+
+    def array_to_buffer(self, array: np.ndarray | list, copy: bool | None = None) -> "Buffer":
+        array = np.asarray(array)
+        if array.ndim == 0:
+            array = array.reshape(1)
         buftype = anyToMetal(array.dtype)
 
-        buffer = self.create_buffer(len(array), buftype)
+        # dtypes without a table of their own match the type they can be converted to, such as float64 for "float", those must be copied
+        if copy is not True and np.dtype(anyToNumpy(buftype)) == array.dtype and canWrapWithoutCopy(array):
+            return self.__wrap_array(array)
+        if copy is False:
+            raise ValueError("[MetalGPU] Array can't be used without a copy, it must be writeable, contiguous and page aligned")
 
-        buffer.contents[:] = array
+        buffer = self.create_buffer(array.shape, buftype)
+        buffer.contents[...] = array
         return buffer
 
+    def __wrap_array(self, array: np.ndarray) -> "Buffer":
+        self.__drop_owners()
+        bufType = anyToCtypes(array.dtype)
+        length = -(-array.nbytes // PAGE_SIZE) * PAGE_SIZE
+        number = self.__createBufferNoCopy(self.__instance, array.ctypes.data, length)
+        if number == -1:
+            raise MemoryError("[MetalGPU] Couldn't wrap array in a buffer")
+        buffPointer = ctypes.cast(self.__getBufferPointer(self.__instance, number), ctypes.POINTER(bufType))
+        return Buffer(buffPointer, array.size, self, number, owner=array, shape=array.shape, dtype=array.dtype)
+
+    def load_buffer(self, path: str, dtype: str | allowedNumpyTypes | allowedCTypes | None = None, shape: int | tuple | None = None, offset: int = 0, copy: bool | None = None) -> "Buffer":
+        # .npy files describe their own shape and type, any other file is raw data of the given type
+        return load_buffer(self, path, dtype, shape, offset, copy)
+
+    def save_buffer(self, buffer: Buffer | LazyBuffer, path: str) -> None:
+        save_buffer(buffer, path)
+
+    def aligned_array(self, shape: int | tuple, dtype: str | allowedNumpyTypes | allowedCTypes) -> np.ndarray:
+        # Arrays from here can always be turned into buffers without a copy
+        return pageAlignedArray(shape, anyToNumpy(dtype))
+
+    def __cached_binary(self, shader_string: str) -> bytes | None:
+        if self.shader_cache is None:
+            return None
+        path = self.shader_cache.get(shader_string)
+        return path.encode('utf-8') if path is not None else None
+
     def load_shader_from_string(self, shader_string: str) -> None:
-        self.__createLibraryFromString(self.__instance, shader_string.encode('utf-8'))
+        start = time.perf_counter()
+        if self.shader_cache is not None:
+            self.__createLibraryFromBinary(self.__instance, shader_string.encode('utf-8'), self.__cached_binary(shader_string))
+        else:
+            self.__createLibraryFromString(self.__instance, shader_string.encode('utf-8'))
+        if self.profiler is not None:
+            self.profiler.compile("load shader", start, time.perf_counter())
+        # Functions are looked up in the shader the calling thread loaded, or in the last one loaded by any thread
+        self.__local.shader = shader_string
+        self.__shader = shader_string
         self.loaded_shader = shader_string
         self.shader_from_path = False
 
-    def threadExecutionWidth(self):
-        return self.__threadExecutionWidth(self.__instance)
+    def threadExecutionWidth(self, kernel: Kernel | None = None):
+        kernel = kernel if kernel is not None else self.__current_kernel()
+        return self.__kernelThreadExecutionWidth(self.__instance, kernel.kernelNum)
+
+    @contextmanager
+    def profile(self):
+        # Records everything run inside the block, the profiler stays usable once the block exits
+        profiler = Profiler(self)
+        previous = self.profiler
+        self.profiler = profiler
+        try:
+            yield profiler
+        finally:
+            self.profiler = previous
+
+    def dispatch_times(self) -> list[float]:
+        # Encoding time of the last dispatch, then GPU start and end timestamps of the last command buffer waited on
+        times = (ctypes.c_double * 3)()
+        self.__getDispatchTimes(self.__instance, times)
+        return list(times)
+
+    def completion_times(self, completionnum: int) -> tuple[float, float]:
+        times = (ctypes.c_double * 2)()
+        self.__getCompletionTimes(self.__instance, completionnum, times)
+        return times[0], times[1]
+
+    def host_time(self) -> float:
+        # Current time on the clock of command buffer timestamps
+        return self.__hostTime(self.__instance)
+
+    def last_gpu_time(self) -> float:
+        # In seconds, for the last command buffer that was waited on
+        return self.__lastGPUTime(self.__instance)
+
+    def maxThreadsPerGroup(self, kernel: Kernel | None = None):
+        kernel = kernel if kernel is not None else self.__current_kernel()
+        return self.__kernelMaxThreadsPerGroup(self.__instance, kernel.kernelNum)
+
+    def set_cache_size(self, cache_size: int) -> None:
+        assert cache_size > 0, "[MetalGPU] Cache size must be greater than 0"
+        self.__setCacheCapacity(self.__instance, cache_size)
+        with self.__lock:
+            self.__kernelCacheSize = cache_size
+            while len(self.__kernels) > self.__kernelCacheSize:
+                self.__kernels.popitem(last=False)
+
+    def cache_stats(self) -> dict:
+        stats = (ctypes.c_long * 6)()
+        self.__getCacheStats(self.__instance, stats)
+        return {
+            "library_hits": stats[0],
+            "library_misses": stats[1],
+            "pipeline_hits": stats[2],
+            "pipeline_misses": stats[3],
+            "libraries": stats[4],
+            "pipelines": stats[5],
+        }
+
+    def set_pool_limits(self, max_bytes: int, max_buffer_size: int) -> None:
+        assert max_bytes >= 0 and max_buffer_size >= 0, "[MetalGPU] Pool limits must be positive"
+        self.__setPoolLimits(self.__instance, max_bytes, max_buffer_size)
+
+    def pool_stats(self) -> dict:
+        stats = (ctypes.c_long * 7)()
+        self.__getPoolStats(self.__instance, stats)
+        return {
+            "hits": stats[0],
+            "misses": stats[1],
+            "pooled_buffers": stats[2],
+            "pooled_bytes": stats[3],
+            "live_buffers": stats[4],
+            "slots": stats[5],
+            "free_slots": stats[6],
+        }
+
+    def set_memory_budget(self, max_bytes: int | None) -> None:
+        # Allocations that would take the buffers held by the interface above max_bytes first free pooled buffers, and fail if that isn't enough
+        assert max_bytes is None or max_bytes > 0, "[MetalGPU] Memory budget must be greater than 0"
+        self.__setMemoryBudget(self.__instance, max_bytes if max_bytes is not None else 0)
+        self.memory_budget = max_bytes
+
+    def memory_stats(self) -> dict:
+        stats = (ctypes.c_long * 10)()
+        self.__getMemoryStats(self.__instance, stats)
+        return {
+            "live_buffers": stats[0],
+            "live_bytes": stats[1],
+            "wrapped_bytes": stats[2],
+            "pooled_bytes": stats[3],
+            "allocated_bytes": stats[4],
+            "peak_bytes": stats[5],
+            "budget": stats[6] if stats[6] > 0 else None,
+            "evicted_bytes": stats[7],
+            "device_allocated_bytes": stats[8],
+            "recommended_working_set": stats[9],
+        }
+
+    def set_command_queues(self, count: int) -> None:
+        # Threads are spread over count command queues, so that command buffers from different threads can run concurrently
+        assert count > 0, "[MetalGPU] Command queue count must be greater than 0"
+        self.__setCommandQueues(self.__instance, count)
+        self.command_queues = count
 
-    def maxThreadsPerGroup(self):
-        return self.__maxThreadsPerGroup(self.__instance)
+    def executor(self, max_workers: int | None = None) -> DispatchExecutor:
+        return DispatchExecutor(self, max_workers)
 
+    def stream_map(self, kernel: Kernel, source, chunk_size: int, out_dtype=None, args: tuple | list = (), stages: int = 2, threads_per_group: int | tuple | MetalSize | None = None):
+        # Generator of the results of kernel over source, chunk_size rows at a time
+        return stream_map(kernel, source, chunk_size, out_dtype, args, stages, threads_per_group)
@@ -0,0 +1,84 @@
+import weakref
+
+from .utils import inlineBytes
+
+
+class Kernel:
+    def __init__(self, interface, kernelNum : int, function_name : str, source : str = "") -> None:
+        # Interfaces cache their kernels, a weak reference avoids a reference cycle that would delay `del interface`
+        self._interface = weakref.ref(interface)
+        self.kernelNum = kernelNum
+        self.function_name = function_name
+        self.source = source
+        # Set by the autotuner the first time it looks this kernel up
+        self._tune_key = None
+
+    @property
+    def interface(self):
+        interface = self._interface()
+        if interface is None:
+            raise ReferenceError("[MetalGPU] The interface this kernel was created from has been deleted")
+        return interface
+
+    def __call__(self, received_size, buffers : list, wait_for_completion : bool = True, threads_per_group=None):
+        return self.interface.run_function(received_size, buffers, self, wait_for_completion, threads_per_group)
+
+    def release(self) -> None:
+        interface = self._interface()
+        if interface is not None and self.kernelNum is not None:
+            interface.release_kernel(self.kernelNum)
+        self.kernelNum = None
+
+    def __del__(self) -> None:
+        self.release()
+
+    def threadExecutionWidth(self) -> int:
+        return self.interface.threadExecutionWidth(self)
+
+    def maxThreadsPerGroup(self) -> int:
+        return self.interface.maxThreadsPerGroup(self)
+
+    def prepare(self, received_size, buffers : list, threads_per_group=None) -> "PreparedDispatch":
+        return self.interface.prepare(self, received_size, buffers, threads_per_group)
+
+
+class PreparedDispatch:
+    def __init__(self, interface, dispatchNum : int, kernel : Kernel, grid : tuple, buffers : list, threads : tuple | None) -> None:
+        self._interface = weakref.ref(interface)
+        self.dispatchNum = dispatchNum
+        self.kernel = kernel
+        self.grid = grid
+        self.threads = threads
+        # Bound buffers are kept alive for as long as the dispatch can use them
+        self.buffers = list(buffers)
+
+    @property
+    def interface(self):
+        interface = self._interface()
+        if interface is None:
+            raise ReferenceError("[MetalGPU] The interface this dispatch was prepared on has been deleted")
+        return interface
+
+    def __call__(self, wait_for_completion : bool = True):
+        return self.interface.run_prepared(self, wait_for_completion)
+
+    def rebind(self, index : int, buffer) -> None:
+        assert(0 <= index < len(self.buffers)), f"[MetalGPU] Buffer index {index} out of range, the dispatch has {len(self.buffers)} buffers"
+        if hasattr(buffer, "evaluate"):
+            buffer = buffer.evaluate()
+        data = inlineBytes(buffer) if buffer is not None and not hasattr(buffer, "bufNum") else None
+        if data is not None:
+            self.interface.set_dispatch_bytes(self.dispatchNum, index, data)
+        else:
+            self.interface.set_dispatch_buffer(self.dispatchNum, index, buffer.bufNum if buffer is not None else -1)
+        self.buffers[index] = buffer
+
+    def release(self) -> None:
+        interface = self._interface()
+        if interface is not None and self.dispatchNum is not None:
+            interface.release_dispatch(self.dispatchNum)
+        self.dispatchNum = None
+        self.buffers = []
+
+    def __del__(self) -> None:
+        self.release()
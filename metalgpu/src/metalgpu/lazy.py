@@ -0,0 +1,158 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .utils import anyToMetal, anyToNumpy, Scalar
+from .shader import fused_func_kernel, element_index, math_call, convert
+
+_binary_ops = {"add": "+", "sub": "-", "mul": "*"}
+_unary_ops = {"sqrt": "sqrt", "cos": "cos", "sin": "sin", "tan": "tan"}
+
+# Generated sources, keyed by expression shape and data types, so that codegen only runs once per shape
+_fused_sources = OrderedDict()
+_fused_sources_size = 256
+_fused_sources_lock = threading.Lock()
+
+
+# Scalars take the other operand's data type, and are passed to the kernel inline rather than through a buffer
+def as_operand(value, dtype):
+    if not isinstance(value, (int, float, bool, np.generic)):
+        return value
+    return Scalar(value, dtype)
+
+
+# Bound in place of a buffer in the arguments of a kernel, scalars by their value
+def kernel_argument(operand):
+    return operand.value if isinstance(operand, Scalar) else operand
+
+
+def broadcast_to(node, shape : tuple):
+    # Every thread reads the same scalar, which needs no strides
+    if node.shape == shape or isinstance(node, Scalar):
+        return node
+    if isinstance(node, LazyBuffer):
+        node = node.evaluate()
+    return node.broadcast_to(shape)
+
+
+def broadcast_operands(left, right) -> tuple:
+    try:
+        shape = tuple(np.broadcast_shapes(left.shape, right.shape))
+    except ValueError:
+        raise ValueError(f"[MetalGPU] Shapes {left.shape} and {right.shape} can't be broadcast together") from None
+    return broadcast_to(left, shape), broadcast_to(right, shape), shape
+
+
+class LazyBuffer:
+    def __init__(self, interface, op : str, inputs : tuple, shape : tuple, dtype) -> None:
+        self.interface = interface
+        self.op = op
+        self.inputs = inputs
+        self.shape = shape
+        self.size = int(np.prod(shape))
+        self.bufType = np.dtype(dtype)
+        self.__result = None
+
+    @staticmethod
+    def binary(op : str, left, right) -> "LazyBuffer":
+        assert(left.bufType == right.bufType), "[MetalGPU] Buffers must be of the same data type"
+        left, right, shape = broadcast_operands(left, right)
+        interface = right.interface if isinstance(left, Scalar) else left.interface
+        return LazyBuffer(interface, op, (left, right), shape, left.bufType)
+
+    @staticmethod
+    def unary(op : str, operand) -> "LazyBuffer":
+        return LazyBuffer(operand.interface, op, (operand,), operand.shape, operand.bufType)
+
+    @staticmethod
+    def cast(operand, targetType) -> "LazyBuffer":
+        return LazyBuffer(operand.interface, "cast", (operand,), operand.shape, anyToNumpy(targetType))
+
+    @property
+    def contents(self) -> np.ndarray:
+        return self.evaluate().contents
+
+    def evaluate(self, out=None):
+        if self.__result is not None and out is None:
+            return self.__result
+
+        leaves = []
+        leafIndices = {}
+        expression, shape = self.__build(self, leaves, leafIndices)
+
+        if out is not None:
+            assert(out.shape == self.shape and out.bufType == self.bufType), "[MetalGPU] Output buffer must be of the same shape and data type as the result"
+        outBuffer = out if out is not None else self.interface.create_buffer(self.shape, anyToMetal(self.bufType), self.interface.output_storage)
+        outIndex = element_index(outBuffer)
+
+        key = (shape, anyToMetal(self.bufType), outIndex)
+        with _fused_sources_lock:
+            source = _fused_sources.get(key)
+            if source is None:
+                source = fused_func_kernel(expression, leaves, anyToMetal(self.bufType), outIndex)
+                _fused_sources[key] = source
+                while len(_fused_sources) > _fused_sources_size:
+                    _fused_sources.popitem(last=False)
+            else:
+                _fused_sources.move_to_end(key)
+
+        fused_kernel = self.interface.get_kernel(source, "fused")
+        # The output can be one of the leaves, the kernel must never be rerun by the autotuner
+        fused_kernel(self.size, [kernel_argument(leaf) for leaf in leaves] + [outBuffer], threads_per_group=fused_kernel.maxThreadsPerGroup())
+
+        self.__result = outBuffer
+        # Intermediate nodes and their inputs can be freed as soon as the result exists
+        self.inputs = ()
+        return outBuffer
+
+    def __build(self, node, leaves : list, leafIndices : dict) -> tuple[str, str]:
+        if isinstance(node, LazyBuffer) and node.__result is not None:
+            node = node.__result
+
+        if not isinstance(node, LazyBuffer):
+            if id(node) not in leafIndices:
+                leafIndices[id(node)] = len(leaves)
+                leaves.append(node)
+            index = leafIndices[id(node)]
+            if isinstance(node, Scalar):
+                return f"in{index}", f"{index}:{anyToMetal(node.bufType)}&"
+            # The leaf layout is part of the generated source, and thus of the expression shape
+            position = element_index(node)
+            return f"in{index}[{position}]", f"{index}:{anyToMetal(node.bufType)}[{position}]"
+
+        metalType = anyToMetal(node.bufType)
+        operands = [self.__build(child, leaves, leafIndices) for child in node.inputs]
+        shape = f"{node.op}:{metalType}({','.join(operand[1] for operand in operands)})"
+
+        # Every node is converted back to its own type, so that fusing never changes the result of intermediate overflows
+        if node.op in _binary_ops:
+            expression = f"static_cast<{metalType}>({operands[0][0]} {_binary_ops[node.op]} {operands[1][0]})"
+        elif node.op in _unary_ops:
+            expression = f"static_cast<{metalType}>({math_call(_unary_ops[node.op], metalType, operands[0][0])})"
+        elif node.op == "cast":
+            expression = convert(operands[0][0], anyToMetal(node.inputs[0].bufType), metalType)
+        else:
+            raise ValueError(f"[MetalGPU] Unknown lazy operation {node.op}")
+        return expression, shape
+
+    def __add__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("add", self, as_operand(other, self.bufType))
+
+    def __sub__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("sub", self, as_operand(other, self.bufType))
+
+    def __mul__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("mul", self, as_operand(other, self.bufType))
+
+    def __radd__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("add", as_operand(other, self.bufType), self)
+
+    def __rsub__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("sub", as_operand(other, self.bufType), self)
+
+    def __rmul__(self, other) -> "LazyBuffer":
+        return LazyBuffer.binary("mul", as_operand(other, self.bufType), self)
+
+    def astype(self, targetType) -> "LazyBuffer":
+        return LazyBuffer.cast(self, targetType)
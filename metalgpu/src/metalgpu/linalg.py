@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .utils import anyToMetal, isFloating
+from .shader import matmul_func_kernel
+
+# (block_m, block_n, block_k, simd_m, simd_n), largest first. Float types use simdgroup matrices, others one thread per output
+_float_configs = [(64, 64, 16, 32, 32), (32, 32, 16, 16, 16)]
+_int_configs = [(16, 16, 16, 0, 0)]
+
+# Tile configuration chosen for every data type and problem size
+_tile_configs = OrderedDict()
+_tile_configs_size = 256
+_tile_configs_lock = threading.Lock()
+
+
+def _threads(config : tuple, floating : bool) -> int:
+    block_m, block_n, _, simd_m, simd_n = config
+    return (block_m // simd_m) * (block_n // simd_n) * 32 if floating else block_m * block_n
+
+
+def _tile_config(interface, metalType : str, floating : bool, M : int, N : int, K : int, batch : int):
+    key = (metalType, M, N, K, batch)
+    with _tile_configs_lock:
+        config = _tile_configs.get(key)
+        if config is not None:
+            _tile_configs.move_to_end(key)
+    if config is not None:
+        return config, interface.get_kernel(matmul_func_kernel(metalType, floating, *config), "matmul")
+
+    configs = _float_configs if floating else _int_configs
+    # Large tiles reuse more of every load, but only pay off when there are enough of them to keep the GPU busy
+    candidates = [config for config in configs if batch * -(-M // config[0]) * -(-N // config[1]) >= 64] or configs[-1:]
+    for config in candidates + [config for config in configs if config not in candidates]:
+        kernel = interface.get_kernel(matmul_func_kernel(metalType, floating, *config), "matmul")
+        # Kernels rely on their exact threadgroup size, a pipeline that can't run that many threads can't be used
+        if kernel.maxThreadsPerGroup() == _threads(config, floating):
+            with _tile_configs_lock:
+                _tile_configs[key] = config
+                while len(_tile_configs) > _tile_configs_size:
+                    _tile_configs.popitem(last=False)
+            return config, kernel
+    raise RuntimeError(f"[MetalGPU] No matmul configuration can run for {metalType}")
+
+
+def matmul(a : Buffer | LazyBuffer, b : Buffer | LazyBuffer) -> Buffer:
+    if isinstance(a, LazyBuffer):
+        a = a.evaluate()
+    if isinstance(b, LazyBuffer):
+        b = b.evaluate()
+    assert(a.ndim in (2, 3) and b.ndim in (2, 3)), "[MetalGPU] Matmul needs matrices, or batches of matrices"
+    assert(a.bufType == b.bufType), "[MetalGPU] Buffers must be of the same data type"
+    M, K = a.shape[-2:]
+    N = b.shape[-1]
+    assert(b.shape[-2] == K), f"[MetalGPU] Can't multiply matrices of shapes {a.shape} and {b.shape}"
+    metalType = anyToMetal(a.bufType)
+    if metalType == "bool":
+        raise TypeError("[MetalGPU] Matmul doesn't support bool buffers")
+
+    # A batch of one matrix, or a single matrix, is broadcast over the batch of the other input
+    aBatch = a.shape[0] if a.ndim == 3 else 1
+    bBatch = b.shape[0] if b.ndim == 3 else 1
+    assert(aBatch == bBatch or aBatch == 1 or bBatch == 1), "[MetalGPU] Batch sizes must be equal, or one of them 1"
+    batch = max(aBatch, bBatch)
+    aLayout = [a.strides[0] if aBatch > 1 else 0, a.strides[-2], a.strides[-1], a.offset]
+    bLayout = [b.strides[0] if bBatch > 1 else 0, b.strides[-2], b.strides[-1], b.offset]
+
+    interface = a.interface
+    floating = isFloating(a.bufType)
+    config, matmul_kernel = _tile_config(interface, metalType, floating, M, N, K, batch)
+    tilesM, tilesN = -(-M // config[0]), -(-N // config[1])
+
+    out = interface.create_buffer((batch, M, N) if a.ndim == 3 or b.ndim == 3 else (M, N), metalType, interface.output_storage)
+    params = np.array([M, N, K, tilesM, tilesN] + aLayout + bLayout, dtype=np.int32)
+    threads = _threads(config, floating)
+    matmul_kernel(batch * tilesM * tilesN * threads, [a, b, out, params], threads_per_group=threads)
+    return out
@@ -1,58 +1,65 @@
-import numpy as np
-
 from .buffer import Buffer
-from .utils import anyToMetal
+from .lazy import LazyBuffer, as_operand
+from .utils import anyToMetal, isFloating
 from .shader import sqrt_func_kernel, cos_func_kernel, sin_func_kernel, tan_func_kernel
 
-def sqrt(buf : Buffer) -> "Buffer":
-    out_buffer = buf.interface.create_buffer(len(buf.contents), anyToMetal(buf.contents.dtype))
-    sqrt_kernel = sqrt_func_kernel(buf)
-
-    
-    prevShader = buf.interface.loaded_shader
-    shaderFromPath = buf.interface.shader_from_path
-    buf.interface.load_shader_from_string(sqrt_kernel)
-    buf.interface.set_function("sqrt_func")
-    buf.interface.run_function(len(buf.contents), [buf, out_buffer])
-    buf.interface.load_shader(prevShader) if shaderFromPath else buf.interface.load_shader_from_string(prevShader)
-    return out_buffer
+def _output(buf : Buffer, out : Buffer | None) -> Buffer:
+    if out is None:
+        return buf.interface.create_buffer(buf.shape, anyToMetal(buf.bufType), buf.interface.output_storage)
+    assert(out.shape == buf.shape and out.bufType == buf.bufType), "[MetalGPU] Output buffer must be of the same shape and data type as the result"
+    return out
+
+
+def _lazy_unary(op : str, buf : Buffer | LazyBuffer, out : Buffer | None) -> "Buffer | LazyBuffer":
+    result = LazyBuffer.unary(op, buf)
+    return result if out is None else result.evaluate(out)
+
+
+def _lazy_binary(op : str, a : LazyBuffer, b, out : Buffer | None) -> "Buffer | LazyBuffer":
+    result = LazyBuffer.binary(op, a, as_operand(b, a.bufType))
+    return result if out is None else result.evaluate(out)
+
 
+def add(a : Buffer | LazyBuffer, b, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    return a._binary("add", b, out) if isinstance(a, Buffer) else _lazy_binary("add", a, b, out)
 
-def cos(buf : Buffer) -> "Buffer":
-    out_buffer = buf.interface.create_buffer(len(buf.contents), anyToMetal(buf.contents.dtype))
-    cos_kernel = cos_func_kernel(buf)
 
-    prevShader = buf.interface.loaded_shader
-    shaderFromPath = buf.interface.shader_from_path
-    buf.interface.load_shader_from_string(cos_kernel)
-    buf.interface.set_function("cos_func")
-    buf.interface.run_function(len(buf.contents), [buf, out_buffer])
-    buf.interface.load_shader(prevShader) if shaderFromPath else buf.interface.load_shader_from_string(prevShader)
+def sub(a : Buffer | LazyBuffer, b, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    return a._binary("sub", b, out) if isinstance(a, Buffer) else _lazy_binary("sub", a, b, out)
+
+
+def mul(a : Buffer | LazyBuffer, b, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    return a._binary("mul", b, out) if isinstance(a, Buffer) else _lazy_binary("mul", a, b, out)
+
+
+def sqrt(buf : Buffer | LazyBuffer, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    if isinstance(buf, LazyBuffer) or buf.interface.lazy: return _lazy_unary("sqrt", buf, out)
+    out_buffer = _output(buf, out)
+    sqrt_kernel = buf.interface.get_kernel(sqrt_func_kernel(buf, out_buffer), "sqrt_func")
+    sqrt_kernel(buf.size, [buf, out_buffer], threads_per_group=sqrt_kernel.maxThreadsPerGroup())
     return out_buffer
 
-def sin(buf : Buffer) -> "Buffer":
-    if(buf.contents.dtype != np.float32 and buf.contents.dtype != np.float64): raise TypeError("[MetalGPU] Buffer data type must be float or double")
-    out_buffer = buf.interface.create_buffer(len(buf.contents), anyToMetal(buf.contents.dtype))
-    sin_kernel = sin_func_kernel(buf)
-
-    prevShader = buf.interface.loaded_shader
-    shaderFromPath = buf.interface.shader_from_path
-    buf.interface.load_shader_from_string(sin_kernel)
-    buf.interface.set_function("sin_func")
-    buf.interface.run_function(len(buf.contents), [buf, out_buffer])
-    buf.interface.load_shader(prevShader) if shaderFromPath else buf.interface.load_shader_from_string(prevShader)
+
+def cos(buf : Buffer | LazyBuffer, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    if isinstance(buf, LazyBuffer) or buf.interface.lazy: return _lazy_unary("cos", buf, out)
+    out_buffer = _output(buf, out)
+    cos_kernel = buf.interface.get_kernel(cos_func_kernel(buf, out_buffer), "cos_func")
+    cos_kernel(buf.size, [buf, out_buffer], threads_per_group=cos_kernel.maxThreadsPerGroup())
     return out_buffer
 
+def sin(buf : Buffer | LazyBuffer, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    if not isFloating(buf.bufType): raise TypeError("[MetalGPU] Buffer data type must be float, half or bfloat")
+    if isinstance(buf, LazyBuffer) or buf.interface.lazy: return _lazy_unary("sin", buf, out)
+    out_buffer = _output(buf, out)
+    sin_kernel = buf.interface.get_kernel(sin_func_kernel(buf, out_buffer), "sin_func")
+    sin_kernel(buf.size, [buf, out_buffer], threads_per_group=sin_kernel.maxThreadsPerGroup())
+    return out_buffer
 
-def tan(buf : Buffer) -> "Buffer":
-    if(buf.contents.dtype != np.float32 and buf.contents.dtype != np.float64): raise TypeError("[MetalGPU] Buffer data type must be float or double")
-    out_buffer = buf.interface.create_buffer(len(buf.contents), anyToMetal(buf.contents.dtype))
-    tan_kernel = tan_func_kernel(buf)
 
-    prevShader = buf.interface.loaded_shader
-    shaderFromPath = buf.interface.shader_from_path
-    buf.interface.load_shader_from_string(tan_kernel)
-    buf.interface.set_function("tan_func")
-    buf.interface.run_function(len(buf.contents), [buf, out_buffer])
-    buf.interface.load_shader(prevShader) if shaderFromPath else buf.interface.load_shader_from_string(prevShader)
+def tan(buf : Buffer | LazyBuffer, out : Buffer | None = None) -> "Buffer | LazyBuffer":
+    if not isFloating(buf.bufType): raise TypeError("[MetalGPU] Buffer data type must be float, half or bfloat")
+    if isinstance(buf, LazyBuffer) or buf.interface.lazy: return _lazy_unary("tan", buf, out)
+    out_buffer = _output(buf, out)
+    tan_kernel = buf.interface.get_kernel(tan_func_kernel(buf, out_buffer), "tan_func")
+    tan_kernel(buf.size, [buf, out_buffer], threads_per_group=tan_kernel.maxThreadsPerGroup())
     return out_buffer
\ No newline at end of file
@@ -0,0 +1,141 @@
+import json
+import os
+import threading
+import time
+import weakref
+
+from .utils import format_table
+
+# Chrome trace thread id of the GPU timeline, host events use the id of the thread that made them
+_GPU_TRACK = 0
+
+
+class Profiler:
+    def __init__(self, interface) -> None:
+        self._interface = weakref.ref(interface)
+        self.records = []
+        self.start = time.perf_counter()
+        # Command buffer timestamps come from another clock, converted to time.perf_counter() with this offset
+        self.clock_offset = self.start - interface.host_time()
+
+    def _gpu_times(self, gpuStart : float, gpuEnd : float) -> tuple[float | None, float | None]:
+        if gpuStart <= 0 or gpuEnd <= 0:
+            return None, None
+        return gpuStart + self.clock_offset, gpuEnd + self.clock_offset
+
+    def dispatch(self, name : str, grid : tuple, threads_per_group, buffer_bytes : int, start : float, marshal_end : float, end : float, times : list, completion, batched : bool, waited : bool) -> None:
+        record = {
+            "type": "dispatch", "name": name, "grid": grid, "threads_per_group": threads_per_group, "bytes": buffer_bytes,
+            "start": start, "marshal_end": marshal_end, "encode": times[0], "end": end, "batched": batched, "waited": waited,
+            "gpu_start": None, "gpu_end": None, "completion": completion, "thread": threading.get_ident(),
+        }
+        # Dispatches in a batch share the command buffer of the batch, timed as a whole
+        if waited and not batched:
+            record["gpu_start"], record["gpu_end"] = self._gpu_times(times[1], times[2])
+        self.records.append(record)
+
+    def batch(self, dispatches : int, start : float, end : float, times : list, completion, waited : bool) -> None:
+        record = {
+            "type": "batch", "name": "batch", "dispatches": dispatches, "start": start, "end": end, "waited": waited,
+            "gpu_start": None, "gpu_end": None, "completion": completion, "thread": threading.get_ident(),
+        }
+        if waited:
+            record["gpu_start"], record["gpu_end"] = self._gpu_times(times[1], times[2])
+        self.records.append(record)
+
+    def compile(self, name : str, start : float, end : float) -> None:
+        self.records.append({"type": "compile", "name": name, "start": start, "end": end, "thread": threading.get_ident()})
+
+    # Fetches the GPU timestamps of command buffers that were submitted without waiting and have completed since
+    def resolve(self) -> None:
+        interface = self._interface()
+        for record in self.records:
+            completion = record.get("completion")
+            if completion is None:
+                continue
+            if completion.completionNum is None or interface is None:
+                record["completion"] = None
+            elif completion.done():
+                record["gpu_start"], record["gpu_end"] = self._gpu_times(*interface.completion_times(completion.completionNum))
+                record["completion"] = None
+
+    def clear(self) -> None:
+        self.records = []
+
+    def summary(self) -> list[dict]:
+        self.resolve()
+        kernels = {}
+        for record in self.records:
+            if record["type"] != "dispatch":
+                continue
+            entry = kernels.setdefault(record["name"], {"name": record["name"], "calls": 0, "host_time": 0.0, "marshal_time": 0.0, "encode_time": 0.0, "gpu_time": 0.0, "gpu_calls": 0, "bytes": 0})
+            entry["calls"] += 1
+            entry["host_time"] += record["end"] - record["start"]
+            entry["marshal_time"] += record["marshal_end"] - record["start"]
+            entry["encode_time"] += record["encode"]
+            entry["bytes"] += record["bytes"]
+            if record["gpu_start"] is not None:
+                entry["gpu_time"] += record["gpu_end"] - record["gpu_start"]
+                entry["gpu_calls"] += 1
+        for entry in kernels.values():
+            entry["gpu_mean"] = entry["gpu_time"] / entry["gpu_calls"] if entry["gpu_calls"] else None
+        return sorted(kernels.values(), key=lambda entry: (entry["gpu_time"], entry["host_time"]), reverse=True)
+
+    def summary_table(self) -> str:
+        number = lambda value: "-" if value is None else f"{value * 1e3:.3f}"
+        return format_table(
+            ["Kernel", "Calls", "Host (ms)", "Marshal (ms)", "Encode (ms)", "GPU (ms)", "GPU mean (ms)", "MB bound"],
+            [[entry["name"], str(entry["calls"]), number(entry["host_time"]), number(entry["marshal_time"]), number(entry["encode_time"]),
+              number(entry["gpu_time"] if entry["gpu_calls"] else None), number(entry["gpu_mean"]), f"{entry['bytes'] / 1e6:.1f}"] for entry in self.summary()],
+        )
+
+    def chrome_trace(self) -> dict:
+        self.resolve()
+        pid = os.getpid()
+        micros = lambda seconds: (seconds - self.start) * 1e6
+        events = [
+            {"ph": "M", "name": "process_name", "pid": pid, "args": {"name": "metalgpu"}},
+            {"ph": "M", "name": "thread_name", "pid": pid, "tid": _GPU_TRACK, "args": {"name": "GPU"}},
+        ]
+        threads = set()
+
+        def add_slice(name, category, tid, start, end, args=None):
+            event = {"ph": "X", "name": name, "cat": category, "pid": pid, "tid": tid, "ts": micros(start), "dur": (end - start) * 1e6}
+            if args:
+                event["args"] = args
+            events.append(event)
+
+        for record in self.records:
+            tid = record["thread"]
+            threads.add(tid)
+            if record["type"] == "compile":
+                add_slice(record["name"], "compile", tid, record["start"], record["end"])
+                continue
+
+            if record["type"] == "dispatch":
+                args = {"grid": list(record["grid"]), "bytes": record["bytes"], "batched": record["batched"]}
+                if record["threads_per_group"] is not None:
+                    args["threads_per_group"] = list(record["threads_per_group"])
+                add_slice(record["name"], "dispatch", tid, record["start"], record["end"], args)
+                # Nested slices, splitting the host time of the dispatch
+                encodeEnd = min(record["marshal_end"] + record["encode"], record["end"])
+                add_slice("marshal", "host", tid, record["start"], record["marshal_end"])
+                add_slice("encode", "host", tid, record["marshal_end"], encodeEnd)
+                if not record["batched"]:
+                    add_slice("wait" if record["waited"] else "submit", "host", tid, encodeEnd, record["end"])
+            else:
+                add_slice(f"batch ({record['dispatches']} dispatches)", "batch", tid, record["start"], record["end"])
+
+            if record["gpu_start"] is not None:
+                name = record["name"] if record["type"] == "dispatch" else f"batch ({record['dispatches']} dispatches)"
+                add_slice(name, "gpu", _GPU_TRACK, record["gpu_start"], record["gpu_end"])
+
+        for tid in threads:
+            events.append({"ph": "M", "name": "thread_name", "pid": pid, "tid": tid, "args": {"name": "main" if tid == threading.main_thread().ident else f"thread {tid}"}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    # Writes a trace that can be opened in chrome://tracing or https://ui.perfetto.dev
+    def export_chrome_trace(self, path : str) -> None:
+        with open(path, "w") as f:
+            json.dump(self.chrome_trace(), f)
+
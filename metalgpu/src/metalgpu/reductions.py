@@ -0,0 +1,96 @@
+import builtins
+
+import numpy as np
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .utils import anyToMetal
+from .shader import reduce_func_kernel, element_index
+
+# Each thread of the first stage reduces at least this many elements, before the tree reduction
+_elements_per_thread = 16
+
+
+# Type results are accumulated and returned in. Integer sums widen to 64 bits, as numpy's do, so that they don't overflow,
+# 16 bit floats are summed in float, and bfloat having no SIMD-group functions is always reduced in float
+def _acc_type(op : str, inType : str) -> str:
+    if op == "mean" or inType == "bfloat" or (inType == "half" and op == "sum"):
+        return "float"
+    if op == "sum" and inType in ("int", "short", "char", "bool"):
+        return "long"
+    if op == "sum" and inType in ("uint32_t", "uint16_t"):
+        return "uint64_t"
+    return "int" if inType == "bool" else inType
+
+
+def _reduce(op : str, buf : Buffer | LazyBuffer, axis : int | None) -> Buffer:
+    if isinstance(buf, LazyBuffer):
+        buf = buf.evaluate()
+    interface = buf.interface
+
+    # The reduced axis is moved last, so that every output element reduces one contiguous row of the view
+    if axis is None:
+        view = buf
+        outShape = ()
+        length = buf.size
+    else:
+        axis = axis + buf.ndim if axis < 0 else axis
+        assert(0 <= axis < buf.ndim), f"[MetalGPU] Axis {axis} is out of range for a buffer of {buf.ndim} dimensions"
+        view = buf.transpose([dim for dim in range(buf.ndim) if dim != axis] + [axis])
+        outShape = buf.shape[:axis] + buf.shape[axis + 1:]
+        length = buf.shape[axis]
+    rows = buf.size // length
+
+    inType = anyToMetal(buf.bufType)
+    accType = _acc_type(op, inType)
+    arg = op in ("argmin", "argmax")
+
+    first = interface.get_kernel(reduce_func_kernel(op, inType, accType, element_index(view, "p"), False), "reduce")
+    width = first.maxThreadsPerGroup()
+    # Enough threadgroups per row to fill the GPU, but few enough for the second stage to fit in a single threadgroup
+    groups = builtins.min(builtins.max(1, -(-length // (width * _elements_per_thread))), width)
+
+    out = interface.create_buffer(outShape, accType, interface.output_storage)
+    indices = interface.create_buffer(outShape, "int", interface.output_storage) if arg else None
+
+    # Both stages go in one command buffer, the second one seeing the writes of the first
+    with interface.batch():
+        if groups == 1:
+            params = np.array([length, 1, length], dtype=np.uint32)
+            first(rows * width, [view, out, params, None, indices], threads_per_group=width)
+        else:
+            # Only ever read by the second stage
+            partials = interface.create_buffer(rows * groups, accType, "private")
+            partialIndices = interface.create_buffer(rows * groups, "int", "private") if arg else None
+            params = np.array([length, groups, 1], dtype=np.uint32)
+            first(rows * groups * width, [view, partials, params, None, partialIndices], threads_per_group=width)
+
+            second = interface.get_kernel(reduce_func_kernel(op, accType, accType, "p", True), "reduce")
+            secondParams = np.array([groups, 1, length], dtype=np.uint32)
+            second(rows * second.maxThreadsPerGroup(), [partials, out, secondParams, partialIndices, indices], threads_per_group=second.maxThreadsPerGroup())
+
+    return indices if arg else out
+
+
+def sum(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("sum", buf, axis)
+
+
+def min(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("min", buf, axis)
+
+
+def max(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("max", buf, axis)
+
+
+def mean(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("mean", buf, axis)
+
+
+def argmin(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("argmin", buf, axis)
+
+
+def argmax(buf : Buffer | LazyBuffer, axis : int | None = None) -> Buffer:
+    return _reduce("argmax", buf, axis)
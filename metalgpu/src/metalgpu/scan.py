@@ -0,0 +1,108 @@
+import numpy as np
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .utils import anyToMetal
+from .shader import scan_func_kernel, scan_add_func_kernel, compact_func_kernel, element_index
+
+# Number of consecutive elements scanned by every thread, a block being this many elements per thread of a threadgroup
+_elements_per_thread = 8
+
+
+# Scans every row of length elements of view into the contiguous buffer out, recursing on the block totals when a row spans several blocks
+def _scan(view : Buffer, rows : int, length : int, accType : str, exclusive : bool, out : Buffer, predicate : bool = False) -> None:
+    interface = view.interface
+    scan_kernel = interface.get_kernel(scan_func_kernel(anyToMetal(view.bufType), accType, element_index(view, "p"), exclusive, predicate, _elements_per_thread), "scan")
+    width = scan_kernel.maxThreadsPerGroup()
+    block = width * _elements_per_thread
+    groups = -(-length // block)
+
+    # Block totals and their offsets are only ever read by the GPU
+    sums = interface.create_buffer(rows * groups, accType, "private")
+    params = np.array([length, groups, block], dtype=np.uint32)
+    scan_kernel(rows * groups * width, [view, out, sums, params], threads_per_group=width)
+
+    if groups > 1:
+        offsets = interface.create_buffer(rows * groups, accType, "private")
+        _scan(sums, rows, groups, accType, True, offsets)
+        add_kernel = interface.get_kernel(scan_add_func_kernel(accType), "scan_add")
+        add_kernel(rows * length, [out, offsets, params], threads_per_group=add_kernel.maxThreadsPerGroup())
+
+
+def cumsum(buf : Buffer | LazyBuffer, axis : int | None = None, exclusive : bool = False) -> Buffer:
+    if isinstance(buf, LazyBuffer):
+        buf = buf.evaluate()
+    interface = buf.interface
+
+    # Same as numpy, no axis scans the row-major flattened buffer
+    if axis is None:
+        view = buf
+        outShape = (buf.size,)
+        length = buf.size
+    else:
+        axis = axis + buf.ndim if axis < 0 else axis
+        assert(0 <= axis < buf.ndim), f"[MetalGPU] Axis {axis} is out of range for a buffer of {buf.ndim} dimensions"
+        order = [dim for dim in range(buf.ndim) if dim != axis] + [axis]
+        view = buf.transpose(order)
+        outShape = view.shape
+        length = buf.shape[axis]
+
+    inType = anyToMetal(buf.bufType)
+    accType = "int" if inType == "bool" else ("float" if inType in ("half", "bfloat") else inType)
+    out = interface.create_buffer(outShape, accType, interface.output_storage)
+    with interface.batch():
+        _scan(view, buf.size // length, length, accType, exclusive, out)
+
+    if axis is None:
+        return out
+    # The scanned axis was moved last, move it back
+    return out.transpose([order.index(dim) for dim in range(buf.ndim)])
+
+
+def _compact(values : Buffer | None, mask : Buffer, value : str, outType : str) -> Buffer:
+    interface = mask.interface
+    # The count is read right after the batch below, which only runs once an enclosing batch ends
+    assert(not interface.batching()), "[MetalGPU] compact and nonzero read their result size back, they can't run inside Interface.batch"
+    positions = interface.create_buffer(mask.size, "uint", "private")
+    count = interface.create_buffer(1, "uint")
+    params = np.array([mask.size], dtype=np.uint32)
+    out = interface.create_buffer(mask.size, outType, interface.output_storage)
+
+    compact_kernel = interface.get_kernel(compact_func_kernel(outType, anyToMetal(mask.bufType), value, element_index(mask)), "compact")
+    with interface.batch():
+        _scan(mask, 1, mask.size, "uint", True, positions, predicate=True)
+        # Without values, the mask is bound in their place, the kernel never reading it
+        compact_kernel(mask.size, [values if values is not None else mask, mask, positions, out, count, params], threads_per_group=compact_kernel.maxThreadsPerGroup())
+
+    # Only the count is read back, the result is a view of the elements written
+    kept = int(count.contents[0])
+    return out._view((kept,), (1,), 0)
+
+
+def compact(buf : Buffer | LazyBuffer, mask : Buffer | LazyBuffer) -> Buffer:
+    if isinstance(buf, LazyBuffer):
+        buf = buf.evaluate()
+    if isinstance(mask, LazyBuffer):
+        mask = mask.evaluate()
+    assert(buf.shape == mask.shape), "[MetalGPU] Buffer and mask must be of the same shape"
+    return _compact(buf, mask, f"arr1[{element_index(buf)}]", anyToMetal(buf.bufType))
+
+
+def flatnonzero(buf : Buffer | LazyBuffer) -> Buffer:
+    if isinstance(buf, LazyBuffer):
+        buf = buf.evaluate()
+    return _compact(None, buf, "int(id)", "int")
+
+
+# One buffer of indices per dimension, each compacted from the row-major position on its own
+def nonzero(buf : Buffer | LazyBuffer) -> tuple[Buffer, ...]:
+    if isinstance(buf, LazyBuffer):
+        buf = buf.evaluate()
+    if buf.ndim <= 1:
+        return (flatnonzero(buf),)
+    indices = []
+    inner = 1
+    for dim in reversed(buf.shape):
+        indices.append(_compact(None, buf, f"int((id / {inner}u) % {dim}u)", "int"))
+        inner *= dim
+    return tuple(reversed(indices))
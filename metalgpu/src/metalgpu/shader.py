@@ -1,36 +1,81 @@
-from .utils import anyToMetal
+from .utils import anyToMetal, isFloating, Scalar
 
 
-def add_func_kernel(self):
+def contiguous_strides(shape):
+    strides = []
+    stride = 1
+    for dim in reversed(shape):
+        strides.append(stride)
+        stride *= dim
+    return tuple(reversed(strides))
+
+# Index of the element at row-major position `position` of buf, with the buffer layout baked in as constants.
+# Contiguous buffers index directly, so their kernels stay the same whatever their shape
+def element_index(buf, position="id"):
+    if buf.offset == 0 and buf.strides == contiguous_strides(buf.shape):
+        return position
+    terms = [str(buf.offset)] if buf.offset != 0 else []
+    inner = 1
+    for dim, stride in reversed(list(zip(buf.shape, buf.strides))):
+        if dim != 1 and stride != 0:
+            coordinate = f"({position} / {inner}u)" if inner != 1 else position
+            if inner * dim < buf.size:
+                coordinate = f"({coordinate} % {dim}u)"
+            terms.append(f"{coordinate} * {stride}" if stride != 1 else coordinate)
+        inner *= dim
+    return " + ".join(reversed(terms)) if terms else "0"
+
+
+# bfloat only has conversions and arithmetic, math functions and conversions from other types go through float
+def math_call(function, metal_type, value):
+    if metal_type == "bfloat":
+        return f"bfloat({function}(float({value})))"
+    return f"{function}({value})"
+
+def convert(value, source_type, target_type):
+    if "bfloat" in (source_type, target_type) and source_type != target_type:
+        return f"static_cast<{target_type}>(float({value}))"
+    return f"static_cast<{target_type}>({value})"
+
+# Parameter declaration of a kernel input and the expression reading its element at id. Scalars are a constant reference, set inline
+def input_argument(operand, name, index):
+    if isinstance(operand, Scalar):
+        return f"constant {anyToMetal(operand.bufType)} &{name} [[buffer({index})]]", name
+    return f"const device {anyToMetal(operand.bufType)} *{name} [[buffer({index})]]", f"{name}[{element_index(operand)}]"
+
+def add_func_kernel(self, other, out):
+    (arg1, value1), (arg2, value2) = input_argument(self, "arr1", 0), input_argument(other, "arr2", 1)
     return f"""
     #include <metal_stdlib>
 
     using namespace metal;
 
-    kernel void add(const device {anyToMetal(self.contents.dtype)} *arr1 [[buffer(0)]], const device {anyToMetal(self.contents.dtype)} *arr2 [[buffer(1)]], device {anyToMetal(self.contents.dtype)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
-        arr3[id] = arr1[id] + arr2[id];
+    kernel void add({arg1}, {arg2}, device {anyToMetal(self.bufType)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
+        arr3[{element_index(out)}] = {value1} + {value2};
     }};
     """
 
-def sub_func_kernel(self):
+def sub_func_kernel(self, other, out):
+    (arg1, value1), (arg2, value2) = input_argument(self, "arr1", 0), input_argument(other, "arr2", 1)
     return f"""
     #include <metal_stdlib>
 
     using namespace metal;
 
-    kernel void sub(const device {anyToMetal(self.contents.dtype)} *arr1 [[buffer(0)]], const device {anyToMetal(self.contents.dtype)} *arr2 [[buffer(1)]], device {anyToMetal(self.contents.dtype)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
-        arr3[id] = arr1[id] - arr2[id];
+    kernel void sub({arg1}, {arg2}, device {anyToMetal(self.bufType)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
+        arr3[{element_index(out)}] = {value1} - {value2};
     }};
     """
 
-def mul_func_kernel(self):
+def mul_func_kernel(self, other, out):
+    (arg1, value1), (arg2, value2) = input_argument(self, "arr1", 0), input_argument(other, "arr2", 1)
     return f"""
     #include <metal_stdlib>
 
     using namespace metal;
 
-    kernel void mul(const device {anyToMetal(self.contents.dtype)} *arr1 [[buffer(0)]], const device {anyToMetal(self.contents.dtype)} *arr2 [[buffer(1)]], device {anyToMetal(self.contents.dtype)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
-        arr3[id] = arr2[id] * arr1[id];
+    kernel void mul({arg1}, {arg2}, device {anyToMetal(self.bufType)} *arr3 [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
+        arr3[{element_index(out)}] = {value2} * {value1};
     }};
     """
 
@@ -40,8 +85,31 @@ def cast_func_kernel(self, targetType):
 
     using namespace metal;
 
-    kernel void cast(const device {anyToMetal(self.contents.dtype)} *arr1 [[buffer(0)]], device {anyToMetal(targetType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
-        arr2[id] = float(arr1[id]);
+    kernel void cast(const device {anyToMetal(self.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(targetType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[id] = {convert(f"arr1[{element_index(self)}]", anyToMetal(self.bufType), anyToMetal(targetType))};
+    }};
+    """
+
+def fused_func_kernel(expression, leaves, output_type, output_index="id"):
+    inputs = "".join(input_argument(leaf, f"in{i}", i)[0] + ", " for i, leaf in enumerate(leaves))
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void fused({inputs}device {output_type} *out [[buffer({len(leaves)})]], uint id [[thread_position_in_grid]]) {{
+        out[{output_index}] = {expression};
+    }};
+    """
+
+def copy_func_kernel(buf):
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void copy(const device {anyToMetal(buf.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(buf.bufType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[id] = arr1[{element_index(buf)}];
     }};
     """
 
@@ -54,42 +122,429 @@ def initial_shader():
     kernel void emptyFunc() {};
     """
 
-def sqrt_func_kernel(buf):
+def sqrt_func_kernel(buf, out):
     return f"""
     #include <metal_stdlib>
 
     using namespace metal;
 
-    kernel void sqrt_func(device {anyToMetal(buf.contents.dtype)} *arr1 [[buffer(0)]], device {anyToMetal(buf.contents.dtype)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
-        arr2[id] = sqrt(arr1[id]);
+    kernel void sqrt_func(device {anyToMetal(buf.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(buf.bufType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[{element_index(out)}] = {math_call("sqrt", anyToMetal(buf.bufType), f"arr1[{element_index(buf)}]")};
     }};
     """
 
-def cos_func_kernel(buf):
+def cos_func_kernel(buf, out):
     return f"""
     #include <metal_stdlib>
 
     using namespace metal;
 
-    kernel void cos_func(device {anyToMetal(buf.contents.dtype)} *arr1 [[buffer(0)]], device {anyToMetal(buf.contents.dtype)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
-        arr2[id] = cos(arr1[id]);
+    kernel void cos_func(device {anyToMetal(buf.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(buf.bufType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[{element_index(out)}] = {math_call("cos", anyToMetal(buf.bufType), f"arr1[{element_index(buf)}]")};
     }};
     """
 
-def sin_func_kernel(buf):
+def sin_func_kernel(buf, out):
     return f"""
     #include <metal_stdlib>
     using namespace metal;
-    kernel void sin_func(device {anyToMetal(buf.contents.dtype)} *arr1 [[buffer(0)]], device {anyToMetal(buf.contents.dtype)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
-        arr2[id] = sin(arr1[id]);
+    kernel void sin_func(device {anyToMetal(buf.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(buf.bufType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[{element_index(out)}] = {math_call("sin", anyToMetal(buf.bufType), f"arr1[{element_index(buf)}]")};
     }};
     """
 
-def tan_func_kernel(buf):
+def tan_func_kernel(buf, out):
     return f"""
     #include <metal_stdlib>
     using namespace metal;
-    kernel void tan_func(device {anyToMetal(buf.contents.dtype)} *arr1 [[buffer(0)]], device {anyToMetal(buf.contents.dtype)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
-        arr2[id] = tan(arr1[id]);
+    kernel void tan_func(device {anyToMetal(buf.bufType)} *arr1 [[buffer(0)]], device {anyToMetal(buf.bufType)} *arr2 [[buffer(1)]], uint id [[thread_position_in_grid]]) {{
+        arr2[{element_index(out)}] = {math_call("tan", anyToMetal(buf.bufType), f"arr1[{element_index(buf)}]")};
     }};
-    """
\ No newline at end of file
+    """
+
+_reduce_combine = {
+    "sum": "value = value + item;",
+    "min": "value = min(value, item);",
+    "max": "value = max(value, item);",
+    "argmin": "if (itemIndex != -1 && (index == -1 || item < value || (item == value && itemIndex < index))) { value = item; index = itemIndex; }",
+    "argmax": "if (itemIndex != -1 && (index == -1 || item > value || (item == value && itemIndex < index))) { value = item; index = itemIndex; }",
+}
+
+def reduce_identity(op, acc_type):
+    floating = acc_type in ("float", "half")
+    if op in ("sum", "mean", "argmin", "argmax"):
+        return f"{acc_type}(0)"
+    if op == "min":
+        return "INFINITY" if floating else f"numeric_limits<{acc_type}>::max()"
+    return "-INFINITY" if floating else f"numeric_limits<{acc_type}>::min()"
+
+# One stage of a row reduction: every threadgroup reduces a chunk of a row, first per thread, then per simdgroup, then
+# across simdgroups through threadgroup memory. params holds the row length, the number of threadgroups per row, and the mean divisor.
+# The first stage reads the input through its layout, the second one reads the partial results of the first, and indices for arg reductions
+def reduce_func_kernel(op, in_type, acc_type, index, from_partials):
+    arg = op in ("argmin", "argmax")
+    combine = _reduce_combine["sum" if op == "mean" else op]
+    identity = reduce_identity(op, acc_type)
+    result = f"value / {acc_type}(params[2])" if op == "mean" else "value"
+    # SIMD-group shuffles don't take 64 bit types, which are shuffled as two 32 bit halves
+    shuffle = f"as_type<{acc_type}>(simd_shuffle_down(as_type<uint2>(value), offset))" if acc_type in ("long", "uint64_t") else "simd_shuffle_down(value, offset)"
+    indexArgs = ""
+    if arg:
+        indexArgs = "device int *idx2 [[buffer(4)]], "
+        if from_partials:
+            indexArgs = "const device int *idx1 [[buffer(3)]], " + indexArgs
+    itemIndex = ("idx1[p]" if from_partials else "int(k)") if arg else "0"
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void reduce(const device {in_type} *arr1 [[buffer(0)]], device {acc_type} *arr2 [[buffer(1)]], constant uint *params [[buffer(2)]], {indexArgs}uint tid [[thread_index_in_threadgroup]], uint group [[threadgroup_position_in_grid]], uint threads [[threads_per_threadgroup]], uint lane [[thread_index_in_simdgroup]], uint simd [[simdgroup_index_in_threadgroup]], uint simdWidth [[threads_per_simdgroup]]) {{
+        threadgroup {acc_type} values[32];
+        threadgroup int indices[32];
+        uint length = params[0];
+        uint groups = params[1];
+        uint row = group / groups;
+        uint chunk = group % groups;
+
+        {acc_type} value = {identity};
+        int index = -1;
+        for (uint k = chunk * threads + tid; k < length; k += groups * threads) {{
+            uint p = row * length + k;
+            {acc_type} item = {acc_type}(arr1[{index if not from_partials else "p"}]);
+            int itemIndex = {itemIndex};
+            {combine}
+        }}
+
+        for (uint offset = simdWidth / 2; offset > 0; offset /= 2) {{
+            {acc_type} item = {shuffle};
+            int itemIndex = simd_shuffle_down(index, offset);
+            {combine}
+        }}
+        if (lane == 0) {{
+            values[simd] = value;
+            indices[simd] = index;
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+
+        if (simd == 0) {{
+            uint simds = (threads + simdWidth - 1) / simdWidth;
+            value = lane < simds ? values[lane] : {identity};
+            index = lane < simds ? indices[lane] : -1;
+            for (uint offset = simdWidth / 2; offset > 0; offset /= 2) {{
+                {acc_type} item = {shuffle};
+                int itemIndex = simd_shuffle_down(index, offset);
+                {combine}
+            }}
+            if (lane == 0) {{
+                arr2[group] = {result};{chr(10) + "                idx2[group] = index;" if arg else ""}
+            }}
+        }}
+    }};
+    """
+
+# Scans blocks of elements_per_thread * threads elements of every row, each thread scanning its elements sequentially, the
+# thread totals being scanned per simdgroup, then across simdgroups through threadgroup memory. The total of every block is
+# written to sums, for the blocks to then be offset by the exclusive scan of those totals. params holds the row length,
+# the number of blocks per row and the block size
+def scan_func_kernel(in_type, acc_type, index, exclusive, predicate, elements_per_thread):
+    item = f"{acc_type}(arr1[{index}] != 0)" if predicate else f"{acc_type}(arr1[{index}])"
+    write = "arr2[p] = running;\n                running += items[j];" if exclusive else "running += items[j];\n                arr2[p] = running;"
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void scan(const device {in_type} *arr1 [[buffer(0)]], device {acc_type} *arr2 [[buffer(1)]], device {acc_type} *sums [[buffer(2)]], constant uint *params [[buffer(3)]], uint tid [[thread_index_in_threadgroup]], uint group [[threadgroup_position_in_grid]], uint threads [[threads_per_threadgroup]], uint lane [[thread_index_in_simdgroup]], uint simd [[simdgroup_index_in_threadgroup]], uint simdWidth [[threads_per_simdgroup]]) {{
+        threadgroup {acc_type} totals[32];
+        uint length = params[0];
+        uint groups = params[1];
+        uint row = group / groups;
+        uint start = (group % groups) * threads * {elements_per_thread} + tid * {elements_per_thread};
+
+        {acc_type} items[{elements_per_thread}];
+        {acc_type} total = 0;
+        for (uint j = 0; j < {elements_per_thread}; j++) {{
+            uint k = start + j;
+            uint p = row * length + k;
+            items[j] = k < length ? {item} : {acc_type}(0);
+            total += items[j];
+        }}
+
+        {acc_type} prefix = total;
+        for (uint offset = 1; offset < simdWidth; offset *= 2) {{
+            {acc_type} other = simd_shuffle_up(prefix, offset);
+            if (lane >= offset) {{
+                prefix += other;
+            }}
+        }}
+        if (lane == simdWidth - 1) {{
+            totals[simd] = prefix;
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+
+        uint simds = (threads + simdWidth - 1) / simdWidth;
+        if (simd == 0) {{
+            {acc_type} simdPrefix = lane < simds ? totals[lane] : {acc_type}(0);
+            for (uint offset = 1; offset < simdWidth; offset *= 2) {{
+                {acc_type} other = simd_shuffle_up(simdPrefix, offset);
+                if (lane >= offset) {{
+                    simdPrefix += other;
+                }}
+            }}
+            if (lane < simds) {{
+                totals[lane] = simdPrefix;
+            }}
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+
+        {acc_type} running = prefix - total + (simd > 0 ? totals[simd - 1] : {acc_type}(0));
+        for (uint j = 0; j < {elements_per_thread}; j++) {{
+            uint k = start + j;
+            uint p = row * length + k;
+            if (k < length) {{
+                {write}
+            }}
+        }}
+        if (tid == 0) {{
+            sums[group] = totals[simds - 1];
+        }}
+    }};
+    """
+
+def scan_add_func_kernel(acc_type):
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void scan_add(device {acc_type} *arr1 [[buffer(0)]], const device {acc_type} *offsets [[buffer(1)]], constant uint *params [[buffer(2)]], uint id [[thread_position_in_grid]]) {{
+        uint length = params[0];
+        arr1[id] += offsets[(id / length) * params[1] + (id % length) / params[2]];
+    }};
+    """
+
+# Writes the value of every element whose mask is set at its position in the exclusive scan of the mask, the last
+# thread writing the number of elements kept, so that it can be read without reading the result back
+def compact_func_kernel(in_type, mask_type, value, mask_index):
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void compact(const device {in_type} *arr1 [[buffer(0)]], const device {mask_type} *mask [[buffer(1)]], const device uint *positions [[buffer(2)]], device {in_type} *arr2 [[buffer(3)]], device uint *count [[buffer(4)]], constant uint *params [[buffer(5)]], uint id [[thread_position_in_grid]]) {{
+        bool keep = mask[{mask_index}] != 0;
+        if (keep) {{
+            arr2[positions[id]] = {value};
+        }}
+        if (id == params[0] - 1) {{
+            count[0] = positions[id] + (keep ? 1 : 0);
+        }}
+    }};
+    """
+
+# Maps a key to unsigned bits that sort in the same order: the sign bit of integers is flipped, and negative floats have all their bits flipped
+def sort_key_bits(dtype, key):
+    bits = "ulong" if dtype.itemsize == 8 else "uint"
+    width = dtype.itemsize * 8
+    mask = f"{bits}({(1 << width) - 1}ul)"
+    sign = f"{bits}({1 << (width - 1)}ul)"
+    if isFloating(dtype):
+        raw = f"{bits}(as_type<{'ushort' if width == 16 else bits}>({key}))"
+        return f"({raw} ^ (({raw} >> {width - 1}) ? {mask} : {sign}))"
+    if dtype.kind == "i":
+        return f"(({bits}({key}) ^ {sign}) & {mask})"
+    return f"{bits}({key})"
+
+def radix_count_func_kernel(key_type, key_bits):
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void radix_count(const device {key_type} *keys [[buffer(0)]], device uint *counts [[buffer(1)]], constant uint *params [[buffer(2)]], uint tid [[thread_index_in_threadgroup]], uint group [[threadgroup_position_in_grid]], uint threads [[threads_per_threadgroup]]) {{
+        threadgroup atomic_uint histogram[16];
+        uint length = params[0];
+        uint shift = params[1];
+        uint blocks = params[2];
+        uint block = params[3];
+
+        if (tid < 16) {{
+            atomic_store_explicit(&histogram[tid], 0, memory_order_relaxed);
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+        for (uint k = group * block + tid; k < min(length, (group + 1) * block); k += threads) {{
+            uint digit = uint(({key_bits.replace("KEY", "keys[k]")}) >> shift) & 15;
+            atomic_fetch_add_explicit(&histogram[digit], 1, memory_order_relaxed);
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+        if (tid < 16) {{
+            counts[tid * blocks + group] = atomic_load_explicit(&histogram[tid], memory_order_relaxed);
+        }}
+    }};
+    """
+
+# Moves every key, one per thread, to the start of its digit for its block, as given by the exclusive scan of the counts,
+# plus its rank among the keys of the same digit before it in the block. The rank within a simdgroup comes from ballots,
+# the rank across simdgroups from their digit counts in threadgroup memory, which keeps the sort stable
+def radix_scatter_func_kernel(key_type, value_type, key_bits, index_values):
+    valueArgs = f"const device {value_type} *values [[buffer(2)]], device {value_type} *valuesOut [[buffer(3)]], " if value_type is not None else ""
+    valueWrite = ""
+    if value_type is not None:
+        valueWrite = f"valuesOut[dest] = {value_type + '(id)' if index_values else 'values[id]'};"
+    return f"""
+    #include <metal_stdlib>
+
+    using namespace metal;
+
+    kernel void radix_scatter(const device {key_type} *keys [[buffer(0)]], device {key_type} *keysOut [[buffer(1)]], {valueArgs}const device uint *offsets [[buffer(4)]], constant uint *params [[buffer(5)]], uint id [[thread_position_in_grid]], uint tid [[thread_index_in_threadgroup]], uint group [[threadgroup_position_in_grid]], uint threads [[threads_per_threadgroup]], uint lane [[thread_index_in_simdgroup]], uint simd [[simdgroup_index_in_threadgroup]]) {{
+        threadgroup uint counts[32][16];
+        uint length = params[0];
+        uint shift = params[1];
+        uint blocks = params[2];
+
+        bool valid = id < length;
+        {key_type} key = valid ? keys[id] : {key_type}(0);
+        // Lanes past the end get digit 16, matching no valid lane
+        uint digit = valid ? uint(({key_bits.replace("KEY", "key")}) >> shift) & 15 : 16;
+
+        simd_vote::vote_t same = ~simd_vote::vote_t(0);
+        for (uint bit = 0; bit < 5; bit++) {{
+            simd_vote::vote_t ballot = static_cast<simd_vote::vote_t>(simd_ballot(((digit >> bit) & 1) != 0));
+            same &= ((digit >> bit) & 1) ? ballot : ~ballot;
+        }}
+        uint rank = popcount(same & ((simd_vote::vote_t(1) << lane) - 1));
+
+        for (uint i = tid; i < 32 * 16; i += threads) {{
+            counts[i / 16][i % 16] = 0;
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+        if (valid && rank == 0) {{
+            counts[simd][digit] = popcount(same);
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+
+        if (valid) {{
+            for (uint s = 0; s < simd; s++) {{
+                rank += counts[s][digit];
+            }}
+            uint dest = offsets[digit * blocks + group] + rank;
+            keysOut[dest] = key;
+            {valueWrite}
+        }}
+    }};
+    """
+
+# Tiled matrix multiplication of (batched) row-major or strided matrices, one threadgroup per block_m x block_n output tile.
+# Float types go through simdgroup matrices, every simdgroup multiplying a simd_m x simd_n part of the tile from threadgroup
+# memory, other types use one thread per output element. params holds the sizes, tile counts, and layouts of both inputs
+def matmul_func_kernel(metal_type, floating, block_m, block_n, block_k, simd_m, simd_n):
+    threads = (block_m // simd_m) * (block_n // simd_n) * 32 if floating else block_m * block_n
+    header = f"""
+    #include <metal_stdlib>
+    #include <metal_simdgroup_matrix>
+
+    using namespace metal;
+
+    [[max_total_threads_per_threadgroup({threads})]]
+    kernel void matmul(const device {metal_type} *a [[buffer(0)]], const device {metal_type} *b [[buffer(1)]], device {metal_type} *c [[buffer(2)]], constant int *params [[buffer(3)]], uint tid [[thread_index_in_threadgroup]], uint group [[threadgroup_position_in_grid]], uint simd [[simdgroup_index_in_threadgroup]]) {{
+        int M = params[0];
+        int N = params[1];
+        int K = params[2];
+        uint tilesM = params[3];
+        uint tilesN = params[4];
+        uint batch = group / (tilesM * tilesN);
+        uint tile = group % (tilesM * tilesN);
+        int rowStart = (tile / tilesN) * {block_m};
+        int colStart = (tile % tilesN) * {block_n};
+        const device {metal_type} *aBase = a + params[8] + batch * params[5];
+        const device {metal_type} *bBase = b + params[12] + batch * params[9];
+        int aRow = params[6], aCol = params[7], bRow = params[10], bCol = params[11];
+"""
+    if not floating:
+        return header + f"""
+        threadgroup {metal_type} tileA[{block_m}][{block_k}];
+        threadgroup {metal_type} tileB[{block_k}][{block_n}];
+        int r = tid / {block_n};
+        int cc = tid % {block_n};
+        int row = rowStart + r;
+        int col = colStart + cc;
+
+        {metal_type} acc = 0;
+        for (int k0 = 0; k0 < K; k0 += {block_k}) {{
+            tileA[r][cc] = (row < M && k0 + cc < K) ? aBase[row * aRow + (k0 + cc) * aCol] : {metal_type}(0);
+            tileB[r][cc] = (k0 + r < K && col < N) ? bBase[(k0 + r) * bRow + col * bCol] : {metal_type}(0);
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+            for (int kk = 0; kk < {block_k}; kk++) {{
+                acc += tileA[r][kk] * tileB[kk][cc];
+            }}
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+        }}
+        if (row < M && col < N) {{
+            c[(batch * M + row) * N + col] = acc;
+        }}
+    }};
+    """
+
+    tiles_m, tiles_n = simd_m // 8, simd_n // 8
+    return header + f"""
+        // Tiles are kept as float whatever the input type, so that products accumulate in float
+        threadgroup float tileA[{block_m * block_k}];
+        threadgroup float tileB[{block_k * block_n}];
+        threadgroup float tileC[{block_m * block_n}];
+        uint simdRow = (simd / {block_n // simd_n}) * {simd_m};
+        uint simdCol = (simd % {block_n // simd_n}) * {simd_n};
+
+        simdgroup_float8x8 acc[{tiles_m}][{tiles_n}];
+        for (uint i = 0; i < {tiles_m}; i++) {{
+            for (uint j = 0; j < {tiles_n}; j++) {{
+                acc[i][j] = make_filled_simdgroup_matrix<float, 8, 8>(0.0f);
+            }}
+        }}
+
+        for (int k0 = 0; k0 < K; k0 += {block_k}) {{
+            for (uint i = tid; i < {block_m * block_k}; i += {threads}) {{
+                int row = rowStart + i / {block_k};
+                int col = k0 + i % {block_k};
+                tileA[i] = (row < M && col < K) ? float(aBase[row * aRow + col * aCol]) : 0.0f;
+            }}
+            for (uint i = tid; i < {block_k * block_n}; i += {threads}) {{
+                int row = k0 + i / {block_n};
+                int col = colStart + i % {block_n};
+                tileB[i] = (row < K && col < N) ? float(bBase[row * bRow + col * bCol]) : 0.0f;
+            }}
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+
+            for (uint kk = 0; kk < {block_k}; kk += 8) {{
+                simdgroup_float8x8 am[{tiles_m}];
+                simdgroup_float8x8 bm[{tiles_n}];
+                for (uint i = 0; i < {tiles_m}; i++) {{
+                    simdgroup_load(am[i], &tileA[(simdRow + i * 8) * {block_k} + kk], {block_k});
+                }}
+                for (uint j = 0; j < {tiles_n}; j++) {{
+                    simdgroup_load(bm[j], &tileB[kk * {block_n} + simdCol + j * 8], {block_n});
+                }}
+                for (uint i = 0; i < {tiles_m}; i++) {{
+                    for (uint j = 0; j < {tiles_n}; j++) {{
+                        simdgroup_multiply_accumulate(acc[i][j], am[i], bm[j], acc[i][j]);
+                    }}
+                }}
+            }}
+            threadgroup_barrier(mem_flags::mem_threadgroup);
+        }}
+
+        for (uint i = 0; i < {tiles_m}; i++) {{
+            for (uint j = 0; j < {tiles_n}; j++) {{
+                simdgroup_store(acc[i][j], &tileC[(simdRow + i * 8) * {block_n} + simdCol + j * 8], {block_n});
+            }}
+        }}
+        threadgroup_barrier(mem_flags::mem_threadgroup);
+        for (uint i = tid; i < {block_m * block_n}; i += {threads}) {{
+            int row = rowStart + i / {block_n};
+            int col = colStart + i % {block_n};
+            if (row < M && col < N) {{
+                c[(batch * M + row) * N + col] = {metal_type}(tileC[i]);
+            }}
+        }}
+    }};
+    """
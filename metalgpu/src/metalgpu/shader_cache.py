@@ -0,0 +1,121 @@
+import hashlib
+import os
+import platform
+import subprocess
+import tempfile
+
+# Bump whenever the way shaders are compiled or stored changes, so that stale binaries are never loaded
+CACHE_VERSION = 1
+
+
+# Compiles a metal source to a .metallib using the Xcode command line tools
+class MetalCompiler:
+    def __call__(self, source: str, output_path: str) -> None:
+        with tempfile.TemporaryDirectory() as tmp:
+            source_path = os.path.join(tmp, "shader.metal")
+            air_path = os.path.join(tmp, "shader.air")
+            with open(source_path, "w") as f:
+                f.write(source)
+            subprocess.run(["xcrun", "-sdk", "macosx", "metal", "-c", source_path, "-o", air_path], check=True, capture_output=True)
+            subprocess.run(["xcrun", "-sdk", "macosx", "metallib", air_path, "-o", output_path], check=True, capture_output=True)
+
+
+class ShaderCache:
+    def __init__(self, directory: str, max_size: int = 256 * 1024 * 1024, compiler=None) -> None:
+        assert max_size > 0, "[MetalGPU] Shader cache size must be greater than 0"
+        self.directory = directory
+        self.max_size = max_size
+        self.compiler = compiler if compiler is not None else MetalCompiler()
+        self.version = f"{CACHE_VERSION}:{platform.mac_ver()[0]}:{platform.machine()}"
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__compilerAvailable = True
+
+        os.makedirs(directory, exist_ok=True)
+
+    def key(self, source: str, specialization: str = "") -> str:
+        digest = hashlib.sha256()
+        for part in (self.version, specialization, source):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key + ".metallib")
+
+    # Returns the path of the compiled library for source, compiling it on a miss, or None if it can't be compiled
+    def get(self, source: str, specialization: str = "") -> str | None:
+        path = self.path(self.key(source, specialization))
+        if os.path.isfile(path):
+            self.hits += 1
+            # The modification time is used as the last access time for eviction
+            os.utime(path)
+            return path
+
+        self.misses += 1
+        if not self.__compilerAvailable:
+            return None
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        os.close(fd)
+        try:
+            self.compiler(source, tmp_path)
+            os.replace(tmp_path, path)
+        except (FileNotFoundError, subprocess.CalledProcessError, OSError):
+            # No compiler, or xcrun without the Metal toolchain, on this machine: don't spawn it again for every shader.
+            # Kernels are then compiled from source, which reports errors in the shader itself
+            self.__compilerAvailable = False
+            return None
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        self.evict(keep=path)
+        return path
+
+    def entries(self) -> list[tuple[str, int, float]]:
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".metallib"):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def size(self) -> int:
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep: str | None = None) -> None:
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.evictions += 1
+
+    def clear(self) -> None:
+        for path, _, _ in self.entries():
+            os.remove(path)
+
+    def stats(self) -> dict:
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(size for _, size, _ in entries),
+        }
@@ -0,0 +1,68 @@
+import numpy as np
+
+from .buffer import Buffer
+from .lazy import LazyBuffer
+from .scan import _scan
+from .utils import anyToMetal
+from .shader import sort_key_bits, radix_count_func_kernel, radix_scatter_func_kernel
+
+# Bits sorted per pass, the scatter kernels having one counter per digit value
+_radix_bits = 4
+
+
+# LSD radix sort of the row-major flattened keys, carrying values along, or the original indices when index_values is set
+def _radix_sort(keys : Buffer | LazyBuffer, values : Buffer | LazyBuffer | None, index_values : bool) -> tuple[Buffer, Buffer | None]:
+    if isinstance(keys, LazyBuffer):
+        keys = keys.evaluate()
+    if isinstance(values, LazyBuffer):
+        values = values.evaluate()
+    interface = keys.interface
+    keys = keys.contiguous()
+    if values is not None:
+        assert(values.size == keys.size), "[MetalGPU] Keys and values must have the same number of elements"
+        values = values.contiguous()
+
+    length = keys.size
+    keyType = anyToMetal(keys.bufType)
+    keyBits = sort_key_bits(np.dtype(keys.bufType), "KEY")
+    valueType = "int" if index_values else (anyToMetal(values.bufType) if values is not None else None)
+    passes = np.dtype(keys.bufType).itemsize * 8 // _radix_bits
+
+    count_kernel = interface.get_kernel(radix_count_func_kernel(keyType, keyBits), "radix_count")
+    scatter_kernel = interface.get_kernel(radix_scatter_func_kernel(keyType, valueType, keyBits, False), "radix_scatter")
+    first_scatter_kernel = interface.get_kernel(radix_scatter_func_kernel(keyType, valueType, keyBits, True), "radix_scatter") if index_values else scatter_kernel
+    # Every scatter thread moves one key, a block being one threadgroup
+    block = scatter_kernel.maxThreadsPerGroup()
+    blocks = -(-length // block)
+
+    # The number of passes is even, so the result always ends up in the first pair of buffers
+    sortedKeys = [interface.create_buffer(length, keyType, interface.output_storage), interface.create_buffer(length, keyType, interface.output_storage)]
+    sortedValues = [interface.create_buffer(length, valueType, interface.output_storage), interface.create_buffer(length, valueType, interface.output_storage)] if valueType is not None else [None, None]
+
+    sourceKeys, sourceValues = keys, values
+    with interface.batch():
+        for sortPass in range(passes):
+            targetKeys, targetValues = sortedKeys[(sortPass + 1) % 2], sortedValues[(sortPass + 1) % 2]
+            params = np.array([length, sortPass * _radix_bits, blocks, block], dtype=np.uint32)
+            counts = interface.create_buffer(16 * blocks, "uint", "private")
+            offsets = interface.create_buffer(16 * blocks, "uint", "private")
+
+            count_kernel(blocks * count_kernel.maxThreadsPerGroup(), [sourceKeys, counts, params], threads_per_group=count_kernel.maxThreadsPerGroup())
+            _scan(counts, 1, 16 * blocks, "uint", True, offsets)
+            scatter = first_scatter_kernel if sortPass == 0 else scatter_kernel
+            scatter(blocks * block, [sourceKeys, targetKeys, sourceValues, targetValues, offsets, params], threads_per_group=block)
+            sourceKeys, sourceValues = targetKeys, targetValues
+
+    return sortedKeys[0], sortedValues[0]
+
+
+def sort(buf : Buffer | LazyBuffer) -> Buffer:
+    return _radix_sort(buf, None, False)[0]
+
+
+def argsort(buf : Buffer | LazyBuffer) -> Buffer:
+    return _radix_sort(buf, None, True)[1]
+
+
+def sort_by_key(keys : Buffer | LazyBuffer, values : Buffer | LazyBuffer) -> tuple[Buffer, Buffer]:
+    return _radix_sort(keys, values, False)
@@ -0,0 +1,87 @@
+import itertools
+from collections import deque
+
+import numpy as np
+
+from .kernel import Kernel
+from .utils import anyToMetal
+
+
+# Pieces of at most chunk_size rows. Arrays, memory maps included, are sliced without reading them,
+# iterables are consumed one item at a time, items larger than a chunk being split
+def chunks(source, chunk_size : int):
+    if isinstance(source, np.ndarray):
+        for start in range(0, len(source), chunk_size):
+            yield source[start:start + chunk_size]
+        return
+    for item in source:
+        item = np.asarray(item)
+        if item.ndim == 0:
+            item = item.reshape(1)
+        for start in range(0, len(item), chunk_size):
+            yield item[start:start + chunk_size]
+
+
+class StagingSlot:
+    def __init__(self, interface, chunk_size : int, rowShape : tuple, inType, outType) -> None:
+        self.input = interface.create_buffer((chunk_size,) + rowShape, anyToMetal(inType))
+        self.output = interface.create_buffer((chunk_size,) + rowShape, anyToMetal(outType))
+        self.rows = 0
+        self.completion = None
+
+    def result(self) -> np.ndarray:
+        if self.completion is not None:
+            self.completion.wait()
+            self.completion = None
+        # Copied, the slot is filled with a later chunk as soon as the caller asks for the next result
+        return self.output.contents[:self.rows].copy()
+
+    def release(self) -> None:
+        self.input.release()
+        self.output.release()
+
+
+def stream_map(kernel : Kernel, source, chunk_size : int, out_dtype=None, args : tuple | list = (), stages : int = 2, threads_per_group=None):
+    # Checked here rather than in the generator, which only runs once the first result is asked for
+    assert(isinstance(kernel, Kernel)), "[MetalGPU] Only kernels from Interface.get_kernel can be streamed"
+    assert(chunk_size > 0), "[MetalGPU] Chunk size must be greater than 0"
+    assert(stages >= 2), "[MetalGPU] Streaming needs at least 2 stages to overlap copies and compute"
+    return _stream(kernel, source, chunk_size, out_dtype, tuple(args), stages, threads_per_group)
+
+
+def _stream(kernel : Kernel, source, chunk_size : int, out_dtype, args : tuple, stages : int, threads_per_group):
+    interface = kernel.interface
+    pieces = chunks(source, chunk_size)
+    first = next(pieces, None)
+    if first is None:
+        return
+    rowShape = first.shape[1:]
+    inType = first.dtype
+    outType = np.dtype(out_dtype) if out_dtype is not None else inType
+
+    # Rotated staging buffers: the next chunk is copied into a free slot while the GPU runs the previous ones
+    free = []
+    pending = deque()
+    try:
+        for piece in itertools.chain([first], pieces):
+            assert(piece.shape[1:] == rowShape), f"[MetalGPU] Chunk rows of shape {piece.shape[1:]} don't match the first chunk's {rowShape}"
+            if len(pending) == stages:
+                slot = pending.popleft()
+                free.append(slot)
+                yield slot.result()
+            slot = free.pop() if free else StagingSlot(interface, chunk_size, rowShape, inType, outType)
+
+            slot.rows = len(piece)
+            slot.input.contents[:slot.rows] = piece
+            size = slot.rows * int(np.prod(rowShape))
+            slot.completion = kernel(size, [slot.input, slot.output, *args], False, threads_per_group)
+            pending.append(slot)
+
+        while pending:
+            slot = pending.popleft()
+            free.append(slot)
+            yield slot.result()
+    finally:
+        # Released buffers are only reused once the GPU is done with them, pending chunks can be dropped safely
+        for slot in free + list(pending):
+            slot.release()
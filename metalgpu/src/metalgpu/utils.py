@@ -1,38 +1,148 @@
 import numpy as np
 import ctypes
+import mmap
+
+try:
+    import ml_dtypes
+except ImportError:
+    ml_dtypes = None
 
 # table[0]: Metal type, table[1]: numpy type, table[2]: ctypes type, table[2:]: Unspecified
+# ctypes has no 16 bit floats, their memory is exposed as uint16 and viewed with the numpy type, so they come after uint16_t
 tables = [
     ["int", np.int32, ctypes.c_int],
     ["float", np.float32, ctypes.c_float],
-    ["half", np.int16, ctypes.c_int16, "short"],
-    ["bool", np.bool_, ctypes.c_bool, np.byte],
+    ["short", np.int16, ctypes.c_int16, "int16", "int16_t"],
+    ["bool", np.bool_, ctypes.c_bool],
+    ["char", np.int8, ctypes.c_int8, "int8", "int8_t"],
     ["long", np.int64, ctypes.c_long, "int64", "int64_t"],
     ["uint64_t", np.uint64, ctypes.c_ulong, "uint64", "unsigned long"],
     ["uint32_t", np.uint32, ctypes.c_uint, "uint32", "uint", "unsigned int"],
-    ["uint16_t", np.uint16, ctypes.c_uint16, "uint16", "ushort", "unsigned short"]
+    ["uint16_t", np.uint16, ctypes.c_uint16, "uint16", "ushort", "unsigned short"],
+    ["half", np.float16, ctypes.c_uint16, "float16"],
 ]
 
-allowedCTypes = ctypes.c_int | ctypes.c_float | ctypes.c_int16 | ctypes.c_bool | ctypes.c_long | ctypes.c_ulong | ctypes.c_uint | ctypes.c_uint16 | ctypes.c_uint32 | ctypes.c_uint64
-allowedCTypesPointer = ctypes.POINTER(ctypes.c_int) | ctypes.POINTER(ctypes.c_float) | ctypes.POINTER(ctypes.c_int16) | ctypes.POINTER(ctypes.c_bool) | ctypes.POINTER(ctypes.c_long) | ctypes.POINTER(ctypes.c_ulong) | ctypes.POINTER(ctypes.c_uint) | ctypes.POINTER(ctypes.c_uint16) | ctypes.POINTER(ctypes.c_uint32) | ctypes.POINTER(ctypes.c_uint64)
-allowedNumpyTypes = np.int32 | np.float32 | np.int16 | np.bool_ | np.int64 | np.uint64 | np.uint32 | np.uint16
+# bfloat needs Metal 3.1, and ml_dtypes for the numpy type
+if ml_dtypes is not None:
+    tables.append(["bfloat", ml_dtypes.bfloat16, ctypes.c_uint16, "bfloat16"])
 
-def anyToMetal(receivedType : str | allowedNumpyTypes | allowedCTypes) -> str:
+allowedCTypes = ctypes.c_int | ctypes.c_float | ctypes.c_int16 | ctypes.c_bool | ctypes.c_int8 | ctypes.c_long | ctypes.c_ulong | ctypes.c_uint | ctypes.c_uint16 | ctypes.c_uint32 | ctypes.c_uint64
+allowedCTypesPointer = ctypes.POINTER(ctypes.c_int) | ctypes.POINTER(ctypes.c_float) | ctypes.POINTER(ctypes.c_int16) | ctypes.POINTER(ctypes.c_bool) | ctypes.POINTER(ctypes.c_int8) | ctypes.POINTER(ctypes.c_long) | ctypes.POINTER(ctypes.c_ulong) | ctypes.POINTER(ctypes.c_uint) | ctypes.POINTER(ctypes.c_uint16) | ctypes.POINTER(ctypes.c_uint32) | ctypes.POINTER(ctypes.c_uint64)
+allowedNumpyTypes = np.int32 | np.float32 | np.int16 | np.bool_ | np.int8 | np.int64 | np.uint64 | np.uint32 | np.uint16 | np.float16
+
+# numpy types compare equal to the strings of the types they convert to, np.dtype("int64") == "int" for one,
+# so they are matched by exact dtype first and only fall back to the aliases when no row has their dtype
+def findTable(receivedType) -> list:
+    if isinstance(receivedType, np.dtype) or (isinstance(receivedType, type) and issubclass(receivedType, np.generic)):
+        dtype = np.dtype(receivedType)
+        for table in tables:
+            if np.dtype(table[1]) == dtype:
+                return table
     for table in tables:
         if receivedType in table:
-            return table[0]
+            return table
     raise TypeError("[MetalGPU] Unsupported data type")
 
 
+def anyToMetal(receivedType : str | allowedNumpyTypes | allowedCTypes) -> str:
+    return findTable(receivedType)[0]
+
+
 def anyToCtypes(receivedType : str | allowedNumpyTypes | allowedCTypes) -> allowedCTypes:
-    for table in tables:
-        if receivedType in table:
-            return table[2]
-    raise TypeError("[MetalGPU] Unsupported data type")
+    return findTable(receivedType)[2]
 
 
 def anyToNumpy(receivedType : str | allowedNumpyTypes | allowedCTypes) -> allowedNumpyTypes:
-    for table in tables:
-        if receivedType in table:
-            return table[1]
-    raise TypeError("[MetalGPU] Unsupported data type")
+    return findTable(receivedType)[1]
+
+
+def isFloating(receivedType : str | allowedNumpyTypes | allowedCTypes) -> bool:
+    return anyToMetal(receivedType) in ("float", "half", "bfloat")
+
+
+# Metal can only wrap host memory without copying when it starts on a page boundary and spans whole pages
+PAGE_SIZE = mmap.PAGESIZE
+
+
+def pageAlignedArray(shape : int | tuple, dtype) -> np.ndarray:
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    padded = max(-(-nbytes // PAGE_SIZE) * PAGE_SIZE, PAGE_SIZE)
+    raw = np.empty(padded + PAGE_SIZE, dtype=np.uint8)
+    offset = -raw.ctypes.data % PAGE_SIZE
+    # The padding up to the next page stays owned by raw, which the returned view keeps alive
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+# setBytes only accepts small arguments, larger data must go through a buffer
+MAX_INLINE_BYTES = 4096
+
+
+# Bytes of a kernel argument passed inline, or None if value isn't one. Python scalars take the type numpy gives them,
+# narrowed to 32 bits as Metal has no doubles, and every type is checked through anyToMetal
+def inlineBytes(value) -> bytes | None:
+    if isinstance(value, (bytes, bytearray, ctypes.Structure, ctypes.Array)):
+        data = bytes(value)
+    elif isinstance(value, (bool, np.bool_)):
+        data = np.bool_(value).tobytes()
+    elif isinstance(value, int):
+        data = np.array(value, dtype=np.int32 if -2 ** 31 <= value < 2 ** 31 else np.int64).tobytes()
+    elif isinstance(value, (float, np.float64)):
+        data = np.float32(value).tobytes()
+    elif isinstance(value, (np.generic, np.ndarray)):
+        # Structured scalars and arrays are structs, whose layout must match the kernel's
+        if value.dtype.names is None:
+            anyToMetal(value.dtype)
+        data = np.ascontiguousarray(value).tobytes()
+    else:
+        return None
+    assert(0 < len(data) <= MAX_INLINE_BYTES), f"[MetalGPU] Inline arguments must be between 1 and {MAX_INLINE_BYTES} bytes, got {len(data)}"
+    return data
+
+
+# Scalar operand of an operator, converted to the data type of the buffer it is used with and passed to the kernel inline,
+# instead of through a buffer, as a constant reference that every thread reads. Operators keep the data type of the buffer,
+# so scalars that type can't hold, where numpy would promote the result, are rejected rather than silently truncated
+class Scalar:
+    def __init__(self, value, dtype) -> None:
+        self.bufType = np.dtype(dtype)
+        metalType = anyToMetal(self.bufType)
+        if isinstance(value, (complex, np.complexfloating)):
+            raise TypeError(f"[MetalGPU] Complex scalar {value} can't be used with a {metalType} buffer")
+        if self.bufType.kind in "iub" and isinstance(value, (float, np.floating)):
+            raise TypeError(f"[MetalGPU] Float scalar {value} can't be used with a {metalType} buffer without truncating it, convert the buffer with astype first")
+        if self.bufType.kind == "b" and not isinstance(value, (bool, np.bool_)):
+            raise TypeError(f"[MetalGPU] Only bool scalars can be used with a bool buffer, got {value}")
+        if self.bufType.kind in "iu" and not np.iinfo(self.bufType).min <= int(value) <= np.iinfo(self.bufType).max:
+            raise TypeError(f"[MetalGPU] Scalar {value} is out of range for a {metalType} buffer, convert the buffer with astype first")
+        self.value = np.array(value, dtype=self.bufType)[()]
+        self.shape = ()
+        self.size = 1
+
+
+def canWrapWithoutCopy(array : np.ndarray) -> bool:
+    if array.nbytes == 0 or not array.flags.c_contiguous or not array.flags.writeable or not array.dtype.isnative:
+        return False
+    address = array.ctypes.data
+    if address % PAGE_SIZE != 0:
+        return False
+
+    length = -(-array.nbytes // PAGE_SIZE) * PAGE_SIZE
+    if length == array.nbytes:
+        return True
+
+    # The last page is only partially used by the array, it must still belong to the same allocation
+    base = array
+    while isinstance(base.base, np.ndarray):
+        base = base.base
+    if base.base is not None:
+        return False
+    return address + length <= base.ctypes.data + base.nbytes
+
+
+# Plain text table, the first column left aligned and the others right aligned
+def format_table(header : list[str], rows : list[list[str]]) -> str:
+    widths = [max(len(header[i]), *(len(row[i]) for row in rows)) for i in range(len(header))]
+    line = "+" + "+".join("-" * (width + 2) for width in widths) + "+"
+    format_row = lambda row: "| " + " | ".join(cell.rjust(width) if i else cell.ljust(width) for i, (cell, width) in enumerate(zip(row, widths))) + " |"
+    return "\n".join([line, format_row(header), line] + [format_row(row) for row in rows] + [line])
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The package isn't installed for the tests, it is imported from the source tree
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
@@ -0,0 +1,29 @@
+import ctypes
+
+import numpy as np
+
+from metalgpu.buffer import Buffer
+from metalgpu.utils import anyToCtypes, anyToNumpy
+
+
+# Buffers over host arrays, standing in for an interface so that the Python side can be tested without a GPU
+class HostInterface:
+    lazy = False
+    output_storage = "shared"
+    in_batch = False
+
+    def create_buffer(self, shape, buffer_type, storage="shared"):
+        return self.array_to_buffer(np.zeros(shape, anyToNumpy(buffer_type)))
+
+    def array_to_buffer(self, array, copy=None):
+        pointer = array.ctypes.data_as(ctypes.POINTER(anyToCtypes(array.dtype)))
+        return Buffer(pointer, array.size, self, None, owner=array, shape=array.shape, dtype=array.dtype)
+
+    def copy_buffer(self, source, destination, wait_for_completion=True):
+        destination.contents[...] = source.contents
+
+    def batching(self):
+        return self.in_batch
+
+    def release_buffer(self, bufnum, owner=None):
+        pass
@@ -0,0 +1,74 @@
+import platform
+
+import numpy as np
+import pytest
+
+from host import HostInterface
+from metalgpu.autotune import Autotuner
+from metalgpu.interface import MetalSize
+
+
+class AccumulateKernel:
+    source = "accumulate"
+    function_name = "accumulate"
+    _tune_key = None
+
+    def threadExecutionWidth(self):
+        return 32
+
+    def maxThreadsPerGroup(self):
+        return 256
+
+
+# Runs the accumulating kernel on the CPU, out += values
+class AccumulateInterface(HostInterface):
+    def run_function(self, size, buffers, kernel, wait_for_completion=True, threads_per_group=None):
+        buffers[0].contents[...] += buffers[1].contents
+
+    def last_gpu_time(self):
+        return 1.0
+
+
+def test_tune_leaves_buffers_untouched():
+    interface = AccumulateInterface()
+    out = interface.array_to_buffer(np.zeros(8, dtype=np.float32))
+    values = interface.array_to_buffer(np.arange(8, dtype=np.float32))
+
+    threads = Autotuner().tune(interface, AccumulateKernel(), MetalSize(8, 1, 1), [out, values])
+    assert threads[0] in (32, 64, 128, 256)
+    np.testing.assert_array_equal(out.contents, np.zeros(8))
+
+
+def test_tune_copies_views_with_their_layout():
+    interface = AccumulateInterface()
+    base = interface.array_to_buffer(np.zeros((4, 2), dtype=np.float32))
+    values = interface.array_to_buffer(np.arange(8, dtype=np.float32).reshape(2, 4))
+
+    Autotuner().tune(interface, AccumulateKernel(), MetalSize(8, 1, 1), [base.T, values])
+    np.testing.assert_array_equal(base.contents, np.zeros((4, 2)))
+
+
+accumulate_shader = """
+#include <metal_stdlib>
+using namespace metal;
+kernel void accumulate(device float *out [[buffer(0)]], const device float *values [[buffer(1)]], uint id [[thread_position_in_grid]]) {
+    out[id] += values[id];
+}
+"""
+
+
+@pytest.mark.skipif(platform.system() != "Darwin", reason="Needs Metal")
+def test_accumulate_matches_without_autotune():
+    import metalgpu
+
+    results = []
+    for autotune in (False, True):
+        interface = metalgpu.Interface()
+        interface.autotune = autotune
+        kernel = interface.get_kernel(accumulate_shader, "accumulate")
+        out = interface.array_to_buffer(np.ones(4096, dtype=np.float32))
+        values = interface.array_to_buffer(np.arange(4096, dtype=np.float32))
+        kernel(4096, [out, values])
+        results.append(out.contents.copy())
+    np.testing.assert_array_equal(results[0], results[1])
+    np.testing.assert_array_equal(results[0], 1 + np.arange(4096, dtype=np.float32))
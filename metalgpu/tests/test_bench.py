@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import pytest
+
+from metalgpu import bench
+
+
+def _results(**medians):
+    return {"version": bench.RESULTS_VERSION, "backend": "numpy", "results": [{"name": name, "time": {"median": median}} for name, median in medians.items()]}
+
+
+def test_summarize_percentiles():
+    times = [float(value) for value in range(1, 101)]
+    stats = bench.summarize(times)
+
+    assert stats["min"] == 1
+    assert stats["mean"] == pytest.approx(50.5)
+    for key, percentile in (("p10", 10), ("median", 50), ("p90", 90), ("p99", 99)):
+        assert stats[key] == pytest.approx(np.percentile(times, percentile))
+    assert stats["stdev"] == pytest.approx(np.std(times, ddof=1))
+    assert bench.summarize([0.5])["stdev"] == 0
+
+
+def test_compare_threshold():
+    baseline = _results(slower=1.0, faster=1.0, same=1.0, edge=1.0, removed=1.0)
+    results = _results(slower=1.2, faster=0.8, same=1.05, edge=1.1, added=1.0)
+    rows = {row["name"]: row for row in bench.compare(results, baseline, 0.1)}
+
+    # Benchmarks missing from either side aren't compared
+    assert sorted(rows) == ["edge", "faster", "same", "slower"]
+    assert rows["slower"]["status"] == "regression"
+    assert rows["slower"]["ratio"] == pytest.approx(1.2)
+    assert rows["faster"]["status"] == "improvement"
+    assert rows["same"]["status"] == "ok"
+    assert rows["edge"]["status"] == "ok"
+
+
+def test_run_benchmark_numpy():
+    benchmark = next(benchmark for benchmark in bench.benchmarks(1024, 8) if benchmark.name == "vector_add")
+    result = bench.run_benchmark(bench.NumpyBackend(), benchmark, 1024, 1, 5)
+
+    assert result["name"] == "vector_add" and result["size"] == 1024 and result["runs"] == 5
+    assert result["verified"]
+    assert result["gpu_time"] is None
+    assert 0 < result["time"]["min"] <= result["time"]["median"] <= result["time"]["p99"]
+    assert result["bandwidth_gbs"] == pytest.approx(12 * 1024 / result["time"]["median"] / 1e9)
+
+
+def _main(*extra):
+    return bench.main(["--backend", "numpy", "--filter", "vector_add", "--filter", "sum", "--size", "1024", "--warmup", "0", "--runs", "3", *extra])
+
+
+def test_json_round_trip(tmp_path, capsys):
+    path = tmp_path / "results.json"
+    assert _main("--json", str(path)) == 0
+
+    with open(path) as f:
+        saved = json.load(f)
+    assert saved["version"] == bench.RESULTS_VERSION
+    assert saved["backend"] == "numpy"
+    assert [result["name"] for result in saved["results"]] == ["vector_add", "sum", "cumsum"]
+    assert all(result["verified"] for result in saved["results"])
+
+    # Results compare against themselves without any regression
+    rows = bench.compare(saved, saved, 0.1)
+    assert [row["status"] for row in rows] == ["ok"] * 3
+
+
+def test_compare_exit_codes(tmp_path, capsys):
+    path = tmp_path / "baseline.json"
+    assert _main("--json", str(path)) == 0
+    with open(path) as f:
+        baseline = json.load(f)
+
+    # A baseline far slower than anything measured only shows improvements
+    for result in baseline["results"]:
+        result["time"]["median"] = 1e3
+    with open(path, "w") as f:
+        json.dump(baseline, f)
+    assert _main("--compare", str(path)) == 0
+    assert "improvement" in capsys.readouterr().out
+
+    # And one far faster is a regression, reported through the exit code
+    for result in baseline["results"]:
+        result["time"]["median"] = 1e-12
+    with open(path, "w") as f:
+        json.dump(baseline, f)
+    assert _main("--compare", str(path), "--threshold", "0.5") == 2
+    assert "REGRESSION" in capsys.readouterr().out
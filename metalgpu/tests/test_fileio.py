@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from host import HostInterface
+from metalgpu.fileio import load_buffer, save_buffer
+
+
+@pytest.mark.parametrize("dtype", [np.int64, np.int8, np.float16])
+@pytest.mark.parametrize("copy", [None, True])
+def test_npy_round_trip(tmp_path, dtype, copy):
+    interface = HostInterface()
+    array = (np.arange(24) - 12).astype(dtype).reshape(4, 6)
+    np.save(tmp_path / "in.npy", array)
+
+    buffer = load_buffer(interface, tmp_path / "in.npy", copy=copy)
+    assert buffer.bufType == np.dtype(dtype)
+    assert buffer.shape == (4, 6)
+    np.testing.assert_array_equal(buffer.contents, array)
+
+    save_buffer(buffer, tmp_path / "out.npy")
+    saved = np.load(tmp_path / "out.npy")
+    assert saved.dtype == np.dtype(dtype)
+    np.testing.assert_array_equal(saved, array)
+
+
+def test_raw_int64(tmp_path):
+    array = np.arange(-5, 5, dtype=np.int64)
+    array.tofile(tmp_path / "in.raw")
+    buffer = load_buffer(HostInterface(), tmp_path / "in.raw", np.int64)
+    assert buffer.bufType == np.dtype(np.int64)
+    np.testing.assert_array_equal(buffer.contents, array)
+
+
+def test_unconvertible_dtype(tmp_path):
+    np.save(tmp_path / "in.npy", np.arange(4, dtype=np.float64))
+    with pytest.raises(TypeError):
+        load_buffer(HostInterface(), tmp_path / "in.npy")
@@ -0,0 +1,42 @@
+import platform
+
+import numpy as np
+import pytest
+
+from metalgpu.reductions import _acc_type
+from metalgpu.shader import reduce_func_kernel
+from metalgpu.utils import anyToMetal, anyToNumpy
+
+
+@pytest.mark.parametrize("dtype", [np.int32, np.int16, np.int8, np.bool_, np.int64, np.uint32, np.uint16, np.uint64])
+def test_integer_sums_match_numpy_dtype(dtype):
+    accType = _acc_type("sum", anyToMetal(dtype))
+    assert np.dtype(anyToNumpy(accType)) == np.sum(np.zeros(4, dtype=dtype)).dtype
+
+
+def test_other_reductions_keep_their_type():
+    assert _acc_type("max", "int") == "int"
+    assert _acc_type("min", "short") == "short"
+    assert _acc_type("max", "bool") == "int"
+    assert _acc_type("mean", "int") == "float"
+    assert _acc_type("sum", "half") == "float"
+
+
+def test_64_bit_sums_shuffle_halves():
+    source = reduce_func_kernel("sum", "int", "long", "p", False)
+    assert "as_type<long>(simd_shuffle_down(as_type<uint2>(value), offset))" in source
+    assert "simd_shuffle_down(value, offset)" not in source
+
+
+@pytest.mark.skipif(platform.system() != "Darwin", reason="Needs Metal")
+def test_int_sum_doesnt_overflow():
+    import metalgpu
+
+    interface = metalgpu.Interface()
+    array = np.full((4, 100_000), 2 ** 30, dtype=np.int32)
+    buffer = interface.array_to_buffer(array)
+
+    total = metalgpu.sum(buffer)
+    assert total.contents.dtype == np.int64
+    assert int(total.contents) == int(array.sum())
+    np.testing.assert_array_equal(metalgpu.sum(buffer, axis=1).contents, array.sum(axis=1))
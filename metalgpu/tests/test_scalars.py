@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from host import HostInterface
+from metalgpu.lazy import as_operand
+from metalgpu.utils import Scalar
+
+
+def test_int_buffer_rejects_float_scalar():
+    buffer = HostInterface().create_buffer(4, "int")
+    with pytest.raises(TypeError):
+        buffer * 2.5
+    with pytest.raises(TypeError):
+        buffer + np.float32(1)
+
+
+def test_uint_buffer_rejects_negative_scalar():
+    buffer = HostInterface().create_buffer(4, "uint32_t")
+    with pytest.raises(TypeError):
+        buffer + (-1)
+    with pytest.raises(TypeError):
+        as_operand(2 ** 32, np.uint32)
+
+
+def test_bool_buffer_rejects_int_scalar():
+    with pytest.raises(TypeError):
+        Scalar(2, np.bool_)
+
+
+@pytest.mark.parametrize("value, dtype, expected", [
+    (3, np.int32, np.int32(3)),
+    (-1, np.int8, np.int8(-1)),
+    (2 ** 40, np.int64, np.int64(2 ** 40)),
+    (True, np.int32, np.int32(1)),
+    (2.5, np.float32, np.float32(2.5)),
+    (2, np.float16, np.float16(2)),
+])
+def test_representable_scalars(value, dtype, expected):
+    scalar = as_operand(value, dtype)
+    assert scalar.value.dtype == np.dtype(dtype)
+    assert scalar.value == expected
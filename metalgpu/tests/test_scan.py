@@ -0,0 +1,30 @@
+import platform
+
+import numpy as np
+import pytest
+
+from host import HostInterface
+import metalgpu
+
+
+@pytest.mark.parametrize("function", [metalgpu.nonzero, metalgpu.flatnonzero, lambda mask: metalgpu.compact(mask, mask)])
+def test_compaction_rejected_inside_batch(function):
+    interface = HostInterface()
+    interface.in_batch = True
+    mask = interface.array_to_buffer(np.array([0, 1, 0, 1], dtype=np.int32))
+    with pytest.raises(AssertionError):
+        function(mask)
+
+
+@pytest.mark.skipif(platform.system() != "Darwin", reason="Needs Metal")
+def test_nonzero_matches_numpy():
+    interface = metalgpu.Interface()
+    array = (np.arange(60).reshape(3, 4, 5) % 7 == 0).astype(np.int32)
+    buffer = interface.array_to_buffer(array)
+
+    indices = metalgpu.nonzero(buffer)
+    assert len(indices) == 3
+    for result, expected in zip(indices, np.nonzero(array)):
+        np.testing.assert_array_equal(result.contents, expected)
+    np.testing.assert_array_equal(metalgpu.nonzero(buffer.T)[0].contents, np.nonzero(array.T)[0])
+    np.testing.assert_array_equal(metalgpu.flatnonzero(buffer).contents, np.flatnonzero(array))
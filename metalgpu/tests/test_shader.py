@@ -0,0 +1,60 @@
+import re
+
+import numpy as np
+import pytest
+
+from host import HostInterface
+from metalgpu.shader import element_index
+
+
+# Evaluates the Metal index expression for every row-major position of the view, unsigned division being floor division
+def _indices(view):
+    expression = re.sub(r"(\d+)u\b", r"\1", element_index(view, "p")).replace("/", "//")
+    return np.array([eval(expression, {}, {"p": p}) for p in range(view.size)])
+
+
+# Element offsets of the view into its storage, as numpy lays it out
+def _expected(view):
+    storage = np.arange(view.length)
+    return np.lib.stride_tricks.as_strided(storage[view.offset:], view.shape, [stride * storage.itemsize for stride in view.strides]).ravel()
+
+
+def _buffer(shape):
+    return HostInterface().array_to_buffer(np.zeros(shape, dtype=np.float32))
+
+
+def test_contiguous_index_is_the_position():
+    assert element_index(_buffer((3, 4)), "p") == "p"
+
+
+@pytest.mark.parametrize("axes", [(1, 0, 2), (2, 1, 0), (0, 2, 1), (2, 0, 1)])
+def test_transposed(axes):
+    view = _buffer((2, 3, 5)).transpose(axes)
+    np.testing.assert_array_equal(_indices(view), _expected(view))
+
+
+@pytest.mark.parametrize("shape, strides, offset", [
+    ((4,), (1,), 3),
+    ((3, 2), (4, 1), 1),
+    ((2, 2), (1, 6), 5),
+    ((3,), (4,), 2),
+])
+def test_offset(shape, strides, offset):
+    view = _buffer(16)._view(shape, strides, offset)
+    np.testing.assert_array_equal(_indices(view), _expected(view))
+
+
+@pytest.mark.parametrize("source, shape", [
+    ((3,), (4, 3)),
+    ((3, 1), (3, 5)),
+    ((1, 4), (2, 3, 4)),
+    ((1,), (6,)),
+])
+def test_broadcast(source, shape):
+    view = _buffer(source).broadcast_to(shape)
+    np.testing.assert_array_equal(_indices(view), _expected(view))
+
+
+def test_broadcast_of_a_transposed_offset_view():
+    view = _buffer(32)._view((4, 3), (1, 5), 2).T.broadcast_to((2, 3, 4))
+    np.testing.assert_array_equal(_indices(view), _expected(view))
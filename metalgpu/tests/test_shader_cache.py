@@ -0,0 +1,77 @@
+import os
+import subprocess
+
+import pytest
+
+from metalgpu.shader_cache import ShaderCache
+
+
+# Writes the source as the "compiled" library, counting its calls
+class StubCompiler:
+    def __init__(self, error=None):
+        self.calls = 0
+        self.error = error
+
+    def __call__(self, source, output_path):
+        self.calls += 1
+        if self.error is not None:
+            raise self.error
+        with open(output_path, "w") as f:
+            f.write(source)
+
+
+def test_miss_then_hit(tmp_path):
+    compiler = StubCompiler()
+    cache = ShaderCache(str(tmp_path), compiler=compiler)
+
+    path = cache.get("kernel void a() {}")
+    assert path is not None and open(path).read() == "kernel void a() {}"
+    assert cache.get("kernel void a() {}") == path
+    assert compiler.calls == 1
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1 and cache.stats()["entries"] == 1
+
+
+def test_key_includes_specialization_and_version(tmp_path):
+    compiler = StubCompiler()
+    cache = ShaderCache(str(tmp_path), compiler=compiler)
+    assert cache.key("source") != cache.key("source", "float")
+
+    cache.get("source")
+    # A cache written by another library or OS version is never loaded
+    other = ShaderCache(str(tmp_path), compiler=compiler)
+    other.version = cache.version + "-other"
+    assert other.key("source") != cache.key("source")
+    other.get("source")
+    assert compiler.calls == 2
+    assert other.stats()["hits"] == 0
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = ShaderCache(str(tmp_path), max_size=30, compiler=StubCompiler())
+    first = cache.get("a" * 10)
+    second = cache.get("b" * 10)
+    third = cache.get("c" * 10)
+    # Modification times stand for access times, the first entry being the most recently used
+    for age, path in enumerate([first, third, second]):
+        os.utime(path, (1000 - age, 1000 - age))
+
+    fourth = cache.get("d" * 10)
+    assert os.path.isfile(first) and os.path.isfile(third) and os.path.isfile(fourth)
+    assert not os.path.isfile(second)
+    assert cache.stats()["evictions"] == 1
+    assert cache.size() <= 30
+
+
+def test_entry_larger_than_the_cache_is_kept(tmp_path):
+    cache = ShaderCache(str(tmp_path), max_size=5, compiler=StubCompiler())
+    assert os.path.isfile(cache.get("a" * 10))
+
+
+@pytest.mark.parametrize("error", [FileNotFoundError(), subprocess.CalledProcessError(72, "xcrun"), OSError()])
+def test_compiler_disabled_after_failure(tmp_path, error):
+    compiler = StubCompiler(error)
+    cache = ShaderCache(str(tmp_path), compiler=compiler)
+    assert cache.get("a") is None
+    assert cache.get("b") is None
+    assert compiler.calls == 1
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
@@ -0,0 +1,58 @@
+import platform
+import threading
+
+import numpy as np
+import pytest
+
+
+fill_shader = """
+#include <metal_stdlib>
+using namespace metal;
+kernel void fill(device int *out [[buffer(0)]], uint id [[thread_position_in_grid]]) {
+    out[id] = VALUE;
+}
+"""
+
+
+@pytest.mark.skipif(platform.system() != "Darwin", reason="Needs Metal")
+def test_threads_run_their_own_function():
+    import metalgpu
+
+    interface = metalgpu.Interface()
+    errors = []
+    barrier = threading.Barrier(4)
+
+    def worker(value):
+        try:
+            interface.load_shader_from_string(fill_shader.replace("VALUE", str(value)))
+            out = interface.create_buffer(256, "int")
+            barrier.wait()
+            for _ in range(50):
+                interface.run_function(256, [out], "fill")
+                assert (out.contents == value).all(), f"thread {value} ran another thread's function"
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=worker, args=(value,)) for value in range(1, 5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+@pytest.mark.skipif(platform.system() != "Darwin", reason="Needs Metal")
+def test_new_threads_start_from_the_last_function():
+    import metalgpu
+
+    interface = metalgpu.Interface()
+    interface.load_shader_from_string(fill_shader.replace("VALUE", "7"))
+    interface.set_function("fill")
+    out = interface.create_buffer(64, "int")
+
+    # Short-lived threads, each of which leaves a state in the C library until it exits
+    for _ in range(32):
+        thread = threading.Thread(target=interface.run_function, args=(64, [out]))
+        thread.start()
+        thread.join()
+    np.testing.assert_array_equal(out.contents, np.full(64, 7))
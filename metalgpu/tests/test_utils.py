@@ -0,0 +1,44 @@
+import ctypes
+
+import numpy as np
+import pytest
+
+from metalgpu.utils import anyToCtypes, anyToMetal, anyToNumpy, ml_dtypes
+
+
+@pytest.mark.parametrize("metalType, numpyType, ctype, alias", [
+    ("int", np.int32, ctypes.c_int, "int"),
+    ("float", np.float32, ctypes.c_float, "float"),
+    ("short", np.int16, ctypes.c_int16, "int16"),
+    ("char", np.int8, ctypes.c_int8, "int8"),
+    ("bool", np.bool_, ctypes.c_bool, "bool"),
+    ("long", np.int64, ctypes.c_long, "int64"),
+    ("uint32_t", np.uint32, ctypes.c_uint, "uint32"),
+    ("uint16_t", np.uint16, ctypes.c_uint16, "uint16"),
+    ("half", np.float16, ctypes.c_uint16, "float16"),
+])
+def test_type_lookups(metalType, numpyType, ctype, alias):
+    for receivedType in (numpyType, np.dtype(numpyType), metalType, alias):
+        assert anyToMetal(receivedType) == metalType
+        assert anyToNumpy(receivedType) is numpyType
+        assert anyToCtypes(receivedType) is ctype
+
+
+@pytest.mark.skipif(ml_dtypes is None, reason="ml_dtypes isn't installed")
+def test_bfloat_lookups():
+    for receivedType in (ml_dtypes.bfloat16, np.dtype(ml_dtypes.bfloat16), "bfloat", "bfloat16"):
+        assert anyToMetal(receivedType) == "bfloat"
+        assert anyToNumpy(receivedType) is ml_dtypes.bfloat16
+        assert anyToCtypes(receivedType) is ctypes.c_uint16
+
+
+def test_ctypes_lookups():
+    assert anyToMetal(ctypes.c_long) == "long"
+    assert anyToMetal(ctypes.c_int16) == "short"
+    assert anyToMetal(ctypes.c_int8) == "char"
+
+
+def test_unlisted_dtypes_convert():
+    assert anyToMetal(np.dtype(np.float64)) == "float"
+    with pytest.raises(TypeError):
+        anyToMetal(np.complex64)